@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # Connects the signal handlers which invalidate cached events and sessions
+        from .auth import tickets  # noqa: F401
+        from .events import cache  # noqa: F401
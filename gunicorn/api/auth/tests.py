@@ -1,7 +1,10 @@
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
-from django.test import Client
+from django.test import Client, override_settings
 from django.urls import reverse
 
+from .tickets import LazyUser, issue_ticket, redeem_ticket, verify_ticket
+
 from ..misc.response import ResponseCode
 from ..misc.test import APITestCase
 
@@ -23,3 +26,36 @@ class AuthTestCase(APITestCase):
         user_id = parsed["response"]["user_id"]
 
         self.assertEqual(self.user.id, user_id)
+
+    def test_get_websocket_ticket(self):
+        client = Client()
+        response = client.get(reverse('get_websocket_ticket'))
+        self.parseAndCheckResponseCode(response, ResponseCode.RESPONSE_NOT_PERMITTED)
+
+        client.force_login(self.user)
+        response = client.get(reverse('get_websocket_ticket'))
+        parsed = self.parseAndCheckResponseCode(response, ResponseCode.RESPONSE_OK)
+        ticket = parsed["response"]["ticket"]
+
+        self.assertEqual(self.user.id, verify_ticket(ticket)[0])
+        self.assertIsNone(verify_ticket(ticket + "0"))
+        with override_settings(MARKING={'WEBSOCKET_TICKET_MAX_AGE': -1}):
+            self.assertIsNone(verify_ticket(ticket))
+
+    def test_redeem_ticket(self):
+        ticket = issue_ticket(self.user.id)
+        self.assertNotEqual(verify_ticket(ticket), verify_ticket(issue_ticket(self.user.id)))
+
+        self.assertEqual(self.user.id, async_to_sync(redeem_ticket)(ticket))
+        # A ticket opens one connection only
+        self.assertIsNone(async_to_sync(redeem_ticket)(ticket))
+        self.assertIsNone(async_to_sync(redeem_ticket)(ticket + "0"))
+
+    def test_lazy_user(self):
+        with self.assertNumQueries(0):
+            user = LazyUser(self.user.id)
+            self.assertEqual(self.user.id, user.id)
+            self.assertTrue(user.is_authenticated)
+            self.assertFalse(user.is_anonymous)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.user.username, user.username)
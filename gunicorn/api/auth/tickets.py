@@ -0,0 +1,148 @@
+"""
+Authentication of websockets without database queries.
+Clients get a signed short-lived ticket from GetWebsocketTicket and pass it
+as the `ticket` query parameter of the websocket url. A ticket opens one connection only.
+Clients without tickets are authenticated by the session cookie, the user ids
+of sessions are cached in redis for WEBSOCKET_SESSION_CACHE_TTL seconds.
+Both settings are taken from the MARKING settings, see api/marking/conf.py.
+The middleware relies on the scope hooks of channels 2 BaseMiddleware.
+"""
+
+import uuid
+from importlib import import_module
+from urllib.parse import parse_qs
+
+from channels.auth import UserLazyObject, get_user
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware
+from django.conf import settings
+from django.contrib.auth import get_user_model, user_logged_out
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.dispatch import receiver
+from django.utils.functional import SimpleLazyObject
+
+from ..marking.conf import get_setting
+from ..marking.storage.redis_backend import decode_int, encode_int
+from ..marking.storage.storage import ConnectionPool, get_sync_connection
+
+TICKET_SALT = "api.auth.websocket_ticket"
+REDEEMED_TICKET_PREFIX = "websocket_ticket_"
+SESSION_CACHE_PREFIX = "websocket_session_"
+
+
+def ticket_max_age():
+    return get_setting('WEBSOCKET_TICKET_MAX_AGE')
+
+
+def issue_ticket(user_id):
+    """
+    Signs a websocket ticket of a user.
+    :param user_id: id of the user
+    :return: ticket valid for WEBSOCKET_TICKET_MAX_AGE seconds
+    """
+
+    # The random nonce tells tickets issued within the same second apart
+    return signing.dumps([user_id, uuid.uuid4().hex], salt=TICKET_SALT)
+
+
+def verify_ticket(ticket):
+    """
+    Checks the signature and the age of a websocket ticket.
+    :param ticket: ticket returned by issue_ticket
+    :return: tuple (id of the user, nonce of the ticket) or None if the ticket is invalid or expired
+    """
+
+    try:
+        user_id, nonce = signing.loads(ticket, salt=TICKET_SALT, max_age=ticket_max_age())
+        return int(user_id), str(nonce)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+async def redeem_ticket(ticket):
+    """
+    Verifies a websocket ticket and marks it as used, so it cannot open another connection.
+    :param ticket: ticket returned by issue_ticket
+    :return: id of the user or None if the ticket is invalid, expired or used before
+    """
+
+    verified = verify_ticket(ticket)
+    if verified is None:
+        return None
+    user_id, nonce = verified
+    r = await ConnectionPool.get()
+    # The nonce is kept until the ticket expires anyway
+    if not await r.set(REDEEMED_TICKET_PREFIX + nonce, b'1', nx=True, ex=max(ticket_max_age(), 0) + 1):
+        return None
+    return user_id
+
+
+class LazyUser(SimpleLazyObject):
+    """
+    Authenticated user known by id only.
+    The user is loaded from the database on the first access to fields other than
+    id, pk, is_authenticated and is_anonymous, which must happen in synchronous code.
+    """
+
+    def __init__(self, user_id):
+        super().__init__(lambda: get_user_model().objects.get(pk=user_id))
+        # Set on the proxy itself, so reading them does not load the user
+        self.__dict__.update(id=user_id, pk=user_id, is_authenticated=True, is_anonymous=False)
+
+
+async def get_session_user_id(session_key):
+    """
+    Returns the user logged in by a session, the database is queried only on a cache miss.
+    :param session_key: key of the session from the session cookie
+    :return: id of the user or None if the session is not authenticated
+    """
+
+    key = SESSION_CACHE_PREFIX + session_key
+    r = await ConnectionPool.get()
+    user_id = await r.get(key)
+    if user_id is not None:
+        return decode_int(user_id)
+
+    session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+    user = await get_user({"session": session})
+    if user.is_anonymous:
+        return None
+    await r.setex(key, get_setting('WEBSOCKET_SESSION_CACHE_TTL'), encode_int(user.id))
+    return user.id
+
+
+class TicketAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope["user"] from the websocket ticket or the cached session.
+    Only the id of the user is known, other fields of the user are loaded on demand, see LazyUser.
+    Requires CookieMiddleware above it.
+    """
+
+    def populate_scope(self, scope):
+        if "cookies" not in scope:
+            raise ValueError("TicketAuthMiddleware cannot find cookies in scope. CookieMiddleware must be above it.")
+        if "user" not in scope:
+            scope["user"] = UserLazyObject()
+
+    async def resolve_scope(self, scope):
+        user_id = None
+        tickets = parse_qs(scope.get('query_string', b'').decode('utf-8')).get('ticket')
+        if tickets:
+            user_id = await redeem_ticket(tickets[0])
+        session_key = scope["cookies"].get(settings.SESSION_COOKIE_NAME)
+        if user_id is None and session_key:
+            # Old clients do not send tickets
+            user_id = await get_session_user_id(session_key)
+        scope["user"]._wrapped = LazyUser(user_id) if user_id is not None else AnonymousUser()
+
+
+def TicketAuthMiddlewareStack(inner):
+    return CookieMiddleware(TicketAuthMiddleware(inner))
+
+
+@receiver(user_logged_out)
+def forget_cached_session(sender, request, **kwargs):
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        get_sync_connection().delete(SESSION_CACHE_PREFIX + session.session_key)
@@ -3,5 +3,6 @@ from django.urls import path
 from . import views
 
 urlpatterns = [
-    path('GetCurrentUserId', views.get_current_user_id, name='get_current_user_id')
+    path('GetCurrentUserId', views.get_current_user_id, name='get_current_user_id'),
+    path('GetWebsocketTicket', views.get_websocket_ticket, name='get_websocket_ticket'),
 ]
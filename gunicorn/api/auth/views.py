@@ -1,8 +1,10 @@
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.http import require_GET
 
+from .tickets import issue_ticket, ticket_max_age
 from ..misc.response import (
     APIResponse,
+    APINotPermittedResponse,
 )
 
 
@@ -12,3 +14,10 @@ def get_current_user_id(request):
     if user is None:
         return APIResponse(response={'user_id': None})
     return APIResponse(response={'user_id': user.id})
+
+
+@require_GET
+def get_websocket_ticket(request):
+    if not request.user.is_authenticated:
+        return APINotPermittedResponse()
+    return APIResponse(response={'ticket': issue_ticket(request.user.id), 'expires_in': ticket_max_age()})
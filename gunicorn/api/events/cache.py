@@ -0,0 +1,163 @@
+"""
+Per-process cache of events used by websocket consumers.
+Entries are dropped on event updates and deletions in any process
+through a redis pub/sub channel.
+"""
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import redis
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .views import get_event_by_uuid
+from ..marking.conf import get_setting
+from ..marking.storage.storage import get_sync_connection
+from ..models import Event
+
+logger = logging.getLogger('api.events')
+
+INVALIDATION_CHANNEL = "event_cache_invalidation"
+
+
+class EventCache(object):
+    """
+    Thread-safe LRU cache of events keyed by uuid with a time to live.
+    The size and the time to live default to the EVENT_CACHE_SIZE and EVENT_CACHE_TTL settings,
+    which are read on use, so the cache can be created before settings are configured.
+    """
+
+    def __init__(self, max_size=None, ttl=None):
+        self._max_size = max_size
+        self._ttl = ttl
+        # uuid -> (expiration time, event)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.listener = None
+
+    @property
+    def max_size(self):
+        return self._max_size if self._max_size is not None else get_setting('EVENT_CACHE_SIZE')
+
+    @property
+    def ttl(self):
+        return self._ttl if self._ttl is not None else get_setting('EVENT_CACHE_TTL')
+
+    def get(self, event_id):
+        """
+        Returns an event from the cache, loading it from the database on a miss.
+        :param event_id: uuid of the event
+        :return: Event or None if it does not exist
+        """
+
+        try:
+            event_id = str(uuid.UUID(str(event_id)))
+        except ValueError:
+            return None
+
+        self.start_listener()
+
+        with self.lock:
+            entry = self.entries.get(event_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(event_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        event = get_event_by_uuid(event_id)
+        if event is None:
+            return None
+
+        with self.lock:
+            self.entries[event_id] = (time.monotonic() + self.ttl, event)
+            self.entries.move_to_end(event_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return event
+
+    def invalidate(self, event_id):
+        """
+        Drops an event from the cache of this process.
+        :param event_id: uuid of the event
+        """
+
+        with self.lock:
+            if self.entries.pop(str(event_id), None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "invalidations": self.invalidations}
+
+    def start_listener(self):
+        """
+        Starts a background thread that drops events invalidated by other processes.
+        """
+
+        if self.listener is not None:
+            return
+        with self.lock:
+            if self.listener is not None:
+                return
+            self.listener = threading.Thread(target=self.listen, name="event-cache-invalidation", daemon=True)
+            self.listener.start()
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = get_sync_connection().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                # Invalidations sent while we were not subscribed are lost
+                self.clear()
+                while True:
+                    # Polls for shorter than the read timeout of the connection
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self.invalidate(message['data'].decode('utf-8'))
+            except (redis.ConnectionError, redis.TimeoutError):
+                self.clear()
+                time.sleep(1)
+            except Exception:
+                # The thread is never restarted, so it resubscribes rather than leaving entries stale until their ttl
+                logger.exception("Listening to invalidations of cached events failed")
+                self.clear()
+                time.sleep(1)
+
+
+event_cache = EventCache()
+
+
+def get_cached_event_by_uuid(event_id):
+    return event_cache.get(event_id)
+
+
+def publish_invalidation(event_id):
+    """
+    Drops an event from the caches of all the processes.
+    :param event_id: uuid of the event
+    """
+
+    event_cache.invalidate(event_id)
+    get_sync_connection().publish(INVALIDATION_CHANNEL, str(event_id))
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def invalidate_cached_event(sender, instance, **kwargs):
+    transaction.on_commit(lambda: publish_invalidation(instance.uuid))
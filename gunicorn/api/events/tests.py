@@ -2,8 +2,10 @@ import datetime
 import json
 
 from django.contrib.auth.models import User
+from django.test import TestCase
 from django.urls import reverse
 
+from .cache import EventCache
 from ..misc.response import ResponseCode
 from ..misc.test import APITestCase, JSONClient
 from ..misc.time import datetime_to_string
@@ -329,3 +331,45 @@ class EventTestCase(APITestCase):
         response = client.post_json(reverse('leave_event'), {'event_id': str(event_id)})
         self.parseAndCheckResponseCode(response,
                                        ResponseCode.RESPONSE_NOT_PERMITTED)
+
+
+class EventCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        user = User(username='testuser')
+        user.set_password('12345')
+        user.save()
+        cls.event = Event(name='cached event', creator=user)
+        cls.event.save()
+
+    def test_hit_and_miss(self):
+        cache = EventCache(max_size=1, ttl=60)
+
+        self.assertEqual(self.event, cache.get(self.event.uuid))
+        self.assertEqual(self.event, cache.get(str(self.event.uuid).upper()))
+        self.assertIsNone(cache.get('not exist'))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1, 'invalidations': 0}, cache.stats())
+
+    def test_invalidate(self):
+        cache = EventCache(max_size=1, ttl=60)
+        cache.get(self.event.uuid)
+
+        cache.invalidate(self.event.uuid)
+        self.assertEqual(0, cache.stats()['size'])
+
+        self.event.delete()
+        self.assertIsNone(cache.get(self.event.uuid))
+
+    def test_ttl(self):
+        cache = EventCache(max_size=1, ttl=0)
+        cache.get(self.event.uuid)
+        cache.get(self.event.uuid)
+        self.assertEqual(2, cache.stats()['misses'])
+
+    def test_settings_read_on_use(self):
+        cache = EventCache()
+        with self.settings(MARKING={'EVENT_CACHE_SIZE': 0}):
+            cache.get(self.event.uuid)
+            self.assertEqual(0, cache.stats()['size'])
+        cache.get(self.event.uuid)
+        self.assertEqual(1, cache.stats()['size'])
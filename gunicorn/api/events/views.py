@@ -1,3 +1,4 @@
+import logging
 from datetime import datetime
 
 from django.contrib.auth.decorators import login_required
@@ -5,6 +6,7 @@ from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 from django.views.decorators.http import require_GET, require_POST
 
+from ..marking.lifecycle import close_event
 from ..misc.time import datetime_to_string, datetime_from_string
 from ..misc.http_decorators import (
     require_arguments,
@@ -21,6 +23,9 @@ from ..misc.response import (
 from ..models import Event
 
 
+logger = logging.getLogger('api.events')
+
+
 def get_event_by_uuid(uuid):
     try:
         event = Event.objects.filter(uuid=uuid).first()
@@ -148,6 +153,11 @@ def event_delete(request):
     elif event.time_from < datetime.utcnow():
         return APINotPermittedResponse(error_msg="Event has already started")
     event.delete()
+    try:
+        close_event(event.uuid)
+    except Exception:
+        # The event is deleted already, its keys are left to reclaim_marking_keys
+        logger.exception("Closing deleted event %s failed", event.uuid)
     return APIResponse()
 
 
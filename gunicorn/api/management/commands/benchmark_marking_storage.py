@@ -0,0 +1,25 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from ...marking.conf import get_setting
+from ...marking.storage.benchmark import benchmark_backend
+
+
+class Command(BaseCommand):
+    help = "Runs a marking session against storage backends and reports their throughput and latencies"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', dest='backends',
+                            help="Dotted path to a backend class, may be repeated, STORAGE_BACKEND by default")
+        parser.add_argument('--students', type=int, default=1000, help="Number of students")
+        parser.add_argument('--markers', type=int, default=50, help="Number of markers")
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        reports = [loop.run_until_complete(benchmark_backend(import_string(path)(), options['students'],
+                                                             options['markers']))
+                   for path in options['backends'] or [get_setting('STORAGE_BACKEND')]]
+        self.stdout.write(json.dumps(reports, indent=2))
@@ -0,0 +1,32 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...profile.karma import flush_pending_karma
+
+logger = logging.getLogger('api.management')
+
+
+class Command(BaseCommand):
+    help = "Writes karma changes accumulated in redis to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep flushing every INTERVAL seconds instead of flushing once")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            flushed = flush_pending_karma()
+            self.stdout.write("Flushed karma of {} users".format(flushed))
+            return
+        while True:
+            try:
+                flush_pending_karma()
+            except Exception:
+                # Changes not acknowledged are taken again on the next iteration
+                logger.exception("Failed to flush karma")
+                close_old_connections()
+            time.sleep(interval)
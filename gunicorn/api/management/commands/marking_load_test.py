@@ -0,0 +1,44 @@
+import asyncio
+import json
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+
+from ...marking.lifecycle import close_event
+from ...marking.loadtest import LoadTest, create_users, prepare_event
+
+
+class Command(BaseCommand):
+    help = "Runs virtual students and markers against a running server and reports latencies and throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default="ws://localhost:8000", help="Websocket address of the server")
+        parser.add_argument('--students', type=int, default=1000, help="Number of virtual students")
+        parser.add_argument('--markers', type=int, default=50, help="Number of virtual markers")
+        parser.add_argument('--refuse-rate', type=float, default=0.0,
+                            help="Share of prepared students markers refuse to mark")
+        parser.add_argument('--pairing', action='store_true', help="Let the server choose students for markers")
+        parser.add_argument('--duration', type=float, default=60.0, help="Maximal duration of the test in seconds")
+        parser.add_argument('--concurrency', type=int, default=100, help="Maximal number of simultaneous handshakes")
+        parser.add_argument('--connect-only', action='store_true',
+                            help="Only measure how fast students and markers get connected, do not mark")
+        parser.add_argument('--prefix', default="loadtest", help="Prefix of usernames of virtual users")
+
+    def handle(self, *args, **options):
+        students = create_users("{}_student".format(options['prefix']), options['students'])
+        markers = create_users("{}_marker".format(options['prefix']), options['markers'])
+        event = prepare_event(students, markers)
+
+        load_test = LoadTest(options['url'], event, students, markers, refuse_rate=options['refuse_rate'],
+                             pairing=options['pairing'], duration=options['duration'],
+                             concurrency=options['concurrency'], connect_only=options['connect_only'])
+        try:
+            loop = asyncio.get_event_loop()
+            report = loop.run_until_complete(load_test.run())
+        finally:
+            event.delete()
+            close_event(event.uuid)
+            Session.objects.filter(session_key__in=list(load_test.students.values()) +
+                                   list(load_test.markers.values())).delete()
+
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,14 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from ...marking.storage import redis_backend
+
+
+class Command(BaseCommand):
+    help = "Converts list-based marking keys stored in redis to sets"
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        migrated = loop.run_until_complete(redis_backend.migrate_all_lists_to_sets())
+        self.stdout.write("Migrated {} keys".format(migrated))
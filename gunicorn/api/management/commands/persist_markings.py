@@ -0,0 +1,43 @@
+import logging
+import socket
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...marking.persistence import persist_markings
+
+logger = logging.getLogger('api.management')
+
+
+class Command(BaseCommand):
+    help = "Saves markings accumulated in the redis stream to the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep saving, waiting up to INTERVAL seconds for new markings, "
+                                 "instead of saving the markings accumulated so far")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Maximal number of markings saved at once")
+        parser.add_argument('--consumer', default=socket.gethostname(),
+                            help="Name of the stream consumer, must be stable across restarts "
+                                 "to pick up markings read before a crash")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            processed = 0
+            while True:
+                read = persist_markings(options['consumer'], options['batch_size'])
+                processed += read
+                if read == 0:
+                    self.stdout.write("Processed {} markings".format(processed))
+                    return
+        while True:
+            try:
+                persist_markings(options['consumer'], options['batch_size'], int(interval * 1000))
+            except Exception:
+                # Markings not acknowledged are read again after the pause
+                logger.exception("Failed to persist markings")
+                close_old_connections()
+                time.sleep(interval)
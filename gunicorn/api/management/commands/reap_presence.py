@@ -0,0 +1,33 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+
+from ...marking.presence import reap_stale_presence
+
+logger = logging.getLogger('api.management')
+
+
+class Command(BaseCommand):
+    help = "Removes users whose websocket heartbeats stopped from marking lists"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep reaping every INTERVAL seconds instead of reaping once")
+
+    def handle(self, *args, **options):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.reap(get_channel_layer(), options['interval']))
+
+    async def reap(self, channel_layer, interval):
+        if interval is None:
+            reaped = await reap_stale_presence(channel_layer)
+            self.stdout.write("Reaped {} users".format(reaped))
+            return
+        while True:
+            try:
+                await reap_stale_presence(channel_layer)
+            except Exception:
+                logger.exception("Failed to reap stale presence")
+            await asyncio.sleep(interval)
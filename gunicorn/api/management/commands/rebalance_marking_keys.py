@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ...marking.storage import redis_backend
+
+
+class Command(BaseCommand):
+    help = "Moves marking state of events to the redis nodes owning them after REDIS_NODES have been changed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1000,
+                            help="Number of keys looked through per step of scanning")
+        parser.add_argument('--drain', action='append', default=[], metavar='HOST:PORT',
+                            help="Node removed from REDIS_NODES to move the events from, may be repeated")
+
+    def handle(self, *args, **options):
+        extra_nodes = [node.split(':') for node in options['drain']]
+        moved, conflicts = redis_backend.rebalance_event_keys(options['count'],
+                                                              [(host, int(port)) for host, port in extra_nodes])
+        self.stdout.write("Moved {} events".format(moved))
+        for event_id in conflicts:
+            self.stdout.write("Left in place {}: its keys already exist on the owner node".format(event_id))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from ...marking.lifecycle import reclaim_keys
+
+
+class Command(BaseCommand):
+    help = "Deletes marking state of finished and deleted events left in redis"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of events checked and purged at once")
+        parser.add_argument('--pause', type=float, default=0.1,
+                            help="Seconds to sleep between chunks")
+
+    def handle(self, *args, **options):
+        deleted = reclaim_keys(chunk_size=options['chunk_size'], pause=options['pause'])
+        self.stdout.write("Deleted {} keys".format(deleted))
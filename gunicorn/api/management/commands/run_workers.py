@@ -0,0 +1,37 @@
+import os
+
+from channels.routing import get_default_application
+from django.core.management.base import BaseCommand
+
+from backend.workers import WorkerRunner, worker_sockets
+
+
+class Command(BaseCommand):
+    help = "Serves HTTP and websockets by several daphne processes forked from one preloaded application, " \
+           "SIGHUP restarts the workers gracefully"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Number of worker processes, one per core by default")
+        parser.add_argument('--bind', default='0.0.0.0', help="Address to listen on")
+        parser.add_argument('--port', type=int, default=8000, help="Port to listen on")
+        parser.add_argument('--event-affinity', action='store_true',
+                            help="Every worker listens on its own port PORT + i, so a proxy hashing the event_id "
+                                 "query parameter sends all the sockets of an event to the same worker")
+        parser.add_argument('--ping-interval', type=int, default=20,
+                            help="Seconds a websocket must be idle before a keepalive ping is sent")
+        parser.add_argument('--ping-timeout', type=int, default=30,
+                            help="Seconds a websocket is kept without answers to pings")
+        parser.add_argument('--graceful-timeout', type=float, default=30,
+                            help="Seconds stopped workers are given to close their connections")
+        parser.add_argument('--pid', default=None, help="File to write the pid of the runner to")
+
+    def handle(self, *args, **options):
+        application = get_default_application()
+        sockets = worker_sockets(options['bind'], options['port'], options['workers'], options['event_affinity'])
+        if options['pid']:
+            with open(options['pid'], 'w') as f:
+                f.write(str(os.getpid()))
+        WorkerRunner(application, sockets,
+                     {'ping_interval': options['ping_interval'], 'ping_timeout': options['ping_timeout']},
+                     graceful_timeout=options['graceful_timeout']).run()
@@ -0,0 +1,32 @@
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...marking.lifecycle import sweep_events
+
+logger = logging.getLogger('api.management')
+
+
+class Command(BaseCommand):
+    help = "Closes connections to finished events and deletes their marking state"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=None,
+                            help="Keep sweeping every INTERVAL seconds instead of sweeping once")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        if interval is None:
+            closed = sweep_events()
+            self.stdout.write("Closed {} events".format(closed))
+            return
+        while True:
+            try:
+                sweep_events()
+            except Exception:
+                # Events left open are swept on the next iteration
+                logger.exception("Failed to sweep events")
+                close_old_connections()
+            time.sleep(interval)
@@ -0,0 +1,160 @@
+"""
+Notifications of markers about changes of the marking list.
+"""
+
+import asyncio
+import weakref
+
+from .conf import get_setting
+from .misc.client_communication import ClientResponse, ClientMessages
+from .misc.codecs import encode_frames
+
+
+def markers_group(event_id):
+    """
+    Name of the group of consumers marking users at the event.
+    """
+
+    return "event_{}_markers".format(event_id)
+
+
+def mark_me_group(event_id):
+    """
+    Name of the group of consumers waiting to be marked at the event.
+    """
+
+    return "event_{}_mark_me".format(event_id)
+
+
+def pairing_group(event_id):
+    """
+    Name of the group of consumers marking users chosen by the server at the event.
+    They do not follow the marking list, so only the end of the event is sent to the group.
+    """
+
+    return "event_{}_pairing".format(event_id)
+
+
+class MarkingListBatcher(object):
+    """
+    Coalesces marking list changes of events and sends them to event groups
+    as a single 'group.marking.list.delta' message per window to the markers group.
+    One batcher per event loop is kept.
+    """
+
+    __batchers = weakref.WeakKeyDictionary()
+
+    def __init__(self, loop):
+        self.loop = loop
+        # event id -> batch of the event's changes not sent yet
+        self.pending = {}
+
+    @classmethod
+    def get(cls):
+        loop = asyncio.get_event_loop()
+        batcher = MarkingListBatcher.__batchers.get(loop)
+        if batcher is None:
+            batcher = MarkingListBatcher.__batchers[loop] = cls(loop)
+        return batcher
+
+    async def add(self, channel_layer, event_id, joined, left, version):
+        if event_id not in self.pending:
+            self.pending[event_id] = {
+                'channel_layer': channel_layer,
+                # user id -> True if joined, False if left
+                'changes': {},
+                'version': None
+            }
+            self.loop.call_later(get_setting('BATCH_WINDOW'),
+                                 lambda: asyncio.ensure_future(self.flush(event_id), loop=self.loop))
+
+        batch = self.pending[event_id]
+        for user_id in joined:
+            batch['changes'][user_id] = True
+        for user_id in left:
+            batch['changes'][user_id] = False
+        if version is not None and (batch['version'] is None or version > batch['version']):
+            batch['version'] = version
+
+        if len(batch['changes']) >= get_setting('BATCH_MAX_SIZE'):
+            await self.flush(event_id)
+
+    async def flush_all(self):
+        for event_id in list(self.pending):
+            await self.flush(event_id)
+
+    async def flush(self, event_id):
+        if event_id not in self.pending:
+            return
+
+        batch = self.pending.pop(event_id)
+        changes = batch['changes']
+        joined = [user_id for user_id, joined in changes.items() if joined]
+        left = [user_id for user_id, joined in changes.items() if not joined]
+        await batch['channel_layer'].group_send(
+            markers_group(event_id),
+            {
+                'type': 'group.marking.list.delta',
+                "params": {"joined": joined,
+                           "left": left,
+                           "version": batch['version'],
+                           "frames": encode_frames(ClientResponse.response_ok(
+                               message=ClientMessages.MARKING_LIST_DELTA, params={'joined': joined, 'left': left}))},
+                "sender": None
+            }
+        )
+
+
+async def marking_list_changed(channel_layer, event_id, joined=(), left=(), sender=None, version=None):
+    """
+    Notifies markers of the event about users who joined or left the marking list.
+    Users waiting to be marked are not notified.
+    Sends a single message per call or, if BATCH_BROADCASTS is on, coalesces changes into batches.
+    Messages carry the unversioned client frames encoded with every codec.
+    :param channel_layer: channel layer to send messages with
+    :param event_id: uuid of the event
+    :param joined: ids of users added to the marking list
+    :param left: ids of users removed from the marking list
+    :param sender: channel name of the consumer that made the changes
+    :param version: version of the marking list after the changes
+    :return:
+    """
+
+    if get_setting('BATCH_BROADCASTS'):
+        await MarkingListBatcher.get().add(channel_layer, event_id, joined, left, version)
+        return
+
+    if len(joined) + len(left) > 1:
+        # Event hubs split the message into user_joined and user_left frames
+        await channel_layer.group_send(
+            markers_group(event_id),
+            {
+                'type': 'group.marking.list.delta',
+                "params": {"joined": list(joined), "left": list(left), "version": version},
+                "sender": sender
+            }
+        )
+        return
+
+    for user_id in joined:
+        await channel_layer.group_send(
+            markers_group(event_id),
+            {
+                'type': 'group.mark.me',
+                "params": {"user_id": user_id, "version": version,
+                           "frames": encode_frames(ClientResponse.response_ok(message=ClientMessages.USER_JOINED,
+                                                                              params={'user_id': user_id}))},
+                "sender": sender
+            }
+        )
+    for user_id in left:
+        await channel_layer.group_send(
+            markers_group(event_id),
+            {
+                'type': 'group.do.not.mark',
+                "params": {"user_id": user_id, "version": version,
+                           "frames": encode_frames(ClientResponse.response_ok(message=ClientMessages.USER_LEFT,
+                                                                              params={'user_id': user_id}))},
+                "sender": sender
+            }
+        )
@@ -0,0 +1,85 @@
+"""
+Settings of the marking subsystem.
+Defaults can be overridden by the MARKING dictionary in django settings.
+"""
+
+from django.conf import settings
+
+DEFAULTS = {
+    # Dotted path to the storage backend class
+    'STORAGE_BACKEND': 'api.marking.storage.redis_backend.RedisStorage',
+    # Seconds a marker may hold a chosen user before the user returns to the marking list
+    'CLAIM_LEASE_SECONDS': 120,
+    # Coalesce user_joined/user_left notifications into marking_list_delta messages
+    'BATCH_BROADCASTS': False,
+    # Seconds marking list changes of an event are collected before being sent
+    'BATCH_WINDOW': 0.1,
+    # Number of changes that makes a batch to be sent before the window ends
+    'BATCH_MAX_SIZE': 200,
+    # Number of the latest marking list changes kept for resynchronization of reconnecting markers
+    'CHANGELOG_SIZE': 500,
+    # Maximal number of users prepared by prepare_to_mark_batch
+    'MARKING_BATCH_MAX_SIZE': 20,
+    # Seconds between heartbeats of connected users recorded by every process
+    'HEARTBEAT_INTERVAL': 10,
+    # Seconds since the last heartbeat after which a user is removed from the marking list
+    'PRESENCE_TIMEOUT': 60,
+    # Seconds after the end of an event its connections and marking state are kept
+    'EVENT_GRACE_SECONDS': 600,
+    # Addresses (host, port) of the redis nodes marking state of events is spread over,
+    # the redis of the default channel layer if empty. Ids of saved markings depend on the order of the nodes,
+    # so new nodes are appended to the end, see the rebalance_marking_keys command
+    'REDIS_NODES': [],
+    # Maximal number of redis connections per process, per redis node and per event loop
+    'REDIS_MAX_CONNECTIONS': 50,
+    # Seconds to wait for a free redis connection when all of them are in use
+    'REDIS_POOL_TIMEOUT': 5,
+    # Seconds to wait for a redis connection to be established
+    'REDIS_CONNECT_TIMEOUT': 2,
+    # Seconds to wait for a redis reply
+    'REDIS_READ_TIMEOUT': 5,
+    # Seconds a redis connection may stay idle before it is checked or reconnected
+    'REDIS_HEALTH_CHECK_INTERVAL': 30,
+    # Number of retries of an idempotent redis command that failed to reach redis
+    'REDIS_RETRIES': 3,
+    # Seconds before the first retry, doubled for every next one
+    'REDIS_RETRY_BACKOFF': 0.05,
+    # Messages per second a client may send through one connection on average, 0 disables the limit
+    'MESSAGE_RATE': 0,
+    # Messages a client may send through one connection at once
+    'MESSAGE_BURST': 10,
+    # Messages per second a user may send through all his/her connections to the process, 0 disables the limit
+    'USER_MESSAGE_RATE': 0,
+    # Messages a user may send through all his/her connections to the process at once
+    'USER_MESSAGE_BURST': 20,
+    # Maximal number of users connected to an event, users stay counted until their last connection
+    # to the event closes, 0 disables the limit
+    'EVENT_MAX_CONNECTIONS': 0,
+    # Seconds of the average redis round trip above which new connections and messages are rejected,
+    # 0 disables load shedding
+    'REDIS_LATENCY_THRESHOLD': 0,
+    # Seconds clients are asked to wait before retrying connections and messages rejected because of load
+    'LOAD_SHEDDING_RETRY_AFTER': 5,
+    # Maximal number of events kept by the per-process cache of events used by websocket consumers
+    'EVENT_CACHE_SIZE': 1024,
+    # Seconds an event is kept by the cache without being reloaded from the database
+    'EVENT_CACHE_TTL': 60,
+    # Seconds a websocket ticket issued by GetWebsocketTicket stays valid
+    'WEBSOCKET_TICKET_MAX_AGE': 60,
+    # Seconds the user id of a session authenticating websockets is cached in redis
+    'WEBSOCKET_SESSION_CACHE_TTL': 300,
+    # uuids of events whose connections are always traced
+    'TRACE_EVENTS': [],
+    # Share of connections to other events which are traced
+    'TRACE_SAMPLE_RATE': 0,
+}
+
+
+def get_setting(name):
+    """
+    Returns a setting of the marking subsystem.
+    :param name: name of the setting
+    :return: value from settings.MARKING or the default one
+    """
+
+    return getattr(settings, 'MARKING', {}).get(name, DEFAULTS[name])
@@ -1,24 +1,48 @@
+import asyncio
 import random
 from datetime import datetime
 from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
+from .broadcast import marking_list_changed, mark_me_group, pairing_group
+from .conf import get_setting
 from .misc.client_communication import ClientResponse, ClientMessages, ErrorMessages, EncouragingMessages
-from .misc.websocket_decorators import require_group_message_param, require_client_message_param, ignore_own_messages
+from .misc.codecs import negotiate_codec, encode_frames, constant_frame
+from .misc.tracing import tracing_enabled, trace
+from .hub import EventHub
+from .lifecycle import event_expire_at
+from .presence import PresenceHeartbeat
+from .misc.websocket_decorators import require_group_message_param, require_client_message_param
 from .storage import storage
-from ..events.views import get_event_by_uuid
-from ..models import UserProfile
+from ..events.cache import get_cached_event_by_uuid
+from ..misc.ratelimit import TokenBucket, user_rate_limiter
 
 
-def retrieve_event_id(query_string):
+def retrieve_query_param(query_string, name):
     params = parse_qs(query_string)
-    event_id = params.get(b'event_id')
-    if event_id is None or len(event_id) != 1:
+    value = params.get(name.encode('utf-8'))
+    if value is None or len(value) != 1:
         return None
 
-    return event_id[0].decode('utf-8')
+    return value[0].decode('utf-8')
+
+
+def retrieve_event_id(query_string):
+    return retrieve_query_param(query_string, 'event_id')
+
+
+def retrieve_pairing(query_string):
+    return retrieve_query_param(query_string, 'pairing') == '1'
+
+
+def retrieve_since_version(query_string):
+    since_version = retrieve_query_param(query_string, 'since_version')
+    try:
+        return int(since_version)
+    except (TypeError, ValueError):
+        return None
 
 
 def event_is_running(event):
@@ -34,212 +58,498 @@ def event_is_over(event):
     return time_to < now
 
 
-def increase_karma(user, delta: int):
-    profile = UserProfile.objects.filter(user=user).first()
-    profile.karma += delta
-    profile.save()
+async def increase_karma(user, delta: int):
+    await storage.add_karma(user.id, delta)
+
+
+def is_user_id(value):
+    """
+    Checks a user id sent by a client, anything else must not reach the storage.
+    """
+
+    return isinstance(value, int) and not isinstance(value, bool)
+
 
+def retry_after_params(seconds):
+    """
+    :param seconds: time the client should wait before retrying
+    :return: params of an error response
+    """
+
+    return {'retry_after': max(round(seconds, 2), 0.01)}
+
+
+def storage_overloaded(event_id):
+    """
+    Checks if the storage of the event answers slower than REDIS_LATENCY_THRESHOLD.
+    :param event_id: uuid of the event
+    :return: True if new work must be rejected
+    """
+
+    threshold = get_setting('REDIS_LATENCY_THRESHOLD')
+    return bool(threshold) and storage.get_latency(event_id) > threshold
+
+
+class EventConsumer(AsyncJsonWebsocketConsumer):
+    # Users who have asked to be marked are not allowed to connect
+    check_asked_to_mark = True
 
-class EventConsumer(JsonWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.event = None
         self.user = None
+        self.traced = False
+        self.codec = None
+        # Token bucket of the client messages of the connection
+        self.bucket = None
+        # Key of the users connected to the event if the connection is counted against EVENT_MAX_CONNECTIONS
+        self.connections_key = None
 
-    def connect(self):
-        self.accept()
+    async def connect(self):
+        self.codec = negotiate_codec(self.scope.get('subprotocols', []))
+        await self.accept(subprotocol=self.codec.subprotocol)
 
         self.user = self.scope['user']
 
         event_id = retrieve_event_id(self.scope['query_string'])
         if event_id is None:
-            self.send_json(ClientResponse.response_error(ErrorMessages.NO_EVENT), close=True)
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NO_EVENT), close=True)
             return False
 
-        event = get_event_by_uuid(event_id)
+        event = await database_sync_to_async(get_cached_event_by_uuid)(event_id)
         if event is None:
-            self.send_json(ClientResponse.response_error(ErrorMessages.INVALID_EVENT), close=True)
+            await self.send_json(ClientResponse.response_error(ErrorMessages.INVALID_EVENT), close=True)
             return False
+        self.traced = tracing_enabled(event.uuid)
 
-        asked_to_mark_list = [int(o.decode('utf-8')) for o in storage.get_list("asked_to_mark_{}".format(event_id))]
-        if self.user.id in asked_to_mark_list:
-            self.send_json(ClientResponse.response_error(ErrorMessages.NOT_PERMITTED), close=True)
+        if storage_overloaded(event.uuid):
+            await self.send_json(ClientResponse.response_error(
+                ErrorMessages.OVERLOADED, params=retry_after_params(get_setting('LOAD_SHEDDING_RETRY_AFTER'))),
+                close=True)
+            return False
+
+        if self.check_asked_to_mark and await storage.set_contains("asked_to_mark_{}".format(event.uuid),
+                                                                    self.user.id):
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NOT_PERMITTED), close=True)
             return False
 
         if event_is_over(event):
-            self.send_json(ClientResponse.response_error(ErrorMessages.PAST_EVENT), close=True)
+            await self.send_json(ClientResponse.response_error(ErrorMessages.PAST_EVENT), close=True)
             return False
 
+        max_connections = get_setting('EVENT_MAX_CONNECTIONS')
+        if max_connections:
+            # Connections are counted and recorded at once, so a burst of them does not overshoot the limit
+            if not await storage.admit_connection(event.uuid, self.user.id, max_connections,
+                                                  get_setting('PRESENCE_TIMEOUT')):
+                await self.send_json(ClientResponse.response_error(
+                    ErrorMessages.EVENT_FULL, params=retry_after_params(get_setting('LOAD_SHEDDING_RETRY_AFTER'))),
+                    close=True)
+                return False
+            self.connections_key = storage.connections_key(event.uuid)
+            await PresenceHeartbeat.get().join(self.connections_key, self.user.id, recorded=True)
+
         self.event = event
 
         return True
 
+    async def disconnect(self, code):
+        if self.connections_key is not None and PresenceHeartbeat.get().leave(self.connections_key, self.user.id):
+            # The place is freed right away, unlike presence kept until the reaper runs
+            await storage.remove_presence(self.connections_key, self.user.id)
+
+    def limit_message(self):
+        """
+        Takes tokens of the connection and of the user for a client message.
+        :return: 0 if the message may be handled, otherwise seconds the client should wait
+        """
+
+        rate = get_setting('MESSAGE_RATE')
+        if rate:
+            if self.bucket is None:
+                self.bucket = TokenBucket(rate, get_setting('MESSAGE_BURST'))
+            retry_after = self.bucket.take()
+            if retry_after:
+                return retry_after
+
+        rate = get_setting('USER_MESSAGE_RATE')
+        if rate and self.user is not None:
+            return user_rate_limiter.take(self.user.id, rate, get_setting('USER_MESSAGE_BURST'))
+        return 0
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        # Rejected messages are not even decoded
+        retry_after = self.limit_message()
+        if retry_after:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.TOO_MANY_MESSAGES,
+                                                               params=retry_after_params(retry_after)))
+            return
+        if self.event is not None and storage_overloaded(self.event.uuid):
+            await self.send_json(ClientResponse.response_error(
+                ErrorMessages.OVERLOADED, params=retry_after_params(get_setting('LOAD_SHEDDING_RETRY_AFTER'))))
+            return
+
+        content = self.codec.decode(text_data=text_data, bytes_data=bytes_data)
+        if content is None:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NO_MESSAGE))
+            return
+        await self.receive_json(content, **kwargs)
+
+    async def send_json(self, content, close=False):
+        if "params" in content:
+            frame = self.codec.encode(content)
+        else:
+            frame = constant_frame(self.codec, content["result"], content["message"])
+        await self.send(close=close, **frame)
+
+    async def event_over(self, message):
+        """
+        Closes the connection when the event is closed by the sweeper or deleted.
+        """
+
+        await self.send_json(ClientResponse.response_error(ErrorMessages.PAST_EVENT), close=True)
+
+    async def send_frame(self, content, frames=None, close=False):
+        """
+        Sends a response pre-encoded by the sender of a channel message.
+        :param content: response to encode if there is no frame for the codec of the connection
+        :param frames: dict codec name -> frame
+        :param close: close the connection after sending
+        """
+
+        frame = (frames or {}).get(self.codec.name)
+        if frame is None:
+            await self.send_json(content, close=close)
+            return
+        await self.send(close=close, **frame)
+
 
 class MarkingConsumer(EventConsumer):
-    messages = ['prepare_to_mark', 'confirm_marking', 'refuse_to_mark']
+    messages = ['prepare_to_mark', 'prepare_to_mark_batch', 'next_student', 'confirm_marking',
+                'confirm_marking_batch', 'refuse_to_mark']
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.marking_list = set()
-        self.prepared_user_id = None
-
-    def connect(self):
-        if not super().connect():
+        self.hub = None
+        self.prepared_user_ids = []
+        self.versioned = False
+        # Students are chosen by the server, the marking list is not sent
+        self.pairing = False
+        self.present = False
+
+    async def connect(self):
+        if not await super().connect():
             return
 
         if not event_is_running(self.event):
-            self.send_json(ClientResponse.response_error(ErrorMessages.NOT_RUNNING_EVENT), close=True)
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NOT_RUNNING_EVENT), close=True)
             return False
 
-        marking_list = [int(o.decode('utf-8')) for o in storage.get_list("mark_me_{}".format(self.event.uuid))]
-        self.marking_list = set(marking_list)
+        self.pairing = retrieve_pairing(self.scope['query_string'])
+        if self.pairing:
+            # The hub is not joined, the end of the event is received through the pairing group
+            await self.channel_layer.group_add(pairing_group(self.event.uuid), self.channel_name)
+            await self.join_presence()
+            return
 
-        async_to_sync(self.channel_layer.group_add)("event_{}".format(self.event.uuid), self.channel_name)
-        storage.add_to_list("ready_to_mark_{}".format(self.event.uuid), self.user.id)
+        since_version = retrieve_since_version(self.scope['query_string'])
+        self.versioned = since_version is not None
+        version, changes = None, None
+        if self.versioned:
+            version, _, released, changes = await storage.get_marking_state(self.event.uuid, since_version)
+            await self.announce_released(released, version)
+
+        # The hub starts pushing changes right after joining,
+        # so the initial frame must be taken from the hub without awaiting anything in between
+        self.hub = await EventHub.join(self)
+        if changes is not None and version == self.hub.version:
+            joined, left = changes
+            response = ClientResponse.response_ok(message=ClientMessages.MARKING_LIST_DELTA,
+                                                  params={'joined': joined, 'left': left, 'version': version})
+        else:
+            response = ClientResponse.response_ok(message=ClientMessages.MARKING_LIST,
+                                                  params=self.versioned_params(
+                                                      {"marking_list": list(self.hub.marking_list)},
+                                                      self.hub.version))
+        await self.send_json(response)
 
-        self.send_json(ClientResponse.response_ok(message=ClientMessages.MARKING_LIST,
-                                                  params={"marking_list": marking_list}))
+        await self.join_presence()
 
-    def disconnect(self, close_code):
-        if self.event is not None:
-            storage.remove_from_list("ready_to_mark_{}".format(self.event.uuid), self.user.id)
-            async_to_sync(self.channel_layer.group_discard)("event_{}".format(self.event.uuid), self.channel_name)
+    async def join_presence(self):
+        await PresenceHeartbeat.get().join(storage.markers_presence_key(self.event.uuid), self.user.id)
+        self.present = True
 
-    def receive_json(self, content, **kwargs):
-        print("Message from client", content)
+    async def disconnect(self, close_code):
+        await super().disconnect(close_code)
+        if self.event is not None:
+            # Independent requests are sent concurrently, so they cost one round trip
+            requests = []
+            if self.prepared_user_ids:
+                requests.append(self.release_prepared_users())
+            if self.present:
+                PresenceHeartbeat.get().leave(storage.markers_presence_key(self.event.uuid), self.user.id)
+                requests.append(storage.remove_presence(storage.markers_presence_key(self.event.uuid), self.user.id))
+            if self.hub is not None:
+                requests.append(EventHub.leave(self))
+            if self.pairing:
+                requests.append(self.channel_layer.group_discard(pairing_group(self.event.uuid), self.channel_name))
+            await asyncio.gather(*requests)
+
+    async def receive_json(self, content, **kwargs):
+        if self.traced:
+            trace("client_message", self.event.uuid, user_id=self.user.id, content=content)
         if content["message"] in self.messages:
-            getattr(self, content["message"])(content.get("params"))
+            await getattr(self, content["message"])(content.get("params"))
         else:
-            self.send_json(ClientResponse.response_error(ErrorMessages.NO_MESSAGE))
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NO_MESSAGE))
 
     @require_client_message_param(['user_id'])
-    def prepare_to_mark(self, params):
-        global_list = storage.get_list("mark_me_{}".format(self.event.uuid))
-        print("prepare to mark {}  user id {} ### my marking list: {} ### global: {} ### prepared user id: {}"
-              .format(self.user.id, params['user_id'], self.marking_list, global_list, self.prepared_user_id))
-
-        user_id = params['user_id']
-        if self.prepared_user_id is not None:
-            self.send_json(ClientResponse.response_error(ErrorMessages.ALREADY_HAVE_USER))
+    async def prepare_to_mark(self, params):
+        if self.traced:
+            await self.trace_marking_state("prepare_to_mark", chosen_user_id=params['user_id'])
+
+        if not is_user_id(params['user_id']):
+            # No such user is waiting to be marked
+            await self.send_json(ClientResponse.response_error(ErrorMessages.USER_ALREADY_CHOSEN))
             return
+        if await self.prepare_users([params['user_id']]):
+            await self.send_json(ClientResponse.response_ok(message=ClientMessages.PREPARED))
+
+    @require_client_message_param(['user_ids'])
+    async def prepare_to_mark_batch(self, params):
+        """
+        Prepares to mark several users at once. Either all of them are prepared or none.
+        """
+
+        if self.traced:
+            await self.trace_marking_state("prepare_to_mark_batch", chosen_user_ids=params['user_ids'])
+
+        user_ids = params['user_ids']
+        if not isinstance(user_ids, list) or not user_ids or len(user_ids) > get_setting('MARKING_BATCH_MAX_SIZE') \
+                or not all(is_user_id(user_id) for user_id in user_ids):
+            await self.send_json(ClientResponse.response_error(ErrorMessages.INVALID_BATCH))
+            return
+
+        user_ids = list(dict.fromkeys(user_ids))
+        if await self.prepare_users(user_ids):
+            await self.send_json(ClientResponse.response_ok(message=ClientMessages.PREPARED,
+                                                            params={'user_ids': user_ids}))
+
+    async def prepare_users(self, user_ids):
+        """
+        Claims users for the marker and notifies other markers.
+        Sends an error to the client if the users cannot be claimed.
+        :param user_ids: ids of the users to prepare
+        :return: True if prepared
+        """
+
+        if self.prepared_user_ids:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.ALREADY_HAVE_USER))
+            return False
 
-        if not storage.remove_from_list("mark_me_{}".format(self.event.uuid), user_id):
-            self.send_json(ClientResponse.response_error(ErrorMessages.USER_ALREADY_CHOSEN))
+        claimed, released, version = await storage.claim_users(self.event.uuid, user_ids, self.user.id,
+                                                                  expire_at=event_expire_at(self.event))
+        await self.announce_released(released, version)
+        if not claimed:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.USER_ALREADY_CHOSEN))
+            return False
+
+        self.prepared_user_ids = user_ids
+
+        await marking_list_changed(self.channel_layer, self.event.uuid, left=user_ids, sender=self.channel_name,
+                                   version=version)
+        return True
+
+    async def next_student(self, params):
+        """
+        Prepares to mark the student waiting longest, so markers do not compete for the same students.
+        """
+
+        if self.traced:
+            await self.trace_marking_state("next_student")
+
+        if self.prepared_user_ids:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.ALREADY_HAVE_USER))
             return
 
-        self.marking_list.remove(user_id)
-        self.prepared_user_id = user_id
-
-        async_to_sync(self.channel_layer.group_send)(
-            "event_{}".format(self.event.uuid),
-            {
-                'type': 'group.do.not.mark',
-                "params": {"user_id": user_id},
-                "sender": self.channel_name
-            }
-        )
-
-        self.send_json(ClientResponse.response_ok(message=ClientMessages.PREPARED))
-
-    def confirm_marking(self, params):
-        global_list = storage.get_list("mark_me_{}".format(self.event.uuid))
-        print("confirm marking {} ### my marking list: {} ### global: {} ### prepared user id: {}"
-              .format(self.user.id, self.marking_list, global_list, self.prepared_user_id))
-
-        async_to_sync(self.channel_layer.group_send)(
-            "event_{}".format(self.event.uuid),
-            {
-                'type': 'group.marked',
-                "params": {"mark_me_user_id": self.prepared_user_id,
-                           "ready_to_mark_user_id": self.scope['user'].id},
-                "sender": self.channel_name
-            }
-        )
-
-        self.prepared_user_id = None
-        self.send_json(ClientResponse.response_ok(message=ClientMessages.MARKED,
-                                                  params={"display_msg": random.choice(EncouragingMessages.general)}))
-
-        increase_karma(self.user, EncouragingMessages.general_delta)
-
-    def refuse_to_mark(self, params):
-        if self.prepared_user_id is None:
-            self.send_json(ClientResponse.response_error(ErrorMessages.NOT_PERMITTED))
+        user_id, released, version = await storage.claim_next_user(self.event.uuid, self.user.id,
+                                                                      expire_at=event_expire_at(self.event))
+        await self.announce_released(released, version)
+        if user_id is None:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NO_STUDENTS))
             return
 
-        global_list = storage.get_list("mark_me_{}".format(self.event.uuid))
-        print(
-            "refuse to mark {} ### my marking list: {} ### global: {} ### prepared user id: {}"
-                .format(self.user.id, self.marking_list, global_list, self.prepared_user_id))
-
-        storage.add_to_list("mark_me_{}".format(self.event.uuid), self.prepared_user_id)
-        self.marking_list.add(self.prepared_user_id)
-
-        async_to_sync(self.channel_layer.group_send)(
-            "event_{}".format(self.event.uuid),
-            {
-                'type': 'group.mark.me',
-                "params": {"user_id": self.prepared_user_id},
-                "sender": self.channel_name
-            }
-        )
-        self.prepared_user_id = None
-        self.send_json(ClientResponse.response_ok(message=ClientMessages.REFUSED))
-
-    def group_marked(self, params):
-        pass
-
-    @ignore_own_messages
-    @require_group_message_param(["user_id"])
-    def group_mark_me(self, params):
-        self.marking_list.add(params['user_id'])
-        self.send_json(ClientResponse.response_ok(message=ClientMessages.USER_JOINED,
-                                                  params={'user_id': params['user_id']}))
-
-    @ignore_own_messages
-    @require_group_message_param(["user_id"])
-    def group_do_not_mark(self, params):
-        try:
-            self.marking_list.remove(params['user_id'])
-        except KeyError:
-            print("Ready to mark user id {rtmuid}, user id to remove {uid}, marking list {ml}"
-                  .format(rtmuid=self.user.id, uid=params['user_id'], ml=self.marking_list))
+        self.prepared_user_ids = [user_id]
+
+        await marking_list_changed(self.channel_layer, self.event.uuid, left=[user_id], sender=self.channel_name,
+                                   version=version)
+
+        await self.send_json(ClientResponse.response_ok(message=ClientMessages.PREPARED,
+                                                        params={'user_id': user_id}))
+
+    async def confirm_marking(self, params):
+        if self.traced:
+            await self.trace_marking_state("confirm_marking")
+
+        confirmed = await self.confirm_prepared_users()
+        if confirmed:
+            await self.send_json(ClientResponse.response_ok(
+                message=ClientMessages.MARKED, params={"display_msg": random.choice(EncouragingMessages.general)}))
+
+    async def confirm_marking_batch(self, params):
+        """
+        Confirms marking of all the prepared users.
+        Users whose claims have expired are not marked.
+        """
+
+        if self.traced:
+            await self.trace_marking_state("confirm_marking_batch")
+
+        confirmed = await self.confirm_prepared_users()
+        if confirmed:
+            await self.send_json(ClientResponse.response_ok(
+                message=ClientMessages.MARKED, params={"display_msg": random.choice(EncouragingMessages.general),
+                                                       "user_ids": confirmed}))
+
+    async def confirm_prepared_users(self):
+        """
+        Completes the claims of the prepared users, notifies the marked users and adds karma to the marker.
+        Sends an error to the client if nobody was marked.
+        :return: list of marked user ids
+        """
+
+        if not self.prepared_user_ids:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NOT_PERMITTED))
+            return []
+
+        prepared_user_ids = self.prepared_user_ids
+        self.prepared_user_ids = []
+        confirmed, released, version = await storage.confirm_claims(self.event.uuid, prepared_user_ids,
+                                                                    self.user.id)
+        await self.announce_released(released, version)
+        if not confirmed:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.CLAIM_EXPIRED))
+            return []
+
+        frames = encode_frames(ClientResponse.response_ok(message=ClientMessages.WAS_MARKED,
+                                                          params={'user_id': self.user.id}))
+        for user_id, mark_me_channel in confirmed.items():
+            if mark_me_channel is None:
+                continue
+            await self.channel_layer.send(
+                mark_me_channel,
+                {
+                    'type': 'user.marked',
+                    "params": {"mark_me_user_id": user_id,
+                               "ready_to_mark_user_id": self.user.id,
+                               "frames": frames},
+                    "sender": self.channel_name
+                }
+            )
+
+        await increase_karma(self.user, EncouragingMessages.general_delta * len(confirmed))
+        return list(confirmed)
+
+    async def refuse_to_mark(self, params):
+        if not self.prepared_user_ids:
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NOT_PERMITTED))
             return
-        self.send_json(ClientResponse.response_ok(message=ClientMessages.USER_LEFT,
-                                                  params={'user_id': params['user_id']}))
 
+        if self.traced:
+            await self.trace_marking_state("refuse_to_mark")
+
+        await self.release_prepared_users()
+        await self.send_json(ClientResponse.response_ok(message=ClientMessages.REFUSED))
+
+    async def trace_marking_state(self, action, **fields):
+        """
+        Traces an action along with the marking list of the process and the global one.
+        Reads the global list, so must be called only if the connection is traced.
+        :param action: name of the action
+        :param fields: additional details
+        """
+
+        marking_list = list(self.hub.marking_list) if self.hub is not None else None
+        trace(action, self.event.uuid, user_id=self.user.id, marking_list=marking_list,
+              global_list=await storage.get_set("mark_me_{}".format(self.event.uuid)),
+              prepared_user_ids=self.prepared_user_ids, **fields)
+
+    async def release_prepared_users(self):
+        """
+        Returns the prepared users to the marking list and notifies other markers.
+        """
+
+        prepared_user_ids = self.prepared_user_ids
+        self.prepared_user_ids = []
+        refused, released, version = await storage.release_claims(self.event.uuid, prepared_user_ids,
+                                                                  self.user.id)
+        await self.announce_released(released, version)
+        # Users whose claims have already expired were announced as released
+        if refused:
+            await marking_list_changed(self.channel_layer, self.event.uuid, joined=refused,
+                                       sender=self.channel_name, version=version)
+
+    async def announce_released(self, released, version):
+        """
+        Notifies all the markers about users returned to the marking list after their claims expired.
+        :param released: list of released user ids
+        :param version: version of the marking list after the release
+        """
+
+        if released:
+            await marking_list_changed(self.channel_layer, self.event.uuid, joined=released, version=version)
+
+    def versioned_params(self, params, version):
+        """
+        Adds the version of the marking list to response params if the client tracks versions.
+        :param params: response params
+        :param version: version of the marking list
+        :return: params to send
+        """
+
+        if self.versioned and version is not None:
+            params['version'] = version
+        return params
 
-class MarkMeConsumer(EventConsumer):
-    def connect(self):
-        if not super().connect():
-            return
 
-        async_to_sync(self.channel_layer.group_add)("event_{}".format(self.event.uuid), self.channel_name)
-        async_to_sync(self.channel_layer.group_send)(
-            "event_{}".format(self.event.uuid),
-            {
-                'type': 'group.mark.me',
-                "params": {"user_id": self.user.id},
-                "sender": self.channel_name
-            }
-        )
+class MarkMeConsumer(EventConsumer):
+    # Checked by the storage along with joining the marking list, saving a round trip
+    check_asked_to_mark = False
 
-        storage.add_to_list("mark_me_{}".format(self.event.uuid), self.user.id)
-        storage.add_to_list("asked_to_mark_{}".format(self.event.uuid), self.user.id)
+    async def connect(self):
+        if not await super().connect():
+            return
 
-    def group_mark_me(self, params):
-        pass
+        event_id = self.event.uuid
+        # Users are marked through their channel names, so the group is joined concurrently
+        _, (added, released, version) = await asyncio.gather(
+            self.channel_layer.group_add(mark_me_group(event_id), self.channel_name),
+            storage.add_user_to_mark(event_id, self.user.id, self.channel_name, once=True,
+                                     expire_at=event_expire_at(self.event)))
+        if added is None:
+            # The user has asked to be marked before
+            self.event = None
+            await self.channel_layer.group_discard(mark_me_group(event_id), self.channel_name)
+            await self.send_json(ClientResponse.response_error(ErrorMessages.NOT_PERMITTED), close=True)
+        else:
+            await PresenceHeartbeat.get().join(storage.mark_me_presence_key(event_id), self.user.id, recorded=True)
 
-    def group_do_not_mark(self, params):
-        pass
+        joined = released + [self.user.id] if added else released
+        if joined:
+            await marking_list_changed(self.channel_layer, event_id, joined=joined, sender=self.channel_name,
+                                       version=version)
 
-    @ignore_own_messages
     @require_group_message_param(["ready_to_mark_user_id", "mark_me_user_id"])
-    def group_marked(self, params):
-        self.send_json(ClientResponse.response_ok(message=ClientMessages.WAS_MARKED,
-                                                  params={'user_id': params['ready_to_mark_user_id']}),
-                       close=True)
+    async def user_marked(self, params):
+        await self.send_frame(ClientResponse.response_ok(message=ClientMessages.WAS_MARKED,
+                                                         params={'user_id': params['ready_to_mark_user_id']}),
+                              params.get('frames'), close=True)
 
-    def disconnect(self, code):
+    async def disconnect(self, code):
+        await super().disconnect(code)
         if self.event is not None:
-            async_to_sync(self.channel_layer.group_discard)("event_{}".format(self.event.uuid), self.channel_name)
+            # The user stays in the marking list until the last heartbeat becomes stale
+            PresenceHeartbeat.get().leave(storage.mark_me_presence_key(self.event.uuid), self.user.id)
+            await asyncio.gather(storage.forget_mark_me_channel(self.event.uuid, self.user.id, self.channel_name),
+                                 self.channel_layer.group_discard(mark_me_group(self.event.uuid),
+                                                                  self.channel_name))
@@ -0,0 +1,245 @@
+"""
+Per-process hubs of events.
+A hub subscribes to the markers group of an event once per process,
+keeps the only copy of the marking list in the process and pushes
+frames encoded by senders to the local marking consumers.
+"""
+
+import asyncio
+import logging
+from array import array
+from bisect import bisect_left
+
+from .broadcast import marking_list_changed, markers_group
+from .conf import get_setting
+from .misc.client_communication import ClientResponse, ClientMessages
+from .storage import storage
+
+logger = logging.getLogger('api.marking')
+
+
+class UserIdSet(object):
+    """
+    Set of user ids stored as a sorted array of 64-bit integers.
+    """
+
+    def __init__(self, user_ids=()):
+        self.ids = array('q', sorted(set(user_ids)))
+
+    def __contains__(self, user_id):
+        i = bisect_left(self.ids, user_id)
+        return i < len(self.ids) and self.ids[i] == user_id
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, user_id):
+        """
+        :return: True if the user id was not in the set
+        """
+
+        i = bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return False
+        self.ids.insert(i, user_id)
+        return True
+
+    def discard(self, user_id):
+        """
+        :return: True if the user id was in the set
+        """
+
+        i = bisect_left(self.ids, user_id)
+        if i == len(self.ids) or self.ids[i] != user_id:
+            return False
+        del self.ids[i]
+        return True
+
+    def nbytes(self):
+        return self.ids.buffer_info()[1] * self.ids.itemsize
+
+
+class EventHub(object):
+    """
+    Receives marking list changes of an event on behalf of all the marking consumers
+    of the process and pushes the resulting frames to them.
+    Changes made by a consumer are not pushed back to it, except for batched changes
+    whose senders are unknown.
+    """
+
+    # event id -> hub
+    __hubs = {}
+
+    def __init__(self, channel_layer, event_id):
+        self.loop = asyncio.get_event_loop()
+        self.channel_layer = channel_layer
+        self.event_id = event_id
+        self.channel_name = None
+        self.consumers = set()
+        self.marking_list = UserIdSet()
+        # Version of the snapshot the hub started with and the highest version seen since
+        self.snapshot_version = None
+        self.version = None
+        self.started = self.loop.create_future()
+        self.task = None
+        self.messages_received = 0
+        self.frames_sent = 0
+
+    @classmethod
+    async def join(cls, consumer):
+        """
+        Registers a marking consumer in the hub of its event, starting the hub if needed.
+        :param consumer: MarkingConsumer
+        :return: EventHub
+        """
+
+        event_id = str(consumer.event.uuid)
+        hub = cls.__hubs.get(event_id)
+        if hub is None or hub.loop is not asyncio.get_event_loop():
+            hub = cls.__hubs[event_id] = cls(consumer.channel_layer, event_id)
+            try:
+                await hub.start()
+            except Exception as e:
+                if cls.__hubs.get(event_id) is hub:
+                    del cls.__hubs[event_id]
+                hub.started.set_exception(e)
+                # Joins waiting for the hub get the error too, if there are none it must not be reported as lost
+                hub.started.exception()
+                raise
+            hub.started.set_result(True)
+        else:
+            await asyncio.shield(hub.started)
+
+        hub.consumers.add(consumer)
+        return hub
+
+    @classmethod
+    async def leave(cls, consumer):
+        """
+        Unregisters a marking consumer, stopping the hub when it has no consumers left.
+        :param consumer: MarkingConsumer
+        """
+
+        hub = consumer.hub
+        hub.consumers.discard(consumer)
+        if hub.consumers:
+            return
+
+        if cls.__hubs.get(hub.event_id) is hub:
+            del cls.__hubs[hub.event_id]
+        await hub.stop()
+
+    @classmethod
+    def stats(cls):
+        """
+        Counters of all the hubs of the process.
+        :return: list of dicts
+        """
+
+        return [hub.hub_stats() for hub in list(cls.__hubs.values())]
+
+    async def start(self):
+        self.channel_name = await self.channel_layer.new_channel()
+        await self.channel_layer.group_add(markers_group(self.event_id), self.channel_name)
+
+        version, marking_list, released, _ = await storage.get_marking_state(self.event_id)
+        self.marking_list = UserIdSet(marking_list)
+        self.snapshot_version = self.version = version
+        if released:
+            await marking_list_changed(self.channel_layer, self.event_id, joined=released, version=version)
+
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        await self.channel_layer.group_discard(markers_group(self.event_id), self.channel_name)
+
+    async def run(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel_name)
+            self.messages_received += 1
+            try:
+                await self.dispatch(message)
+            except Exception:
+                logger.exception("Event hub %s failed to dispatch %s", self.event_id, message)
+
+    async def dispatch(self, message):
+        if message['type'] == 'event.over':
+            for consumer in list(self.consumers):
+                await consumer.event_over(message)
+            return
+
+        params = message.get('params') or {}
+        version = params.get('version')
+        if version is not None:
+            if version <= self.snapshot_version:
+                # Already included in the snapshot
+                return
+            self.version = max(self.version, version)
+
+        sender = message.get('sender')
+        if message['type'] == 'group.mark.me':
+            if self.marking_list.add(params['user_id']):
+                await self.push(ClientMessages.USER_JOINED, {'user_id': params['user_id']}, version,
+                                params.get('frames'), exclude=sender)
+
+        elif message['type'] == 'group.do.not.mark':
+            if self.marking_list.discard(params['user_id']):
+                await self.push(ClientMessages.USER_LEFT, {'user_id': params['user_id']}, version,
+                                params.get('frames'), exclude=sender)
+
+        elif message['type'] == 'group.marking.list.delta':
+            joined = [user_id for user_id in params['joined'] if self.marking_list.add(user_id)]
+            left = [user_id for user_id in params['left'] if self.marking_list.discard(user_id)]
+            # Frames of the sender are valid only if none of the changes were filtered out
+            frames = params.get('frames') if joined == params['joined'] and left == params['left'] else None
+            if not get_setting('BATCH_BROADCASTS'):
+                # Clients expect separate notifications unless batching is on
+                for user_id in joined:
+                    await self.push(ClientMessages.USER_JOINED, {'user_id': user_id}, version, exclude=sender)
+                for user_id in left:
+                    await self.push(ClientMessages.USER_LEFT, {'user_id': user_id}, version, exclude=sender)
+            elif joined or left:
+                await self.push(ClientMessages.MARKING_LIST_DELTA, {'joined': joined, 'left': left}, version,
+                                frames, exclude=sender)
+
+    async def push(self, message, params, version, sender_frames=None, exclude=None):
+        """
+        Sends a frame to the local consumers.
+        Unversioned frames encoded by the sender are forwarded as is,
+        other frames are encoded once per codec and per presence of the version.
+        :param message: message from ClientMessages
+        :param params: params of the message
+        :param version: version of the marking list
+        :param sender_frames: dict codec name -> unversioned frame encoded by the sender
+        :param exclude: channel name of a consumer to skip
+        """
+
+        frames = {}
+        for consumer in list(self.consumers):
+            if consumer.channel_name == exclude:
+                continue
+
+            versioned = consumer.versioned and version is not None
+            key = (consumer.codec, versioned)
+            frame = frames.get(key)
+            if frame is None and not versioned and sender_frames:
+                frame = frames[key] = sender_frames.get(consumer.codec.name)
+            if frame is None:
+                frame = frames[key] = consumer.codec.encode(
+                    ClientResponse.response_ok(message=message, params=consumer.versioned_params(dict(params),
+                                                                                              version)))
+            await consumer.send(**frame)
+            self.frames_sent += 1
+
+    def hub_stats(self):
+        return {"event_id": self.event_id,
+                "consumers": len(self.consumers),
+                "marking_list_size": len(self.marking_list),
+                "marking_list_bytes": self.marking_list.nbytes(),
+                "messages_received": self.messages_received,
+                "frames_sent": self.frames_sent}
@@ -0,0 +1,96 @@
+"""
+Lifecycle of marking state of events.
+Marking state of an event expires EVENT_GRACE_SECONDS after the event ends.
+The sweeper closes connections to finished events and purges their state earlier than redis would.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from .broadcast import markers_group, mark_me_group, pairing_group
+from .conf import get_setting
+from .storage import storage
+from ..models import Event
+
+
+def event_expire_at(event):
+    """
+    :param event: Event
+    :return: unix timestamp when marking state of the event expires
+    """
+
+    return event.time_to.timestamp() + get_setting('EVENT_GRACE_SECONDS')
+
+
+def close_event(event_id, channel_layer=None):
+    """
+    Closes all the connections to the event and deletes its marking state.
+    The connections close after the state is deleted, writes made while they close
+    (releasing claims, forgetting channels and heartbeats) do not recreate it.
+    :param event_id: uuid of the event
+    :param channel_layer: channel layer to notify consumers with, the default one if None
+    :return: number of deleted keys
+    """
+
+    if channel_layer is None:
+        channel_layer = get_channel_layer()
+    for group in (markers_group(event_id), mark_me_group(event_id), pairing_group(event_id)):
+        async_to_sync(channel_layer.group_send)(group, {'type': 'event.over'})
+    return storage.purge_event_keys([event_id])
+
+
+def sweep_events(channel_layer=None):
+    """
+    Sets expiration of marking state of current events and closes events
+    that ended between one and two EVENT_GRACE_SECONDS ago.
+    Sweeping more often than every EVENT_GRACE_SECONDS closes every finished event.
+    :param channel_layer: channel layer to notify consumers with, the default one if None
+    :return: number of closed events
+    """
+
+    now = datetime.utcnow()
+    grace = timedelta(seconds=get_setting('EVENT_GRACE_SECONDS'))
+
+    for event in Event.objects.filter(time_from__lte=now + grace, time_to__gte=now - grace):
+        storage.expire_event_keys(event.uuid, event_expire_at(event))
+
+    # Older events are left to key expiration and the reclaim_marking_keys command
+    finished = Event.objects.filter(time_to__lt=now - grace, time_to__gte=now - 2 * grace)
+    closed = 0
+    for event_id in finished.values_list('uuid', flat=True):
+        if close_event(event_id, channel_layer):
+            closed += 1
+    return closed
+
+
+def reclaim_keys(chunk_size=500, pause=0.1):
+    """
+    Deletes marking state of finished and deleted events.
+    Redis is scanned incrementally and keys are deleted in chunks with pauses between them,
+    so other clients are not blocked.
+    :param chunk_size: number of events checked and purged at once
+    :param pause: seconds to sleep between chunks
+    :return: number of deleted keys
+    """
+
+    cutoff = datetime.utcnow() - timedelta(seconds=get_setting('EVENT_GRACE_SECONDS'))
+    deleted = 0
+    chunk = set()
+    for event_id in storage.scan_event_ids(count=chunk_size):
+        chunk.add(event_id)
+        if len(chunk) >= chunk_size:
+            deleted += _reclaim_chunk(chunk, cutoff)
+            chunk = set()
+            time.sleep(pause)
+    if chunk:
+        deleted += _reclaim_chunk(chunk, cutoff)
+    return deleted
+
+
+def _reclaim_chunk(event_ids, cutoff):
+    alive = {str(event_id) for event_id in
+             Event.objects.filter(uuid__in=event_ids, time_to__gte=cutoff).values_list('uuid', flat=True)}
+    return storage.purge_event_keys(event_ids - alive)
@@ -0,0 +1,332 @@
+"""
+Load test of the marking websockets.
+Virtual students and markers speak the real protocol to a running server:
+students wait to be marked, markers pick students from the marking list
+(or ask for the next one in pairing mode), then confirm or refuse.
+"""
+
+import asyncio
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+import websockets
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+
+from .misc.client_communication import ClientMessages
+from .storage import storage
+from ..models import Event
+
+# Messages answering client requests, other messages are notifications
+RESPONSES = {ClientMessages.PREPARED, ClientMessages.MARKED, ClientMessages.REFUSED}
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class LoadTestStats(object):
+    def __init__(self):
+        self.connect_latencies = []
+        # Seconds from connecting a student until markers see him/her in the marking list
+        self.join_latencies = []
+        # Seconds from connecting a marker until the marking list is received
+        self.ready_latencies = []
+        # message -> list of seconds until the response
+        self.latencies = {}
+        self.frames = 0
+        self.markings = 0
+        # Students who received was_marked
+        self.marked = 0
+        self.conflicts = 0
+        # Messages rejected by rate limits or load shedding and sent again
+        self.throttled = 0
+        self.errors = 0
+
+    def add_latency(self, message, seconds):
+        self.latencies.setdefault(message, []).append(seconds)
+
+    def report(self, elapsed, redis_ops):
+        """
+        :param elapsed: seconds the test took
+        :param redis_ops: number of commands redis processed during the test
+        :return: dict of results
+        """
+
+        def summary(values):
+            return {"count": len(values),
+                    "p50_ms": _ms(percentile(values, 0.5)),
+                    "p95_ms": _ms(percentile(values, 0.95)),
+                    "p99_ms": _ms(percentile(values, 0.99)),
+                    "max_ms": _ms(max(values) if values else None)}
+
+        return {"elapsed_s": round(elapsed, 3),
+                "connect": summary(self.connect_latencies),
+                "join": summary(self.join_latencies),
+                "ready": summary(self.ready_latencies),
+                "messages": {message: summary(values) for message, values in self.latencies.items()},
+                "frames": self.frames,
+                "frames_per_second": round(self.frames / elapsed, 1) if elapsed else None,
+                "markings": self.markings,
+                "marked_students": self.marked,
+                "conflicts": self.conflicts,
+                "throttled": self.throttled,
+                "errors": self.errors,
+                "redis_ops": redis_ops,
+                "redis_ops_per_marking": round(redis_ops / self.markings, 1) if self.markings else None}
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def create_session(user):
+    """
+    Logs a user in without a password.
+    :param user: User
+    :return: session key
+    """
+
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return session.session_key
+
+
+def create_users(prefix, count):
+    users = []
+    for i in range(count):
+        user, _ = User.objects.get_or_create(username="{}_{}".format(prefix, i))
+        users.append(user)
+    return users
+
+
+def prepare_event(students, markers):
+    """
+    Creates a running event with the virtual users.
+    :return: Event
+    """
+
+    creator = markers[0]
+    event = Event(name="load test {}".format(int(time.time())), creator=creator,
+                  time_from=datetime.utcnow() - timedelta(minutes=1),
+                  time_to=datetime.utcnow() + timedelta(hours=1))
+    event.save()
+    event.users.set(students + markers)
+    return event
+
+
+class LoadTest(object):
+    def __init__(self, url, event, students, markers, refuse_rate=0.0, pairing=False, duration=60.0,
+                 concurrency=100, connect_only=False):
+        self.url = url.rstrip('/')
+        self.event = event
+        # session key per user id
+        self.students = {user.id: create_session(user) for user in students}
+        self.markers = {user.id: create_session(user) for user in markers}
+        self.refuse_rate = refuse_rate
+        self.pairing = pairing
+        self.duration = duration
+        # Students only connect and leave once markers see them, markers do not mark
+        self.connect_only = connect_only
+        # id of a student not seen by markers yet -> event set when markers see him/her
+        self.joining = {}
+        # id of a student -> time markers saw him/her
+        self.seen_at = {}
+        # Limits simultaneous handshakes
+        self.connecting = asyncio.Semaphore(concurrency)
+        self.stats = LoadTestStats()
+        # Students who have not tried to connect yet
+        self.students_pending = len(self.students)
+        self.deadline = None
+
+    async def connect(self, path, session_key, query=""):
+        """
+        :return: tuple (socket, time the handshake started)
+        """
+
+        headers = [('Cookie', '{}={}'.format(settings.SESSION_COOKIE_NAME, session_key))]
+        uri = "{}/ws/{}?event_id={}{}".format(self.url, path, self.event.uuid, query)
+        async with self.connecting:
+            started = time.monotonic()
+            socket = await websockets.connect(uri, extra_headers=headers, max_queue=None)
+            self.stats.connect_latencies.append(time.monotonic() - started)
+        return socket, started
+
+    async def receive(self, socket, timeout=None):
+        frame = json.loads(await asyncio.wait_for(socket.recv(), timeout))
+        self.stats.frames += 1
+        return frame
+
+    async def student(self, user_id, session_key):
+        seen = self.joining[user_id] = asyncio.Event()
+        try:
+            socket, started = await self.connect("mark_me", session_key)
+        finally:
+            self.students_pending -= 1
+        try:
+            if self.connect_only:
+                await asyncio.wait_for(seen.wait(), self.deadline - time.monotonic())
+                return
+            while time.monotonic() < self.deadline:
+                try:
+                    frame = await self.receive(socket, timeout=self.deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    return
+                if frame.get('message') == ClientMessages.WAS_MARKED:
+                    self.stats.marked += 1
+                    return
+        except (asyncio.TimeoutError, websockets.ConnectionClosed):
+            pass
+        finally:
+            if user_id in self.seen_at:
+                self.stats.join_latencies.append(self.seen_at[user_id] - started)
+            await socket.close()
+
+    async def observer(self, session_key, ready):
+        """
+        Watches the marking list and records when connecting students appear in it.
+        :param session_key: session of a marker
+        :param ready: event set once the initial marking list is received
+        """
+
+        socket = None
+        marking_list = set()
+        try:
+            socket, _ = await self.connect("marking", session_key)
+            await self.apply_frame(await self.receive(socket, timeout=10), marking_list)
+            ready.set()
+            while time.monotonic() < self.deadline and (self.students_pending or self.joining):
+                try:
+                    await self.apply_frame(await self.receive(socket, timeout=self.deadline - time.monotonic()),
+                                           marking_list)
+                except asyncio.TimeoutError:
+                    return
+                now = time.monotonic()
+                for user_id in marking_list.intersection(self.joining):
+                    self.seen_at[user_id] = now
+                    self.joining.pop(user_id).set()
+        except (asyncio.TimeoutError, websockets.ConnectionClosed):
+            pass
+        finally:
+            ready.set()
+            if socket is not None:
+                await socket.close()
+
+    async def marker(self, session_key):
+        socket, started = await self.connect("marking", session_key, query="&pairing=1" if self.pairing else "")
+        marking_list = set()
+        try:
+            if not self.pairing:
+                await self.apply_frame(await self.receive(socket, timeout=10), marking_list)
+                self.stats.ready_latencies.append(time.monotonic() - started)
+            while time.monotonic() < self.deadline and self.stats.markings < len(self.students):
+                if self.pairing:
+                    response = await self.request(socket, marking_list, {"message": "next_student"})
+                else:
+                    if not marking_list:
+                        try:
+                            await self.apply_frame(await self.receive(socket, timeout=1), marking_list)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    user_id = random.choice(list(marking_list))
+                    response = await self.request(socket, marking_list,
+                                                  {"message": "prepare_to_mark", "params": {"user_id": user_id}})
+                if response.get('result') != 'ok':
+                    self.stats.conflicts += 1
+                    if self.pairing:
+                        await asyncio.sleep(0.1)
+                    continue
+
+                if random.random() < self.refuse_rate:
+                    await self.request(socket, marking_list, {"message": "refuse_to_mark"})
+                    continue
+                response = await self.request(socket, marking_list, {"message": "confirm_marking"})
+                if response.get('result') == 'ok':
+                    self.stats.markings += 1
+        except (asyncio.TimeoutError, websockets.ConnectionClosed):
+            pass
+        finally:
+            await socket.close()
+
+    async def request(self, socket, marking_list, content):
+        """
+        Sends a message and waits for the response, applying notifications received meanwhile.
+        A message rejected with a retry_after hint is sent again after the hinted time.
+        :return: response
+        """
+
+        while True:
+            started = time.monotonic()
+            await socket.send(json.dumps(content))
+            frame = await self.receive(socket, timeout=10)
+            while frame.get('result') != 'error' and frame.get('message') not in RESPONSES:
+                await self.apply_frame(frame, marking_list)
+                frame = await self.receive(socket, timeout=10)
+
+            retry_after = frame.get('params', {}).get('retry_after') if frame.get('result') == 'error' else None
+            if retry_after is not None:
+                self.stats.throttled += 1
+                await asyncio.sleep(retry_after)
+                continue
+            self.stats.add_latency(content['message'], time.monotonic() - started)
+            if frame.get('result') == 'error' and content['message'] not in ('prepare_to_mark', 'next_student'):
+                self.stats.errors += 1
+            return frame
+
+    async def apply_frame(self, frame, marking_list):
+        params = frame.get('params', {})
+        message = frame.get('message')
+        if message == ClientMessages.MARKING_LIST:
+            marking_list.clear()
+            marking_list.update(params['marking_list'])
+        elif message == ClientMessages.USER_JOINED:
+            marking_list.add(params['user_id'])
+        elif message == ClientMessages.USER_LEFT:
+            marking_list.discard(params['user_id'])
+        elif message == ClientMessages.MARKING_LIST_DELTA:
+            marking_list.update(params['joined'])
+            marking_list.difference_update(params['left'])
+
+    async def run(self):
+        """
+        Connects an observing marker, all the students, then all the markers,
+        and marks until everybody is marked or the duration passes.
+        :return: dict of results
+        """
+
+        redis_ops = _redis_commands_processed()
+        started = time.monotonic()
+        self.deadline = started + self.duration
+
+        ready = asyncio.Event()
+        observer = asyncio.ensure_future(self.observer(next(iter(self.markers.values())), ready))
+        await ready.wait()
+
+        students = [asyncio.ensure_future(self.student(user_id, session_key))
+                    for user_id, session_key in self.students.items()]
+        # Let the students get into the marking list first
+        while self.students_pending and time.monotonic() < self.deadline:
+            await asyncio.sleep(0.1)
+
+        markers = [] if self.connect_only else [asyncio.ensure_future(self.marker(session_key))
+                                                for session_key in self.markers.values()]
+        results = await asyncio.gather(observer, *students, *markers, return_exceptions=True)
+        self.stats.errors += sum(1 for result in results if isinstance(result, Exception))
+
+        return self.stats.report(time.monotonic() - started, _redis_commands_processed() - redis_ops)
+
+
+def _redis_commands_processed():
+    return sum(storage.get_sync_connection(node).info('stats')['total_commands_processed']
+               for node in storage.redis_nodes())
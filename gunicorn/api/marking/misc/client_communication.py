@@ -11,6 +11,12 @@ class ErrorMessages:
     NOT_PERMITTED = "Нельзя так!"
     ALREADY_HAVE_USER = "Ты уже выбрал пользователя"
     USER_ALREADY_CHOSEN = "Его уже отмечают"
+    CLAIM_EXPIRED = "Время на отметку истекло"
+    NO_STUDENTS = "Некого отмечать"
+    INVALID_BATCH = "Неверный список пользователей"
+    TOO_MANY_MESSAGES = "Слишком часто, подожди немного"
+    EVENT_FULL = "На паре слишком много людей"
+    OVERLOADED = "Сервер перегружен, попробуй позже"
 
 
 class EncouragingMessages:
@@ -40,6 +46,31 @@ class ClientMessages:
     REFUSED = "refused"
     USER_JOINED = "user_joined"
     USER_LEFT = "user_left"
+    MARKING_LIST_DELTA = "marking_list_delta"
+
+
+class MessageCodes:
+    """
+    Integer codes replacing strings in the binary protocol.
+    """
+
+    RESULTS = {"ok": 0, "error": 1}
+    # Messages from server to client
+    SERVER = {ClientMessages.MARKED: 1,
+              ClientMessages.WAS_MARKED: 2,
+              ClientMessages.MARKING_LIST: 3,
+              ClientMessages.PREPARED: 4,
+              ClientMessages.REFUSED: 5,
+              ClientMessages.USER_JOINED: 6,
+              ClientMessages.USER_LEFT: 7,
+              ClientMessages.MARKING_LIST_DELTA: 8}
+    # Messages from client to server
+    CLIENT = {"prepare_to_mark": 1,
+              "confirm_marking": 2,
+              "refuse_to_mark": 3,
+              "next_student": 4,
+              "prepare_to_mark_batch": 5,
+              "confirm_marking_batch": 6}
 
 
 class ClientResponse:
@@ -55,5 +86,8 @@ class ClientResponse:
         return response
 
     @staticmethod
-    def response_error(message):
-        return {"result": "error", "message": message}
+    def response_error(message, params=None):
+        response = {"result": "error", "message": message}
+        if params:
+            response["params"] = params
+        return response
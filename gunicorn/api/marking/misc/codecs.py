@@ -0,0 +1,110 @@
+"""
+Encodings of websocket messages.
+JSON is used by default, MessagePack is used if the client asks for
+the "mv.msgpack" subprotocol.
+"""
+
+import json
+from functools import lru_cache
+
+import msgpack
+
+from .client_communication import MessageCodes
+
+
+class JsonCodec:
+    """
+    Messages are JSON text frames: {"result": ..., "message": ..., "params": ...}.
+    """
+
+    name = "json"
+    subprotocol = None
+
+    @staticmethod
+    def encode(content):
+        return {"text_data": json.dumps(content)}
+
+    @staticmethod
+    def decode(text_data=None, bytes_data=None):
+        if text_data is None:
+            return None
+        return json.loads(text_data)
+
+
+class MsgpackCodec:
+    """
+    Messages are MessagePack binary frames with integer codes instead of strings:
+    [result, message, params] from server and [message, params] from client.
+    Params are omitted when there are none.
+    Error descriptions stay strings.
+    """
+
+    name = "msgpack"
+    subprotocol = "mv.msgpack"
+    client_messages = {code: message for message, code in MessageCodes.CLIENT.items()}
+
+    @staticmethod
+    def encode(content):
+        frame = [MessageCodes.RESULTS[content["result"]],
+                 MessageCodes.SERVER.get(content["message"], content["message"])]
+        if "params" in content:
+            frame.append(content["params"])
+        return {"bytes_data": msgpack.packb(frame, use_bin_type=True)}
+
+    @classmethod
+    def decode(cls, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            return None
+        try:
+            frame = msgpack.unpackb(bytes_data, raw=False)
+        except (ValueError, msgpack.UnpackException):
+            return None
+        # Messages are codes or names, anything else (e.g. a map) cannot even be looked up
+        if not isinstance(frame, list) or not frame or isinstance(frame[0], bool) \
+                or not isinstance(frame[0], (int, str)):
+            return None
+
+        content = {"message": cls.client_messages.get(frame[0], frame[0])}
+        if len(frame) > 1:
+            content["params"] = frame[1]
+        return content
+
+
+CODECS = [MsgpackCodec, JsonCodec]
+
+
+def negotiate_codec(subprotocols):
+    """
+    Chooses a codec for a connection.
+    :param subprotocols: subprotocols requested by the client
+    :return: codec class
+    """
+
+    for codec in CODECS:
+        if codec.subprotocol is None or codec.subprotocol in subprotocols:
+            return codec
+
+
+def encode_frames(content):
+    """
+    Encodes a response with every codec, so that receivers of a channel message
+    can forward the frame to their clients as is.
+    :param content: response
+    :return: dict codec name -> frame
+    """
+
+    return {codec.name: codec.encode(content) for codec in CODECS}
+
+
+@lru_cache(maxsize=None)
+def constant_frame(codec, result, message):
+    """
+    Encodes a response without params.
+    Such responses are the same for every client, so they are encoded once per process.
+    :param codec: codec class
+    :param result: result of the response
+    :param message: message of the response
+    :return: frame
+    """
+
+    return codec.encode({"result": result, "message": message})
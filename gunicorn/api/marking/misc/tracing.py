@@ -0,0 +1,41 @@
+"""
+Structured tracing of the marking subsystem.
+Tracing is off by default. It can be enabled for particular events with the
+TRACE_EVENTS setting or for a random share of connections with TRACE_SAMPLE_RATE.
+Traces are written as JSON lines to the 'api.marking' logger.
+"""
+
+import json
+import logging
+import random
+
+from ..conf import get_setting
+
+logger = logging.getLogger('api.marking')
+
+
+def tracing_enabled(event_id):
+    """
+    Decides whether a connection to the event is traced.
+    :param event_id: uuid of the event
+    :return: True if the connection should be traced
+    """
+
+    if str(event_id) in get_setting('TRACE_EVENTS'):
+        return True
+    sample_rate = get_setting('TRACE_SAMPLE_RATE')
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def trace(action, event_id, **fields):
+    """
+    Writes a trace record.
+    Callers must check that tracing is enabled before collecting the fields.
+    :param action: what happened
+    :param event_id: uuid of the event
+    :param fields: any JSON-serializable details
+    """
+
+    record = {"action": action, "event_id": str(event_id)}
+    record.update(fields)
+    logger.info(json.dumps(record, default=lambda o: sorted(o) if isinstance(o, set) else str(o)))
@@ -1,4 +1,5 @@
 from .client_communication import ClientResponse
+from .tracing import trace
 
 
 def require_group_message_param(required):
@@ -10,8 +11,9 @@ def require_group_message_param(required):
     """
 
     def decorator(func):
-        def wrapper(self, event):
-            print("Message from group", event)
+        async def wrapper(self, event):
+            if self.traced:
+                trace("group_message", self.event.uuid, user_id=self.user.id, message=event)
             params = event.get('params')
             if params is None:
                 return
@@ -19,7 +21,7 @@ def require_group_message_param(required):
             for param in required:
                 if param not in params:
                     return
-            return func(self, params)
+            return await func(self, params)
 
         return wrapper
 
@@ -35,30 +37,14 @@ def require_client_message_param(required):
     """
 
     def decorator(func):
-        def wrapper(self, params):
+        async def wrapper(self, params):
             for param in required:
                 if param not in params:
-                    self.send_json(ClientResponse.response_error("{} is missing".format(param)))
+                    await self.send_json(ClientResponse.response_error("{} is missing".format(param)))
                     return
-            return func(self, params)
+            return await func(self, params)
 
         return wrapper
 
     return decorator
 
-
-def ignore_own_messages(func):
-    """
-    Decorator for group messages.
-    Checks if sender is current consumer and ignores the message in that case.
-    :param
-    :return:
-    """
-
-    def wrapper(self, params):
-        sender = params['sender']
-        if sender == self.channel_name:
-            return
-        return func(self, params)
-
-    return wrapper
@@ -0,0 +1,65 @@
+"""
+Saving of markings to the database.
+Markings are appended to a redis stream when they are confirmed
+and are moved to the Marking table in batches by a background process.
+"""
+
+import uuid
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from .storage import storage
+from ..models import Event, Marking
+
+
+def _parse_marking(fields):
+    """
+    :param fields: fields of a stream entry
+    :return: tuple (event uuid, user id, marker id, time) or None if the entry is malformed
+    """
+
+    try:
+        return (str(uuid.UUID(fields['event'])), int(fields['user']), int(fields['marker']),
+                datetime.utcfromtimestamp(int(fields['time']) / 1000))
+    except (KeyError, ValueError):
+        return None
+
+
+def persist_markings(consumer, batch_size=500, block=None):
+    """
+    Saves a batch of markings from the stream to the database and removes them from the stream.
+    Markings saved before are skipped, so a batch can be safely saved again after a crash.
+    Markings of deleted events or users are dropped.
+    :param consumer: name of the consumer reading the stream
+    :param batch_size: maximal number of markings to save
+    :param block: milliseconds to wait for new markings, do not wait if None
+    :return: number of markings read from the stream
+    """
+
+    entries = storage.read_markings(consumer, batch_size, block)
+    if not entries:
+        return 0
+
+    records = {}
+    for entry_id, fields in entries:
+        record = _parse_marking(fields)
+        if record is not None:
+            records[entry_id] = record
+
+    event_ids = {str(event_id) for event_id in
+                 Event.objects.filter(uuid__in={record[0] for record in records.values()})
+                      .values_list('uuid', flat=True)}
+    user_ids = set(User.objects.filter(id__in={user_id for record in records.values() for user_id in record[1:3]})
+                   .values_list('id', flat=True))
+    saved = set(Marking.objects.filter(stream_id__in=list(records)).values_list('stream_id', flat=True))
+
+    markings = [Marking(event_id=event_id, user_id=user_id, marker_id=marker_id, time=time, stream_id=entry_id)
+                for entry_id, (event_id, user_id, marker_id, time) in records.items()
+                if entry_id not in saved and event_id in event_ids and user_id in user_ids and marker_id in user_ids]
+    with transaction.atomic():
+        Marking.objects.bulk_create(markings)
+
+    storage.ack_markings([entry_id for entry_id, _ in entries])
+    return len(entries)
@@ -0,0 +1,102 @@
+"""
+Presence of connected users.
+Every process records heartbeats of its connected users in redis,
+the reaper removes users whose heartbeats stopped, e.g. after a crash of the process.
+"""
+
+import asyncio
+import logging
+import weakref
+from collections import Counter
+
+from .broadcast import marking_list_changed, MarkingListBatcher
+from .conf import get_setting
+from .storage import storage
+
+logger = logging.getLogger('api.marking')
+
+
+class PresenceHeartbeat(object):
+    """
+    Periodically records heartbeats of the users connected to the process.
+    One heartbeat per event loop is kept.
+    """
+
+    __heartbeats = weakref.WeakKeyDictionary()
+
+    def __init__(self, loop):
+        self.loop = loop
+        # presence key -> number of connections per user id
+        self.present = {}
+        self.task = None
+
+    @classmethod
+    def get(cls):
+        loop = asyncio.get_event_loop()
+        heartbeat = PresenceHeartbeat.__heartbeats.get(loop)
+        if heartbeat is None:
+            heartbeat = PresenceHeartbeat.__heartbeats[loop] = cls(loop)
+        return heartbeat
+
+    async def join(self, key, user_id, recorded=False):
+        """
+        Starts recording heartbeats of a user.
+        :param key: presence key
+        :param user_id: id of the user
+        :param recorded: the first heartbeat has already been recorded by the caller
+        """
+
+        self.present.setdefault(key, Counter())[user_id] += 1
+        if not recorded:
+            await storage.touch_presence({key: [user_id]})
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run(), loop=self.loop)
+
+    def leave(self, key, user_id):
+        """
+        Stops recording heartbeats of a user once all his/her connections are closed.
+        The last heartbeat stays in redis until it is reaped or removed.
+        :param key: presence key
+        :param user_id: id of the user
+        :return: True if the user has no connections to the process left
+        """
+
+        users = self.present.get(key)
+        if users is None:
+            return True
+        users[user_id] -= 1
+        left = users[user_id] <= 0
+        if left:
+            del users[user_id]
+        if not users:
+            del self.present[key]
+        return left
+
+    async def run(self):
+        while self.present:
+            await asyncio.sleep(get_setting('HEARTBEAT_INTERVAL'))
+            try:
+                # Heartbeats of connections to a closed event must not recreate its purged state
+                await storage.touch_presence({key: list(users) for key, users in self.present.items()}, refresh=True)
+            except Exception:
+                logger.exception("Failed to record heartbeats")
+
+
+async def reap_stale_presence(channel_layer):
+    """
+    Removes users without recent heartbeats from marking lists of all the events
+    and notifies markers about the changes.
+    Batched notifications are sent before returning.
+    :param channel_layer: channel layer to send notifications with
+    :return: number of removed users
+    """
+
+    timeout = get_setting('PRESENCE_TIMEOUT')
+    reaped = 0
+    for event_id in await storage.get_present_events():
+        joined, left, version = await storage.reap_stale_presence(event_id, timeout)
+        if joined or left:
+            await marking_list_changed(channel_layer, event_id, joined=joined, left=left, version=version)
+        reaped += len(left)
+    await MarkingListBatcher.get().flush_all()
+    return reaped
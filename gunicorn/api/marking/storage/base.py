@@ -0,0 +1,400 @@
+"""
+Interface of storage backends of the marking subsystem.
+A backend keeps marking lists of events, claims of markers, presence of connected users,
+markings waiting to be saved to the database and pending karma changes.
+"""
+
+MARK_ME_PRESENCE_PREFIX = "presence_mark_me_"
+MARKERS_PRESENCE_PREFIX = "presence_markers_"
+CONNECTIONS_PREFIX = "connections_"
+
+# Prefixes of keys holding marking state of an event, followed by the uuid of the event
+EVENT_KEY_PREFIXES = ["mark_me_", "mark_me_channels_", "claimed_", "leases_", "version_", "changelog_",
+                      "pairing_queue_", "asked_to_mark_", "ready_to_mark_", MARK_ME_PRESENCE_PREFIX, MARKERS_PRESENCE_PREFIX,
+                      CONNECTIONS_PREFIX]
+
+
+def mark_me_presence_key(event_id):
+    return "{}{}".format(MARK_ME_PRESENCE_PREFIX, event_id)
+
+
+def markers_presence_key(event_id):
+    return "{}{}".format(MARKERS_PRESENCE_PREFIX, event_id)
+
+
+def connections_key(event_id):
+    """
+    Name of the sorted set of users connected to the event scored by the time of the last heartbeat.
+    Unlike presence, users are removed from it as soon as their last connection closes.
+    """
+
+    return "{}{}".format(CONNECTIONS_PREFIX, event_id)
+
+
+def event_keys(event_id):
+    """
+    Returns names of all the keys that may hold marking state of the event.
+    :param event_id: uuid of the event
+    :return: list of key names
+    """
+
+    return ["{}{}".format(prefix, event_id) for prefix in EVENT_KEY_PREFIXES]
+
+
+def key_event_id(key):
+    """
+    Returns the event whose marking state a key holds.
+    :param key: name of the key
+    :return: uuid of the event or None if the key is not bound to an event
+    """
+
+    # mark_me_ is also the beginning of mark_me_channels_, so longer prefixes are tried first
+    for prefix in sorted(EVENT_KEY_PREFIXES, key=len, reverse=True):
+        if key.startswith(prefix):
+            return key[len(prefix):]
+    return None
+
+
+class StorageBackend(object):
+    """
+    Base class of storage backends.
+    Every change of the marking state is atomic: concurrent consumers never observe
+    a user both in the marking list and claimed, or claimed by two markers.
+    Every change of the marking list of an event increments its version
+    and is kept in a changelog of the last CHANGELOG_SIZE changes.
+    """
+
+    async def add_to_set(self, setname, value):
+        """
+        Adds an integer to the set.
+        If a set with name setname does not exist, the new empty set is created before.
+        :param setname: name of the set
+        :param value: an integer to add
+        :return: True if the value was not in the set before
+        """
+
+        raise NotImplementedError
+
+    async def get_set(self, setname):
+        """
+        Returns all the elements of the set.
+        :param setname: name of the set
+        :return: list with all the integers of requested set
+        """
+
+        raise NotImplementedError
+
+    async def set_contains(self, setname, value):
+        """
+        Checks if the set contains an integer.
+        :param setname: name of the set
+        :param value: an integer to look for
+        :return: True if the value is in the set
+        """
+
+        raise NotImplementedError
+
+    async def remove_from_set(self, setname, value):
+        """
+        Removes an integer from the set.
+        :param setname: name of the set
+        :param value: an integer to remove
+        :return: True if the value was removed
+        """
+
+        raise NotImplementedError
+
+    async def get_marking_state(self, event_id, since_version=None):
+        """
+        Returns users waiting to be marked at the event along with the version of the list.
+        Users whose claims have expired are returned to the list first.
+        :param event_id: uuid of the event
+        :param since_version: version of the list known to the caller, if any
+        :return: tuple (version, list of user ids to mark, list of user ids released from expired claims,
+          changes since since_version as (joined, left) or None if they are unknown)
+        """
+
+        raise NotImplementedError
+
+    async def get_marking_list(self, event_id):
+        """
+        Returns users waiting to be marked at the event.
+        Users whose claims have expired are returned to the list first.
+        :param event_id: uuid of the event
+        :return: tuple (list of user ids to mark, list of user ids released from expired claims)
+        """
+
+        _, members, released, _ = await self.get_marking_state(event_id)
+        return members, released
+
+    async def add_user_to_mark(self, event_id, user_id, channel_name, once=False, expire_at=None):
+        """
+        Atomically adds a user to the marking list, marks him/her as the one who asked to be marked
+        and records his/her heartbeat.
+        A user who is being marked right now is not added.
+        :param event_id: uuid of the event
+        :param user_id: id of the user
+        :param channel_name: channel name of the user's consumer to notify when he/she is marked
+        :param once: leave everything as is if the user has asked to be marked before
+        :param expire_at: unix timestamp when the marking state of the event expires, None leaves it as is
+        :return: tuple (True if added, False if not, None if refused because of once,
+          list of user ids released from expired claims, version of the list)
+        """
+
+        raise NotImplementedError
+
+    async def claim_users(self, event_id, user_ids, marker_id, lease_seconds=None, expire_at=None):
+        """
+        Atomically takes users from the marking list and leases them to a marker.
+        Either all the users are claimed or none of them.
+        If the claim is neither confirmed nor released in lease_seconds,
+        the users are returned to the marking list.
+        :param event_id: uuid of the event
+        :param user_ids: ids of the users to mark
+        :param marker_id: id of the user who marks
+        :param lease_seconds: lease duration, CLAIM_LEASE_SECONDS setting by default
+        :param expire_at: unix timestamp when the marking state of the event expires, None leaves it as is
+        :return: tuple (True if claimed, list of user ids released from expired claims, version of the list)
+        """
+
+        raise NotImplementedError
+
+    async def claim_user(self, event_id, user_id, marker_id, lease_seconds=None, expire_at=None):
+        """
+        Atomically takes a user from the marking list and leases him/her to a marker.
+        :param event_id: uuid of the event
+        :param user_id: id of the user to mark
+        :param marker_id: id of the user who marks
+        :param lease_seconds: lease duration, CLAIM_LEASE_SECONDS setting by default
+        :param expire_at: unix timestamp when the marking state of the event expires, None leaves it as is
+        :return: tuple (True if claimed, list of user ids released from expired claims, version of the list)
+        """
+
+        return await self.claim_users(event_id, [user_id], marker_id, lease_seconds, expire_at)
+
+    async def claim_next_user(self, event_id, marker_id, lease_seconds=None, expire_at=None):
+        """
+        Atomically takes the user waiting longest from the marking list and leases him/her to a marker.
+        :param event_id: uuid of the event
+        :param marker_id: id of the user who marks
+        :param lease_seconds: lease duration, CLAIM_LEASE_SECONDS setting by default
+        :param expire_at: unix timestamp when the marking state of the event expires, None leaves it as is
+        :return: tuple (id of the claimed user or None if nobody waits, list of user ids released from expired
+          claims, version of the list)
+        """
+
+        raise NotImplementedError
+
+    async def confirm_claims(self, event_id, user_ids, marker_id):
+        """
+        Atomically completes claims, so the users do not return to the marking list,
+        and records the markings to be saved to the database.
+        A claim past its lease that has not been returned to the list yet can still be confirmed.
+        :param event_id: uuid of the event
+        :param user_ids: ids of the claimed users
+        :param marker_id: id of the user who marks
+        :return: tuple (dict id of user whose claim the marker held -> channel name of the user's consumer or None,
+          list of user ids released from expired claims, version of the list)
+        """
+
+        raise NotImplementedError
+
+    async def confirm_claim(self, event_id, user_id, marker_id):
+        """
+        Atomically completes a claim, so the user does not return to the marking list.
+        :param event_id: uuid of the event
+        :param user_id: id of the claimed user
+        :param marker_id: id of the user who marks
+        :return: tuple (True if the marker held the claim, list of user ids released from expired claims,
+          version of the list, channel name of the marked user's consumer or None)
+        """
+
+        confirmed, released, version = await self.confirm_claims(event_id, [user_id], marker_id)
+        return user_id in confirmed, released, version, confirmed.get(user_id)
+
+    async def release_claims(self, event_id, user_ids, marker_id):
+        """
+        Atomically cancels claims and returns the users to the marking list.
+        :param event_id: uuid of the event
+        :param user_ids: ids of the claimed users
+        :param marker_id: id of the user who marks
+        :return: tuple (list of ids of users whose claims the marker held, list of user ids released from expired
+          claims, version of the list)
+        """
+
+        raise NotImplementedError
+
+    async def release_claim(self, event_id, user_id, marker_id):
+        """
+        Atomically cancels a claim and returns the user to the marking list.
+        :param event_id: uuid of the event
+        :param user_id: id of the claimed user
+        :param marker_id: id of the user who marks
+        :return: tuple (True if the marker held the claim, list of user ids released from expired claims,
+          version of the list)
+        """
+
+        refused, released, version = await self.release_claims(event_id, [user_id], marker_id)
+        return bool(refused), released, version
+
+    async def forget_mark_me_channel(self, event_id, user_id, channel_name):
+        """
+        Removes the channel name stored by add_user_to_mark unless another consumer has replaced it.
+        :param event_id: uuid of the event
+        :param user_id: id of the user
+        :param channel_name: channel name of the user's consumer
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def touch_presence(self, presence, refresh=False):
+        """
+        Records a heartbeat of connected users.
+        :param presence: dict presence key -> iterable of user ids
+        :param refresh: only update heartbeats recorded before, so users removed from presence,
+          e.g. by purging state of a closed event, are not recorded again
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def remove_presence(self, key, user_id):
+        """
+        Forgets the heartbeat of a user.
+        :param key: presence key
+        :param user_id: id of the user
+        :return:
+        """
+
+        raise NotImplementedError
+
+    async def admit_connection(self, event_id, user_id, max_connections, timeout):
+        """
+        Atomically counts users connected to the event and records the connection of the user
+        unless max_connections users are connected already. Users connected before are always admitted.
+        Users without heartbeats for timeout seconds, e.g. connected to a crashed process, are forgotten first.
+        :param event_id: uuid of the event
+        :param user_id: id of the connecting user
+        :param max_connections: maximal number of connected users
+        :param timeout: seconds since the last heartbeat after which a connection is stale
+        :return: True if the connection is admitted
+        """
+
+        raise NotImplementedError
+
+    async def get_present_events(self):
+        """
+        Returns events having presence records.
+        :return: set of event uuids
+        """
+
+        raise NotImplementedError
+
+    async def reap_stale_presence(self, event_id, timeout):
+        """
+        Atomically removes users without recent heartbeats from the marking list of the event
+        and returns users claimed by markers without recent heartbeats to the list.
+        :param event_id: uuid of the event
+        :param timeout: seconds since the last heartbeat after which users are considered gone
+        :return: tuple (list of user ids added to the list, list of user ids removed from the list,
+          version of the list)
+        """
+
+        raise NotImplementedError
+
+    def get_latency(self, event_id):
+        """
+        Returns the recent latency of the storage keeping marking state of the event.
+        :param event_id: uuid of the event
+        :return: seconds, 0 if unknown
+        """
+
+        return 0.0
+
+    def expire_event_keys(self, event_id, expire_at):
+        """
+        Makes the storage drop marking state of the event at the given time.
+        :param event_id: uuid of the event
+        :param expire_at: unix timestamp
+        :return:
+        """
+
+        raise NotImplementedError
+
+    def purge_event_keys(self, event_ids):
+        """
+        Deletes marking state of events.
+        :param event_ids: uuids of the events
+        :return: number of deleted keys
+        """
+
+        raise NotImplementedError
+
+    def scan_event_ids(self, count=1000):
+        """
+        Iterates over uuids of events having marking state.
+        An uuid may be returned more than once.
+        :param count: number of keys looked through per step
+        :return: generator of uuids
+        """
+
+        raise NotImplementedError
+
+    def read_markings(self, consumer, count, block=None):
+        """
+        Reads markings delivered to the consumer but not acknowledged yet,
+        or new markings if there are none.
+        :param consumer: name of the reading consumer
+        :param count: maximal number of markings to read
+        :param block: milliseconds to wait for new markings, do not wait if None
+        :return: list of tuples (entry id, dict with event, user, marker and time)
+        """
+
+        raise NotImplementedError
+
+    def ack_markings(self, entry_ids):
+        """
+        Forgets markings saved to the database.
+        :param entry_ids: ids of the entries
+        """
+
+        raise NotImplementedError
+
+    async def add_karma(self, user_id, delta):
+        """
+        Accumulates a karma change to be written to the database later.
+        :param user_id: id of the user
+        :param delta: karma change
+        :return:
+        """
+
+        raise NotImplementedError
+
+    def get_pending_karma(self, user_id, applied_batch=None):
+        """
+        Returns the karma change of a user that has not been written to the database yet.
+        :param user_id: id of the user
+        :param applied_batch: id of the last batch written to the profile of the user,
+          changes of the batch are not counted even if it has not been acknowledged yet
+        :return: karma change
+        """
+
+        raise NotImplementedError
+
+    def take_pending_karma(self):
+        """
+        Moves accumulated karma changes aside as a batch to be written to the database.
+        A batch that has not been acknowledged is returned again with the same id.
+        :return: tuple (id of the batch or None if nothing is pending, dict user id -> karma change)
+        """
+
+        raise NotImplementedError
+
+    def ack_pending_karma(self, batch):
+        """
+        Forgets a batch of karma changes after it has been written to the database.
+        :param batch: id of the batch returned by take_pending_karma
+        """
+
+        raise NotImplementedError
@@ -0,0 +1,65 @@
+"""
+Benchmark of storage backends.
+Runs the operations of a marking session against a backend directly, without websockets,
+so backends can be compared with each other.
+"""
+
+import asyncio
+import time
+import uuid
+
+from ..loadtest import percentile
+from .base import mark_me_presence_key
+
+
+async def benchmark_backend(backend, students, markers):
+    """
+    Students join the marking list of a fresh event, markers concurrently take
+    the next student and confirm the marking until the list is empty.
+    Markings of the event are left in the markings storage, they are dropped
+    on persistence because the event does not exist.
+    :param backend: StorageBackend
+    :param students: number of students
+    :param markers: number of markers
+    :return: dict of results
+    """
+
+    event_id = str(uuid.uuid4())
+    latencies = {}
+
+    async def timed(name, coroutine):
+        started = time.monotonic()
+        result = await coroutine
+        latencies.setdefault(name, []).append(time.monotonic() - started)
+        return result
+
+    async def marker(marker_id):
+        while True:
+            user_id, _, _ = await timed('claim_next_user', backend.claim_next_user(event_id, marker_id))
+            if user_id is None:
+                return
+            await timed('confirm_claims', backend.confirm_claims(event_id, [user_id], marker_id))
+
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*[timed('add_user_to_mark',
+                                     backend.add_user_to_mark(event_id, user_id, "channel_{}".format(user_id)))
+                               for user_id in range(1, students + 1)])
+        await timed('touch_presence', backend.touch_presence({mark_me_presence_key(event_id):
+                                                                  range(1, students + 1)}))
+        await timed('get_marking_state', backend.get_marking_state(event_id))
+        await asyncio.gather(*[marker(students + i) for i in range(1, markers + 1)])
+        await timed('reap_stale_presence', backend.reap_stale_presence(event_id, timeout=60))
+    finally:
+        backend.purge_event_keys([event_id])
+    elapsed = time.monotonic() - started
+
+    operations = sum(len(values) for values in latencies.values())
+    return {"backend": "{}.{}".format(type(backend).__module__, type(backend).__name__),
+            "elapsed_s": round(elapsed, 3),
+            "operations": operations,
+            "operations_per_second": round(operations / elapsed, 1) if elapsed else None,
+            "latencies": {name: {"count": len(values),
+                                 "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+                                 "p99_ms": round(percentile(values, 0.99) * 1000, 3)}
+                          for name, values in latencies.items()}}
@@ -0,0 +1,395 @@
+"""
+In-memory storage backend.
+State lives in the process, so the backend suits single-process deployments
+and tests paired with channels.layers.InMemoryChannelLayer.
+Management commands run in other processes (reap_presence, persist_markings, ...)
+do not see the state, their functions have to be called in the server process instead.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from .base import StorageBackend, EVENT_KEY_PREFIXES, MARK_ME_PRESENCE_PREFIX, MARKERS_PRESENCE_PREFIX, \
+    connections_key, event_keys, mark_me_presence_key, markers_presence_key
+from ..conf import get_setting
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+class InMemoryStorage(StorageBackend):
+    """
+    Storage keeping the same keys as the redis backend in dictionaries of the process.
+    Operations hold a lock, so they are atomic for coroutines and threads alike.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Has its own lock, so readers of markings wait without blocking the storage
+        self._markings_added = threading.Condition()
+        # key -> set, dict (hashes and sorted sets), OrderedDict (pairing queues), list (changelogs) or int
+        self._keys = {}
+        # key -> unix timestamp
+        self._expire_at = {}
+        # entry id -> fields of markings not acknowledged yet
+        self._markings = OrderedDict()
+        # entry id -> consumer the marking was delivered to
+        self._delivered = {}
+        self._last_entry = (0, 0)
+        self._karma_pending = {}
+        self._karma_flushing = {}
+        self._karma_batch = None
+
+    def _get(self, key, factory=None):
+        """
+        :param key: name of the key
+        :param factory: creates the value of a missing key, missing keys are not created if None
+        :return: value of the key or None
+        """
+
+        expire_at = self._expire_at.get(key)
+        if expire_at is not None and expire_at <= time.time():
+            self._delete(key)
+        value = self._keys.get(key)
+        if value is None and factory is not None:
+            value = self._keys[key] = factory()
+        return value
+
+    def _delete(self, key):
+        """
+        :return: True if the key held a value, empty collections do not count as in redis
+        """
+
+        self._expire_at.pop(key, None)
+        return bool(self._keys.pop(key, None))
+
+    def _log_change(self, event_id, op, user_id):
+        queue = self._get("pairing_queue_{}".format(event_id), OrderedDict)
+        if op == '+':
+            queue[user_id] = None
+        else:
+            queue.pop(user_id, None)
+        version = self._keys["version_{}".format(event_id)] = self._version(event_id) + 1
+        changelog = self._get("changelog_{}".format(event_id), list)
+        changelog.append((version, op, user_id))
+        del changelog[:-get_setting('CHANGELOG_SIZE')]
+
+    def _version(self, event_id):
+        return self._get("version_{}".format(event_id)) or 0
+
+    def _release_expired(self, event_id, now):
+        """
+        Returns users with expired leases to the marking list.
+        :return: list of released user ids
+        """
+
+        leases = self._get("leases_{}".format(event_id), dict)
+        claimed = self._get("claimed_{}".format(event_id), dict)
+        mark_me = self._get("mark_me_{}".format(event_id), set)
+        released = sorted((user_id for user_id, expiry in leases.items() if expiry <= now),
+                          key=lambda user_id: (leases[user_id], user_id))
+        for user_id in released:
+            del leases[user_id]
+            claimed.pop(user_id, None)
+            if user_id not in mark_me:
+                mark_me.add(user_id)
+                self._log_change(event_id, '+', user_id)
+        return released
+
+    def _claim(self, event_id, user_id, marker_id, expiry):
+        self._get("mark_me_{}".format(event_id), set).discard(user_id)
+        self._log_change(event_id, '-', user_id)
+        self._get("claimed_{}".format(event_id), dict)[user_id] = marker_id
+        self._get("leases_{}".format(event_id), dict)[user_id] = expiry
+
+    def _unclaim(self, event_id, user_id, marker_id):
+        """
+        :return: True if the marker held the claim of the user
+        """
+
+        claimed = self._get("claimed_{}".format(event_id), dict)
+        if claimed.get(user_id) != marker_id:
+            return False
+        del claimed[user_id]
+        self._get("leases_{}".format(event_id), dict).pop(user_id, None)
+        return True
+
+    async def add_to_set(self, setname, value):
+        with self._lock:
+            members = self._get(setname, set)
+            if int(value) in members:
+                return False
+            members.add(int(value))
+            return True
+
+    async def get_set(self, setname):
+        with self._lock:
+            return list(self._get(setname) or ())
+
+    async def set_contains(self, setname, value):
+        with self._lock:
+            return int(value) in (self._get(setname) or ())
+
+    async def remove_from_set(self, setname, value):
+        with self._lock:
+            members = self._get(setname) or set()
+            if int(value) not in members:
+                return False
+            members.discard(int(value))
+            return True
+
+    async def get_marking_state(self, event_id, since_version=None):
+        with self._lock:
+            released = self._release_expired(event_id, _now_ms())
+            version = self._version(event_id)
+            members = list(self._get("mark_me_{}".format(event_id), set))
+            changelog = self._get("changelog_{}".format(event_id), list)
+
+            if since_version is None or since_version < 0 or since_version > version:
+                changes = None
+            elif since_version == version:
+                changes = [], []
+            elif not changelog or changelog[0][0] > since_version + 1:
+                # The changes are not in the changelog anymore
+                changes = None
+            else:
+                joined = {}
+                for change_version, op, user_id in changelog:
+                    if change_version > since_version:
+                        joined[user_id] = op == '+'
+                changes = ([user_id for user_id, is_joined in joined.items() if is_joined],
+                           [user_id for user_id, is_joined in joined.items() if not is_joined])
+            return version, members, released, changes
+
+    async def add_user_to_mark(self, event_id, user_id, channel_name, once=False, expire_at=None):
+        user_id = int(user_id)
+        with self._lock:
+            now = _now_ms()
+            released = self._release_expired(event_id, now)
+            asked_to_mark = self._get("asked_to_mark_{}".format(event_id), set)
+            if once and user_id in asked_to_mark:
+                return None, released, self._version(event_id)
+            asked_to_mark.add(user_id)
+            self._get("mark_me_channels_{}".format(event_id), dict)[user_id] = channel_name
+            self._get(mark_me_presence_key(event_id), dict)[user_id] = now
+            mark_me = self._get("mark_me_{}".format(event_id), set)
+            added = user_id not in self._get("claimed_{}".format(event_id), dict) and user_id not in mark_me
+            if added:
+                mark_me.add(user_id)
+                self._log_change(event_id, '+', user_id)
+            if expire_at:
+                self.expire_event_keys(event_id, expire_at)
+            return added, released, self._version(event_id)
+
+    async def claim_users(self, event_id, user_ids, marker_id, lease_seconds=None, expire_at=None):
+        if lease_seconds is None:
+            lease_seconds = get_setting('CLAIM_LEASE_SECONDS')
+        user_ids = {int(user_id) for user_id in user_ids}
+        with self._lock:
+            now = _now_ms()
+            released = self._release_expired(event_id, now)
+            claimed = user_ids <= self._get("mark_me_{}".format(event_id), set)
+            if claimed:
+                for user_id in user_ids:
+                    self._claim(event_id, user_id, int(marker_id), now + int(lease_seconds * 1000))
+            if expire_at:
+                self.expire_event_keys(event_id, expire_at)
+            return claimed, released, self._version(event_id)
+
+    async def claim_next_user(self, event_id, marker_id, lease_seconds=None, expire_at=None):
+        if lease_seconds is None:
+            lease_seconds = get_setting('CLAIM_LEASE_SECONDS')
+        with self._lock:
+            now = _now_ms()
+            released = self._release_expired(event_id, now)
+            user_id = next(iter(self._get("pairing_queue_{}".format(event_id), OrderedDict)), None)
+            if user_id is None:
+                user_id = next(iter(self._get("mark_me_{}".format(event_id), set)), None)
+            if user_id is not None:
+                self._claim(event_id, user_id, int(marker_id), now + int(lease_seconds * 1000))
+            if expire_at:
+                self.expire_event_keys(event_id, expire_at)
+            return user_id, released, self._version(event_id)
+
+    async def confirm_claims(self, event_id, user_ids, marker_id):
+        with self._lock:
+            now = _now_ms()
+            channels = self._get("mark_me_channels_{}".format(event_id), dict)
+            confirmed = {}
+            for user_id in user_ids:
+                if self._unclaim(event_id, int(user_id), int(marker_id)):
+                    self._add_marking({'event': str(event_id), 'user': str(int(user_id)),
+                                       'marker': str(int(marker_id)), 'time': str(now)}, now)
+                    confirmed[int(user_id)] = channels.pop(int(user_id), None)
+            released = self._release_expired(event_id, now)
+            return confirmed, released, self._version(event_id)
+
+    async def release_claims(self, event_id, user_ids, marker_id):
+        with self._lock:
+            mark_me = self._get("mark_me_{}".format(event_id), set)
+            refused = []
+            for user_id in user_ids:
+                if self._unclaim(event_id, int(user_id), int(marker_id)):
+                    if int(user_id) not in mark_me:
+                        mark_me.add(int(user_id))
+                        self._log_change(event_id, '+', int(user_id))
+                    refused.append(int(user_id))
+            released = self._release_expired(event_id, _now_ms())
+            return refused, released, self._version(event_id)
+
+    async def forget_mark_me_channel(self, event_id, user_id, channel_name):
+        with self._lock:
+            channels = self._get("mark_me_channels_{}".format(event_id)) or {}
+            if channels.get(int(user_id)) == channel_name:
+                del channels[int(user_id)]
+
+    async def touch_presence(self, presence, refresh=False):
+        now = _now_ms()
+        with self._lock:
+            for key, user_ids in presence.items():
+                heartbeats = self._get(key) if refresh else self._get(key, dict)
+                if heartbeats is None:
+                    continue
+                for user_id in user_ids:
+                    if not refresh or int(user_id) in heartbeats:
+                        heartbeats[int(user_id)] = now
+
+    async def remove_presence(self, key, user_id):
+        with self._lock:
+            (self._get(key) or {}).pop(int(user_id), None)
+
+    async def admit_connection(self, event_id, user_id, max_connections, timeout):
+        now = _now_ms()
+        with self._lock:
+            connected = self._get(connections_key(event_id), dict)
+            stale = now - int(timeout * 1000)
+            for connected_user_id in [o for o, heartbeat in connected.items() if heartbeat <= stale]:
+                del connected[connected_user_id]
+            if int(user_id) not in connected and len(connected) >= max_connections:
+                return False
+            connected[int(user_id)] = now
+            return True
+
+    async def get_present_events(self):
+        with self._lock:
+            events = set()
+            for key in list(self._keys):
+                for prefix in (MARK_ME_PRESENCE_PREFIX, MARKERS_PRESENCE_PREFIX):
+                    if key.startswith(prefix) and self._get(key):
+                        events.add(key[len(prefix):])
+            return events
+
+    async def reap_stale_presence(self, event_id, timeout):
+        with self._lock:
+            now = _now_ms()
+            threshold = now - int(timeout * 1000)
+            joined = OrderedDict.fromkeys(self._release_expired(event_id, now))
+            mark_me = self._get("mark_me_{}".format(event_id), set)
+
+            markers = self._get(markers_presence_key(event_id), dict)
+            stale_markers = {marker_id for marker_id, heartbeat in markers.items() if heartbeat <= threshold}
+            for marker_id in stale_markers:
+                del markers[marker_id]
+            if stale_markers:
+                claimed = self._get("claimed_{}".format(event_id), dict)
+                for user_id, marker_id in list(claimed.items()):
+                    if marker_id in stale_markers and self._unclaim(event_id, user_id, marker_id) \
+                            and user_id not in mark_me:
+                        mark_me.add(user_id)
+                        self._log_change(event_id, '+', user_id)
+                        joined[user_id] = None
+
+            left = []
+            heartbeats = self._get(mark_me_presence_key(event_id), dict)
+            channels = self._get("mark_me_channels_{}".format(event_id), dict)
+            for user_id in sorted((user_id for user_id, heartbeat in heartbeats.items() if heartbeat <= threshold),
+                                  key=lambda user_id: (heartbeats[user_id], user_id)):
+                del heartbeats[user_id]
+                channels.pop(user_id, None)
+                if user_id in mark_me:
+                    mark_me.discard(user_id)
+                    self._log_change(event_id, '-', user_id)
+                    if user_id in joined:
+                        del joined[user_id]
+                    else:
+                        left.append(user_id)
+            return list(joined), left, self._version(event_id)
+
+    def expire_event_keys(self, event_id, expire_at):
+        with self._lock:
+            for key in event_keys(event_id):
+                if self._get(key) is not None:
+                    self._expire_at[key] = int(expire_at)
+
+    def purge_event_keys(self, event_ids):
+        with self._lock:
+            return sum(self._delete(key) for event_id in event_ids for key in event_keys(event_id))
+
+    def scan_event_ids(self, count=1000):
+        with self._lock:
+            keys = [key for key in self._keys if self._get(key)]
+        for key in keys:
+            for prefix in EVENT_KEY_PREFIXES:
+                if not key.startswith(prefix):
+                    continue
+                # mark_me_ also matches keys of other prefixes
+                try:
+                    yield str(uuid.UUID(key[len(prefix):]))
+                except ValueError:
+                    continue
+
+    def _add_marking(self, fields, now):
+        ms, seq = self._last_entry
+        self._last_entry = (ms, seq + 1) if now <= ms else (now, 0)
+        self._markings["{}-{}".format(*self._last_entry)] = fields
+        with self._markings_added:
+            self._markings_added.notify_all()
+
+    def read_markings(self, consumer, count, block=None):
+        deadline = time.monotonic() + block / 1000 if block is not None else None
+        while True:
+            with self._lock:
+                # Markings read before a crash of the consumer come first
+                entry_ids = [entry_id for entry_id, owner in self._delivered.items() if owner == consumer][:count]
+                if not entry_ids:
+                    entry_ids = [entry_id for entry_id in self._markings if entry_id not in self._delivered][:count]
+                    for entry_id in entry_ids:
+                        self._delivered[entry_id] = consumer
+                if entry_ids or deadline is None or time.monotonic() >= deadline:
+                    return [(entry_id, dict(self._markings.get(entry_id, {}))) for entry_id in entry_ids]
+                last_entry = self._last_entry
+            with self._markings_added:
+                # The last entry changes along with the notification, so a marking added meanwhile is not missed
+                if self._last_entry == last_entry:
+                    self._markings_added.wait(deadline - time.monotonic())
+
+    def ack_markings(self, entry_ids):
+        with self._lock:
+            for entry_id in entry_ids:
+                self._delivered.pop(entry_id, None)
+                self._markings.pop(entry_id, None)
+
+    async def add_karma(self, user_id, delta):
+        with self._lock:
+            self._karma_pending[int(user_id)] = self._karma_pending.get(int(user_id), 0) + delta
+
+    def get_pending_karma(self, user_id, applied_batch=None):
+        with self._lock:
+            flushing = self._karma_flushing.get(int(user_id), 0) if self._karma_batch != applied_batch else 0
+            return self._karma_pending.get(int(user_id), 0) + flushing
+
+    def take_pending_karma(self):
+        with self._lock:
+            if self._karma_batch is None and self._karma_pending:
+                self._karma_flushing, self._karma_pending = self._karma_pending, {}
+                self._karma_batch = uuid.uuid4().hex
+            return self._karma_batch, dict(self._karma_flushing)
+
+    def ack_pending_karma(self, batch):
+        with self._lock:
+            if self._karma_batch == batch:
+                self._karma_flushing = {}
+                self._karma_batch = None
@@ -0,0 +1,814 @@
+"""
+Redis storage backend.
+State shared by all the processes lives in redis, changes of the marking state are made atomic by lua scripts.
+Marking state of events is spread over the REDIS_NODES by consistent hashing of event uuids,
+all the keys of an event live on the same node, so scripts can change them together.
+"""
+
+import asyncio
+import functools
+import hashlib
+import threading
+import time
+import uuid
+import weakref
+
+import redis
+import redis.asyncio
+from backend.settings import CHANNEL_LAYERS
+
+from . import scripts
+from .base import StorageBackend, EVENT_KEY_PREFIXES, MARK_ME_PRESENCE_PREFIX, MARKERS_PRESENCE_PREFIX, \
+    connections_key, event_keys, key_event_id, mark_me_presence_key, markers_presence_key
+from .sharding import HashRing
+from ..conf import get_setting
+
+MARKING_KEY_PATTERNS = ["mark_me_*", "ready_to_mark_*", "asked_to_mark_*"]
+
+MARKINGS_STREAM = "markings"
+MARKINGS_GROUP = "markings_persistence"
+
+KARMA_PENDING_KEY = "karma_pending"
+KARMA_FLUSHING_KEY = "karma_flushing"
+KARMA_BATCH_KEY = "karma_flushing_batch"
+
+# Weight of the latest round trip in the moving average of latency
+LATENCY_SMOOTHING = 0.2
+# Seconds a moving average of latency stays valid without new round trips
+LATENCY_WINDOW = 5
+
+
+def redis_nodes():
+    """
+    Returns the redis nodes marking state is spread over.
+    The first node also keeps state not bound to events (pending karma)
+    and serves other purposes, e.g. invalidation of caches.
+    :return: list of addresses, tuples (host, port)
+    """
+
+    nodes = get_setting('REDIS_NODES') or CHANNEL_LAYERS['default']["CONFIG"]['hosts'][:1]
+    return [(host, int(port)) for host, port in nodes]
+
+
+@functools.lru_cache(maxsize=8)
+def _hash_ring(nodes):
+    return HashRing(nodes)
+
+
+def event_node(event_id):
+    """
+    Returns the node keeping marking state of an event.
+    :param event_id: uuid of the event
+    :return: address of the node, tuple (host, port)
+    """
+
+    return _hash_ring(tuple(redis_nodes())).node(str(event_id))
+
+
+def key_node(key):
+    """
+    Returns the node keeping a key.
+    :param key: name of the key
+    :return: address of the node, tuple (host, port)
+    """
+
+    event_id = key_event_id(key)
+    return event_node(event_id) if event_id is not None else redis_nodes()[0]
+
+
+class PoolMetrics(object):
+    """
+    Counters of a connection pool.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Connections taken out of the pool and not returned yet
+        self.in_use = 0
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        # Checkouts given up after REDIS_POOL_TIMEOUT
+        self.pool_timeouts = 0
+        # Commands given up after REDIS_READ_TIMEOUT
+        self.read_timeouts = 0
+        self.retries = 0
+        # Moving average of round trips of commands and the time it was last updated at
+        self.latency_seconds = 0.0
+        self.latency_updated_at = None
+
+        # Connections counted as in use
+        self.connections = set()
+
+    def checked_out(self, connection, wait_seconds):
+        with self.lock:
+            self.connections.add(connection)
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_seconds_total += wait_seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, wait_seconds)
+
+    def checked_in(self, connection):
+        # Pools also release connections that failed to connect and were never handed out
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+                self.in_use -= 1
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def observed(self, seconds):
+        """
+        Records a round trip of a command.
+        :param seconds: time from sending the command to receiving its reply
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            if self.latency_updated_at is None or now - self.latency_updated_at > LATENCY_WINDOW:
+                # The average of an idle pool says nothing about redis now
+                self.latency_seconds = seconds
+            else:
+                self.latency_seconds += LATENCY_SMOOTHING * (seconds - self.latency_seconds)
+            self.latency_updated_at = now
+
+    def latency(self):
+        """
+        :return: moving average of round trips of commands, 0 if no command was sent for LATENCY_WINDOW seconds
+        """
+
+        with self.lock:
+            if self.latency_updated_at is None or time.monotonic() - self.latency_updated_at > LATENCY_WINDOW:
+                return 0.0
+            return self.latency_seconds
+
+    def stats(self, max_connections):
+        with self.lock:
+            return {"in_use": self.in_use,
+                    "max_connections": max_connections,
+                    "utilization": round(self.in_use / max_connections, 3),
+                    "checkouts": self.checkouts,
+                    "wait_ms_avg": round(self.wait_seconds_total * 1000 / self.checkouts, 3) if self.checkouts else 0,
+                    "wait_ms_max": round(self.wait_seconds_max * 1000, 3),
+                    "pool_timeouts": self.pool_timeouts,
+                    "read_timeouts": self.read_timeouts,
+                    "retries": self.retries,
+                    "latency_ms": round(self.latency_seconds * 1000, 3)}
+
+
+# Commands which change nothing when executed again. Only they are retried, a connection error
+# may come after redis has executed a command, e.g. when the connection is dropped before the reply
+IDEMPOTENT_COMMANDS = frozenset([
+    'GET', 'EXISTS', 'TYPE', 'TTL', 'PTTL', 'PING', 'SCAN', 'SMEMBERS', 'SISMEMBER', 'SCARD',
+    'HGET', 'HGETALL', 'ZCARD', 'ZSCORE', 'ZRANGEBYSCORE', 'LRANGE',
+    'SADD', 'SREM', 'HSET', 'HDEL', 'ZADD', 'ZREM', 'DEL', 'UNLINK', 'EXPIRE', 'EXPIREAT', 'SETEX', 'XACK', 'XDEL',
+])
+
+
+def _is_idempotent(args):
+    """
+    :param args: command and its arguments as passed to execute_command
+    :return: True if the command may be retried
+    """
+
+    command = args[0].upper()
+    if command == 'EVALSHA':
+        return scripts.is_idempotent(args[1])
+    if command == 'EVAL':
+        return scripts.is_idempotent(hashlib.sha1(args[1].encode('utf-8')).hexdigest())
+    return command in IDEMPOTENT_COMMANDS
+
+
+def _retry_delays():
+    """
+    :return: seconds to sleep before every retry of a command that failed to reach redis
+    """
+
+    backoff = get_setting('REDIS_RETRY_BACKOFF')
+    return [backoff * 2 ** attempt for attempt in range(get_setting('REDIS_RETRIES'))]
+
+
+class PoolTimeoutError(redis.ConnectionError):
+    """
+    Raised when no connection of the pool gets free in time.
+    """
+
+
+class MeteredAsyncConnectionPool(redis.asyncio.BlockingConnectionPool):
+    """
+    Asynchronous pool that records waits for free connections.
+    Every command takes a connection out of the pool for the time of its round trip,
+    callers wait up to REDIS_POOL_TIMEOUT for a connection when all of them are in use.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    async def get_connection(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except redis.ConnectionError as e:
+            if time.monotonic() - started >= self.timeout:
+                self.metrics.count('pool_timeouts')
+                raise PoolTimeoutError(str(e))
+            raise
+        self.metrics.checked_out(connection, time.monotonic() - started)
+        return connection
+
+    async def release(self, connection):
+        self.metrics.checked_in(connection)
+        await super().release(connection)
+
+    def stats(self):
+        return self.metrics.stats(self.max_connections)
+
+
+class RetryingAsyncRedis(redis.asyncio.Redis):
+    """
+    Asynchronous redis client retrying idempotent commands failing to reach redis
+    REDIS_RETRIES times with exponential backoff.
+    Commands are given up after REDIS_READ_TIMEOUT.
+    """
+
+    async def execute_command(self, *args, **options):
+        metrics = self.connection_pool.metrics
+        retry_delays = _retry_delays() if _is_idempotent(args) else []
+        for delay in retry_delays + [None]:
+            started = time.monotonic()
+            try:
+                result = await super().execute_command(*args, **options)
+                metrics.observed(time.monotonic() - started)
+                return result
+            except redis.TimeoutError:
+                metrics.observed(time.monotonic() - started)
+                metrics.count('read_timeouts')
+                raise
+            except PoolTimeoutError:
+                # Retrying would only make the caller wait longer
+                raise
+            except redis.ConnectionError:
+                if delay is None:
+                    raise
+            metrics.count('retries')
+            await asyncio.sleep(delay)
+
+
+def _pool_options(node):
+    host, port = node
+    return {"host": host, "port": port, "max_connections": get_setting('REDIS_MAX_CONNECTIONS'),
+            "timeout": get_setting('REDIS_POOL_TIMEOUT'),
+            "socket_connect_timeout": get_setting('REDIS_CONNECT_TIMEOUT'),
+            "socket_timeout": get_setting('REDIS_READ_TIMEOUT'),
+            # Connections idle for longer are pinged before use, they may have been dropped by the network silently
+            "health_check_interval": get_setting('REDIS_HEALTH_CHECK_INTERVAL')}
+
+
+class ConnectionPool(object):
+    """
+    Singleton class for asynchronous redis clients.
+    Connections are bound to the event loop they were opened in,
+    so one pool per redis node and running event loop is kept.
+    """
+
+    __clients = weakref.WeakKeyDictionary()
+
+    @classmethod
+    async def get(cls, node=None):
+        """
+        :param node: address of the redis node, the first of REDIS_NODES by default
+        :return: redis.asyncio.Redis instance
+        """
+
+        if node is None:
+            node = redis_nodes()[0]
+        clients = ConnectionPool.__clients.setdefault(asyncio.get_event_loop(), {})
+        client = clients.get(node)
+        if client is None:
+            client = clients.setdefault(node, RetryingAsyncRedis(
+                connection_pool=MeteredAsyncConnectionPool(**_pool_options(node))))
+        return client
+
+    @classmethod
+    def latency(cls, node):
+        """
+        Recent latency of a redis node seen by the pool of the running event loop.
+        :param node: address of the redis node
+        :return: seconds, 0 if unknown
+        """
+
+        client = ConnectionPool.__clients.get(asyncio.get_event_loop(), {}).get(node)
+        return client.connection_pool.metrics.latency() if client is not None else 0.0
+
+    @classmethod
+    def stats(cls):
+        """
+        Counters of the pools of all the event loops.
+        :return: list of dicts
+        """
+
+        return [dict(client.connection_pool.stats(), node="{}:{}".format(*node))
+                for clients in list(ConnectionPool.__clients.values()) for node, client in list(clients.items())]
+
+
+class MeteredBlockingConnectionPool(redis.BlockingConnectionPool):
+    """
+    Synchronous pool that records waits for free connections.
+    Callers wait up to REDIS_POOL_TIMEOUT for a connection when all of them are in use.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def get_connection(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except redis.ConnectionError as e:
+            if time.monotonic() - started >= self.timeout:
+                self.metrics.count('pool_timeouts')
+                raise PoolTimeoutError(str(e))
+            raise
+        self.metrics.checked_out(connection, time.monotonic() - started)
+        return connection
+
+    def release(self, connection):
+        self.metrics.checked_in(connection)
+        super().release(connection)
+
+    def stats(self):
+        return self.metrics.stats(self.max_connections)
+
+
+class RetryingRedis(redis.Redis):
+    """
+    Synchronous redis client retrying idempotent commands failing to reach redis
+    REDIS_RETRIES times with exponential backoff.
+    """
+
+    def execute_command(self, *args, **options):
+        metrics = self.connection_pool.metrics
+        retry_delays = _retry_delays() if _is_idempotent(args) else []
+        for delay in retry_delays + [None]:
+            try:
+                return super().execute_command(*args, **options)
+            except redis.TimeoutError:
+                metrics.count('read_timeouts')
+                raise
+            except PoolTimeoutError:
+                # Retrying would only make the caller wait longer
+                raise
+            except redis.ConnectionError:
+                if delay is None:
+                    raise
+            metrics.count('retries')
+            time.sleep(delay)
+
+
+class SyncConnectionPool(object):
+    """
+    Singleton class for redis connection pools used outside of event loops
+    (views, signal handlers, background threads), one per redis node.
+    """
+
+    __connection_pools = {}
+    __clients = {}
+
+    def __new__(cls, node=None):
+        if node is None:
+            node = redis_nodes()[0]
+        pool = SyncConnectionPool.__connection_pools.get(node)
+        if pool is None:
+            pool = SyncConnectionPool.__connection_pools.setdefault(
+                node, MeteredBlockingConnectionPool(**_pool_options(node)))
+        return pool
+
+    @classmethod
+    def client(cls, node=None):
+        if node is None:
+            node = redis_nodes()[0]
+        client = SyncConnectionPool.__clients.get(node)
+        if client is None:
+            client = SyncConnectionPool.__clients.setdefault(
+                node, RetryingRedis(connection_pool=SyncConnectionPool(node)))
+        return client
+
+    @classmethod
+    def stats(cls):
+        """
+        Counters of the pools of all the redis nodes.
+        :return: list of dicts
+        """
+
+        return [dict(pool.stats(), node="{}:{}".format(*node))
+                for node, pool in list(SyncConnectionPool.__connection_pools.items())]
+
+
+def get_sync_connection(node=None):
+    """
+    Returns the synchronous redis client.
+    :param node: address of the redis node, the first of REDIS_NODES by default
+    :return: redis.Redis instance
+    """
+
+    return SyncConnectionPool.client(node)
+
+
+def pool_stats():
+    """
+    Utilization and wait times of the redis connection pools of the process.
+    :return: dict with counters of the synchronous pools per redis node
+      and of the asynchronous pools per redis node and event loop
+    """
+
+    return {"sync": SyncConnectionPool.stats(),
+            "async": ConnectionPool.stats()}
+
+
+def encode_int(value):
+    """
+    Encodes an integer (e.g. user id) to store it in redis.
+    :param value: an integer to encode
+    :return: encoded value
+    """
+
+    return str(int(value)).encode('utf-8')
+
+
+def decode_int(value):
+    """
+    Decodes an integer stored in redis.
+    :param value: a raw value returned by redis
+    :return: decoded integer
+    """
+
+    return int(value.decode('utf-8'))
+
+
+async def migrate_list_to_set(key, node=None):
+    """
+    Converts a list-based marking key to a set in place.
+    Keys of other types are left untouched.
+    :param key: name of the key
+    :param node: address of the redis node keeping the key, the one owning the key by default
+    :return: number of migrated elements or -1 if the key is not a list
+    """
+
+    r = await ConnectionPool.get(node or key_node(key))
+    return await scripts.MIGRATE_LIST_TO_SET(r, keys=[key])
+
+
+async def migrate_all_lists_to_sets():
+    """
+    Converts all list-based marking keys of all the redis nodes to sets.
+    :return: number of migrated keys
+    """
+
+    migrated = 0
+    for node in redis_nodes():
+        r = await ConnectionPool.get(node)
+        for pattern in MARKING_KEY_PATTERNS:
+            async for key in r.scan_iter(match=pattern):
+                if await migrate_list_to_set(key, node) >= 0:
+                    migrated += 1
+    return migrated
+
+
+def _scan_event_ids(r, count):
+    # SCAN does not block redis
+    for prefix in EVENT_KEY_PREFIXES:
+        for key in r.scan_iter(match=prefix + '*', count=count):
+            event_id = key.decode('utf-8')[len(prefix):]
+            # mark_me_* also matches keys of other prefixes
+            try:
+                yield str(uuid.UUID(event_id))
+            except ValueError:
+                continue
+
+
+def rebalance_event_keys(count=1000, extra_nodes=()):
+    """
+    Moves marking state of events to the nodes owning them after REDIS_NODES have been changed.
+    All the keys of an event are moved by one MIGRATE, so an event is never split between nodes.
+    An event whose keys already exist on its owner node (e.g. written by processes using the new
+    REDIS_NODES before the rebalancing) is left in place, so nothing is overwritten.
+    :param count: number of keys looked through per step of scanning
+    :param extra_nodes: addresses of nodes removed from REDIS_NODES to be emptied
+    :return: tuple (number of moved events, list of uuids of events left in place)
+    """
+
+    moved = 0
+    conflicts = []
+    timeout = int(get_setting('REDIS_READ_TIMEOUT') * 1000)
+    for node in redis_nodes() + [tuple(node) for node in extra_nodes]:
+        r = get_sync_connection(node)
+        for event_id in set(_scan_event_ids(r, count)):
+            owner = event_node(event_id)
+            if owner == node:
+                continue
+            pipe = r.pipeline(transaction=False)
+            for key in event_keys(event_id):
+                pipe.exists(key)
+            keys = [key for key, exists in zip(event_keys(event_id), pipe.execute()) if exists]
+            if not keys:
+                continue
+            try:
+                r.migrate(owner[0], owner[1], keys, 0, timeout)
+            except redis.ResponseError as e:
+                if not str(e).startswith('BUSYKEY'):
+                    raise
+                conflicts.append(event_id)
+                continue
+            moved += 1
+    return moved, conflicts
+
+
+async def _run_on_set(setname, command):
+    """
+    Runs a command on a set.
+    A key still stored as a list by an older version is migrated
+    to a set and the command is retried.
+    """
+
+    try:
+        return await command()
+    except redis.ResponseError as e:
+        if not str(e).startswith('WRONGTYPE'):
+            raise
+    await migrate_list_to_set(setname)
+    return await command()
+
+
+def _stream_entry_id(index, entry_id):
+    """
+    Makes ids of markings unique across the streams of the redis nodes.
+    Ids of the first node are left as is, so they match ids saved before the state was spread over nodes.
+    :param index: index of the node in REDIS_NODES
+    :param entry_id: id of the entry in the stream of the node
+    :return: id of the marking
+    """
+
+    return entry_id if index == 0 else "{}/{}".format(index, entry_id)
+
+
+def _split_stream_entry_id(marking_id):
+    """
+    :param marking_id: id of the marking returned by _stream_entry_id
+    :return: tuple (index of the node in REDIS_NODES, id of the entry in the stream of the node)
+    """
+
+    if '/' not in marking_id:
+        return 0, marking_id
+    index, entry_id = marking_id.split('/', 1)
+    return int(index), entry_id
+
+
+def _marking_keys(event_id):
+    return ["mark_me_{}".format(event_id), "claimed_{}".format(event_id), "leases_{}".format(event_id),
+            "version_{}".format(event_id), "changelog_{}".format(event_id), "pairing_queue_{}".format(event_id)]
+
+
+def _marking_args(*args):
+    return [int(time.time() * 1000), get_setting('CHANGELOG_SIZE')] + list(args)
+
+
+def _decode_changes(changes):
+    """
+    Collapses changelog entries into the resulting changes of the marking list.
+    :param changes: raw changelog entries "<version>:<+ or ->:<user id>"
+    :return: tuple (list of joined user ids, list of left user ids)
+    """
+
+    joined = {}
+    for change in changes:
+        _, op, user_id = change.decode('utf-8').split(':')
+        joined[int(user_id)] = op == '+'
+    return ([user_id for user_id, is_joined in joined.items() if is_joined],
+            [user_id for user_id, is_joined in joined.items() if not is_joined])
+
+
+class RedisStorage(StorageBackend):
+    """
+    Storage shared by all the processes through redis.
+    Markings are appended to a redis stream read by the persistence consumer group.
+    """
+
+    async def add_to_set(self, setname, value):
+        r = await ConnectionPool.get(key_node(setname))
+        return bool(await _run_on_set(setname, lambda: r.sadd(setname, encode_int(value))))
+
+    async def get_set(self, setname):
+        r = await ConnectionPool.get(key_node(setname))
+        return [decode_int(o) for o in await _run_on_set(setname, lambda: r.smembers(setname))]
+
+    async def set_contains(self, setname, value):
+        r = await ConnectionPool.get(key_node(setname))
+        return bool(await _run_on_set(setname, lambda: r.sismember(setname, encode_int(value))))
+
+    async def remove_from_set(self, setname, value):
+        r = await ConnectionPool.get(key_node(setname))
+        return bool(await _run_on_set(setname, lambda: r.srem(setname, encode_int(value))))
+
+    async def get_marking_state(self, event_id, since_version=None):
+        if since_version is None:
+            since_version = -1
+        r = await ConnectionPool.get(event_node(event_id))
+        version, members, released, changes = await scripts.SNAPSHOT(r, keys=_marking_keys(event_id),
+                                                                     args=_marking_args(since_version))
+        if changes is not None:
+            changes = _decode_changes(changes)
+        return version, [decode_int(o) for o in members], [decode_int(o) for o in released], changes
+
+    async def add_user_to_mark(self, event_id, user_id, channel_name, once=False, expire_at=None):
+        keys = _marking_keys(event_id) + ["asked_to_mark_{}".format(event_id),
+                                          "mark_me_channels_{}".format(event_id), mark_me_presence_key(event_id)]
+        args = _marking_args(encode_int(user_id), channel_name, int(once), int(expire_at or 0))
+        r = await ConnectionPool.get(event_node(event_id))
+        added, released, version = await scripts.JOIN(r, keys=keys, args=args)
+        return bool(added) if added >= 0 else None, [decode_int(o) for o in released], version
+
+    async def claim_users(self, event_id, user_ids, marker_id, lease_seconds=None, expire_at=None):
+        if lease_seconds is None:
+            lease_seconds = get_setting('CLAIM_LEASE_SECONDS')
+        args = _marking_args(encode_int(marker_id))
+        args += [args[0] + int(lease_seconds * 1000), int(expire_at or 0)]
+        args += [encode_int(user_id) for user_id in set(user_ids)]
+        r = await ConnectionPool.get(event_node(event_id))
+        claimed, released, version = await scripts.CLAIM(r, keys=_marking_keys(event_id), args=args)
+        return bool(claimed), [decode_int(o) for o in released], version
+
+    async def claim_next_user(self, event_id, marker_id, lease_seconds=None, expire_at=None):
+        if lease_seconds is None:
+            lease_seconds = get_setting('CLAIM_LEASE_SECONDS')
+        args = _marking_args(encode_int(marker_id))
+        args += [args[0] + int(lease_seconds * 1000), int(expire_at or 0)]
+        r = await ConnectionPool.get(event_node(event_id))
+        user_id, released, version = await scripts.CLAIM_NEXT(r, keys=_marking_keys(event_id), args=args)
+        if user_id is not None:
+            user_id = decode_int(user_id)
+        return user_id, [decode_int(o) for o in released], version
+
+    async def confirm_claims(self, event_id, user_ids, marker_id):
+        keys = _marking_keys(event_id) + ["mark_me_channels_{}".format(event_id), MARKINGS_STREAM]
+        args = _marking_args(encode_int(marker_id), str(event_id)) + [encode_int(user_id) for user_id in user_ids]
+        r = await ConnectionPool.get(event_node(event_id))
+        confirmed, released, version, channel_names = await scripts.CONFIRM(r, keys=keys, args=args)
+        confirmed = {decode_int(user_id): channel_name.decode('utf-8') if channel_name is not None else None
+                     for user_id, channel_name in zip(confirmed, channel_names)}
+        return confirmed, [decode_int(o) for o in released], version
+
+    async def release_claims(self, event_id, user_ids, marker_id):
+        args = _marking_args(encode_int(marker_id)) + [encode_int(user_id) for user_id in user_ids]
+        r = await ConnectionPool.get(event_node(event_id))
+        refused, released, version = await scripts.REFUSE(r, keys=_marking_keys(event_id), args=args)
+        return [decode_int(o) for o in refused], [decode_int(o) for o in released], version
+
+    async def forget_mark_me_channel(self, event_id, user_id, channel_name):
+        r = await ConnectionPool.get(event_node(event_id))
+        await scripts.FORGET_CHANNEL(r, keys=["mark_me_channels_{}".format(event_id)],
+                                     args=[encode_int(user_id), channel_name])
+
+    async def touch_presence(self, presence, refresh=False):
+        now = int(time.time() * 1000)
+        pipes = {}
+        for key, user_ids in presence.items():
+            scores = {encode_int(user_id): now for user_id in user_ids}
+            if scores:
+                node = key_node(key)
+                if node not in pipes:
+                    pipes[node] = (await ConnectionPool.get(node)).pipeline(transaction=False)
+                pipes[node].zadd(key, scores, xx=refresh)
+        # Nodes are written to concurrently
+        await asyncio.gather(*[pipe.execute() for pipe in pipes.values()])
+
+    async def remove_presence(self, key, user_id):
+        r = await ConnectionPool.get(key_node(key))
+        await r.zrem(key, encode_int(user_id))
+
+    async def admit_connection(self, event_id, user_id, max_connections, timeout):
+        now = int(time.time() * 1000)
+        r = await ConnectionPool.get(event_node(event_id))
+        return bool(await scripts.ADMIT(r, keys=[connections_key(event_id)],
+                                        args=[now, now - int(timeout * 1000), encode_int(user_id), max_connections]))
+
+    async def get_present_events(self):
+        events = set()
+        for node in redis_nodes():
+            r = await ConnectionPool.get(node)
+            for prefix in (MARK_ME_PRESENCE_PREFIX, MARKERS_PRESENCE_PREFIX):
+                async for key in r.scan_iter(match=prefix + '*'):
+                    events.add(key.decode('utf-8')[len(prefix):])
+        return events
+
+    async def reap_stale_presence(self, event_id, timeout):
+        keys = _marking_keys(event_id) + [mark_me_presence_key(event_id), "mark_me_channels_{}".format(event_id),
+                                          markers_presence_key(event_id)]
+        args = _marking_args()
+        args.append(args[0] - int(timeout * 1000))
+        r = await ConnectionPool.get(event_node(event_id))
+        joined, left, version = await scripts.REAP(r, keys=keys, args=args)
+        return [decode_int(o) for o in joined], [decode_int(o) for o in left], version
+
+    def get_latency(self, event_id):
+        return ConnectionPool.latency(event_node(event_id))
+
+    def expire_event_keys(self, event_id, expire_at):
+        pipe = get_sync_connection(event_node(event_id)).pipeline(transaction=False)
+        for key in event_keys(event_id):
+            pipe.expireat(key, int(expire_at))
+        pipe.execute()
+
+    def purge_event_keys(self, event_ids):
+        pipes = {}
+        for event_id in event_ids:
+            node = event_node(event_id)
+            if node not in pipes:
+                pipes[node] = get_sync_connection(node).pipeline(transaction=False)
+            # Keys are unlinked, so redis reclaims their memory in background
+            pipes[node].unlink(*event_keys(event_id))
+        return sum(sum(pipe.execute()) for pipe in pipes.values())
+
+    def scan_event_ids(self, count=1000):
+        for node in redis_nodes():
+            yield from _scan_event_ids(get_sync_connection(node), count)
+
+    def read_markings(self, consumer, count, block=None):
+        # Every node has its own stream, written by the scripts confirming claims of its events
+        nodes = redis_nodes()
+        if block is not None:
+            # Redis must answer before the socket times out, nodes are waited for in turn
+            block = max(1, min(block, int(get_setting('REDIS_READ_TIMEOUT') * 500) // len(nodes)))
+
+        # Markings read before a crash of the consumer come first, a node without new markings
+        # is waited for only when no other node has them
+        reads = [('0', None), ('>', None)]
+        if block is not None:
+            reads.append(('>', block))
+        for stream_id, wait in reads:
+            for index, node in enumerate(nodes):
+                entries = self._read_stream(get_sync_connection(node), consumer, stream_id, count, wait)
+                if entries:
+                    # Fields of entries deleted from the stream are empty
+                    return [(_stream_entry_id(index, entry_id.decode('utf-8')),
+                             {key.decode('utf-8'): value.decode('utf-8') for key, value in (fields or {}).items()})
+                            for entry_id, fields in entries]
+        return []
+
+    @staticmethod
+    def _read_stream(r, consumer, stream_id, count, block):
+        try:
+            response = r.xreadgroup(MARKINGS_GROUP, consumer, {MARKINGS_STREAM: stream_id}, count=count, block=block)
+        except redis.ResponseError as e:
+            if not str(e).startswith('NOGROUP'):
+                raise
+            # The group is created by the first read from the node, not on every poll
+            try:
+                r.xgroup_create(MARKINGS_STREAM, MARKINGS_GROUP, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if not str(e).startswith('BUSYGROUP'):
+                    raise
+            response = r.xreadgroup(MARKINGS_GROUP, consumer, {MARKINGS_STREAM: stream_id}, count=count, block=block)
+        return response[0][1] if response else []
+
+    def ack_markings(self, entry_ids):
+        by_node = {}
+        for entry_id in entry_ids:
+            index, entry_id = _split_stream_entry_id(entry_id)
+            by_node.setdefault(index, []).append(entry_id)
+        nodes = redis_nodes()
+        for index, node_entry_ids in by_node.items():
+            pipe = get_sync_connection(nodes[index]).pipeline()
+            pipe.xack(MARKINGS_STREAM, MARKINGS_GROUP, *node_entry_ids)
+            pipe.xdel(MARKINGS_STREAM, *node_entry_ids)
+            pipe.execute()
+
+    async def add_karma(self, user_id, delta):
+        r = await ConnectionPool.get()
+        await r.hincrby(KARMA_PENDING_KEY, encode_int(user_id), delta)
+
+    def get_pending_karma(self, user_id, applied_batch=None):
+        # The batch is read along with its changes
+        pipe = get_sync_connection().pipeline()
+        pipe.hget(KARMA_PENDING_KEY, encode_int(user_id))
+        pipe.hget(KARMA_FLUSHING_KEY, encode_int(user_id))
+        pipe.get(KARMA_BATCH_KEY)
+        pending, flushing, batch = pipe.execute()
+        if batch is not None and batch.decode('utf-8') == applied_batch:
+            flushing = None
+        return sum(decode_int(delta) for delta in (pending, flushing) if delta is not None)
+
+    def take_pending_karma(self):
+        batch, deltas = scripts.TAKE_KARMA.run(get_sync_connection(),
+                                               keys=[KARMA_PENDING_KEY, KARMA_FLUSHING_KEY, KARMA_BATCH_KEY],
+                                               args=[uuid.uuid4().hex])
+        if batch is None:
+            return None, {}
+        return batch.decode('utf-8'), {decode_int(deltas[i]): decode_int(deltas[i + 1])
+                                       for i in range(0, len(deltas), 2)}
+
+    def ack_pending_karma(self, batch):
+        scripts.ACK_KARMA.run(get_sync_connection(), keys=[KARMA_FLUSHING_KEY, KARMA_BATCH_KEY], args=[batch])
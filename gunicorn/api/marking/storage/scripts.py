@@ -0,0 +1,365 @@
+"""
+Server-side lua scripts used by the marking storage.
+"""
+
+import hashlib
+
+from redis.exceptions import NoScriptError
+
+# SHA1 digests of the scripts which change nothing when executed again
+_idempotent_shas = set()
+
+
+def is_idempotent(sha):
+    """
+    :param sha: SHA1 digest of a script
+    :return: True if executing the script again changes nothing
+    """
+
+    return sha in _idempotent_shas
+
+
+class Script(object):
+    """
+    Lua script executed by its SHA1 digest.
+    The source is sent to redis only when the script is not cached there yet.
+    Only idempotent scripts are retried by the clients when redis may have executed them already.
+    """
+
+    def __init__(self, source, idempotent=False):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        if idempotent:
+            _idempotent_shas.add(self.sha)
+
+    async def __call__(self, redis, keys=(), args=()):
+        keys_and_args = list(keys) + list(args)
+        try:
+            return await redis.evalsha(self.sha, len(keys), *keys_and_args)
+        except NoScriptError:
+            return await redis.eval(self.source, len(keys), *keys_and_args)
+
+    def run(self, redis, keys=(), args=()):
+        """
+        Executes the script by a synchronous client.
+        """
+
+        keys_and_args = list(keys) + list(args)
+        try:
+            return redis.evalsha(self.sha, len(keys), *keys_and_args)
+        except NoScriptError:
+            return redis.eval(self.source, len(keys), *keys_and_args)
+
+
+MIGRATE_LIST_TO_SET = Script("""
+if redis.call('TYPE', KEYS[1]).ok ~= 'list' then
+    return -1
+end
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+for i = 1, #items do
+    redis.call('SADD', KEYS[1], items[i])
+end
+return #items
+""", idempotent=True)
+
+# Marking scripts share the keys layout:
+# KEYS[1] - mark_me set, KEYS[2] - claimed hash (user id -> marker id),
+# KEYS[3] - leases sorted set (user id scored by lease expiry),
+# KEYS[4] - version of the mark_me set, KEYS[5] - changelog list,
+# KEYS[6] - pairing queue sorted set holding members of mark_me scored by the time they joined,
+# so keeping it costs O(log n) per change.
+# ARGV[1] is always the current time in milliseconds,
+# ARGV[2] is the maximal length of the changelog.
+# Every change of the mark_me set increments the version and appends
+# "<version>:<+ or ->:<user id>" to the changelog, users joining mark_me are also
+# added to the pairing queue and users leaving it are removed from the queue.
+# Every script first returns users with expired leases to the mark_me set
+# and reports them, so the caller can announce them to the markers.
+
+_LOG_CHANGE = """
+local function log_change(op, user_id)
+    if op == '+' then
+        redis.call('ZADD', KEYS[6], ARGV[1], user_id)
+    else
+        redis.call('ZREM', KEYS[6], user_id)
+    end
+    local version = redis.call('INCR', KEYS[4])
+    redis.call('RPUSH', KEYS[5], version .. ':' .. op .. ':' .. user_id)
+    redis.call('LTRIM', KEYS[5], -tonumber(ARGV[2]), -1)
+end
+"""
+
+_RELEASE_EXPIRED = """
+local released = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+for _, user_id in ipairs(released) do
+    redis.call('ZREM', KEYS[3], user_id)
+    redis.call('HDEL', KEYS[2], user_id)
+    if redis.call('SADD', KEYS[1], user_id) == 1 then
+        log_change('+', user_id)
+    end
+end
+"""
+
+_VERSION = """
+local version = tonumber(redis.call('GET', KEYS[4]) or '0')
+"""
+
+
+def _expire(key_count, arg):
+    """
+    Keys expire as they are written, so the state of an event expires even if the sweeper never sees it.
+    :param key_count: number of the first keys to expire
+    :param arg: index of the argument holding the unix timestamp when the keys expire, 0 leaves it as is
+    :return: lua code setting the expiry
+    """
+
+    return """
+if ARGV[{arg}] ~= '0' then
+    for i = 1, {key_count} do
+        redis.call('EXPIREAT', KEYS[i], ARGV[{arg}])
+    end
+end
+""".format(key_count=key_count, arg=arg)
+
+
+# ARGV[3] - version the caller already knows, negative if none.
+# Returns {version, members of mark_me, released, changes}.
+# changes are changelog entries made after the known version
+# or false if they are not in the changelog anymore.
+SNAPSHOT = Script(_LOG_CHANGE + _RELEASE_EXPIRED + _VERSION + """
+local members = redis.call('SMEMBERS', KEYS[1])
+local since = tonumber(ARGV[3])
+if since < 0 or since > version then
+    return {version, members, released, false}
+end
+if since == version then
+    return {version, members, released, {}}
+end
+local first = redis.call('LINDEX', KEYS[5], 0)
+if not first or tonumber(string.match(first, '^%d+')) > since + 1 then
+    return {version, members, released, false}
+end
+local offset = since + 1 - tonumber(string.match(first, '^%d+'))
+return {version, members, released, redis.call('LRANGE', KEYS[5], offset, -1)}
+""")
+
+# KEYS[7] - asked_to_mark set, KEYS[8] - mark_me channels hash (user id -> channel name),
+# KEYS[9] - presence sorted set of users waiting to be marked.
+# ARGV[3] - user id, ARGV[4] - channel name of the user's consumer,
+# ARGV[5] - 1 if the user is refused when he/she has asked to be marked before,
+# ARGV[6] - unix timestamp when the keys expire, 0 to leave it as is.
+# Records a heartbeat of the user along with joining.
+# Returns {1 if added to mark_me, 0 if not, -1 if refused, released, version}.
+JOIN = Script(_LOG_CHANGE + _RELEASE_EXPIRED + """
+local added = 0
+if ARGV[5] == '1' and redis.call('SISMEMBER', KEYS[7], ARGV[3]) == 1 then
+    added = -1
+else
+    redis.call('SADD', KEYS[7], ARGV[3])
+    redis.call('HSET', KEYS[8], ARGV[3], ARGV[4])
+    redis.call('ZADD', KEYS[9], ARGV[1], ARGV[3])
+    if redis.call('HEXISTS', KEYS[2], ARGV[3]) == 0 and redis.call('SADD', KEYS[1], ARGV[3]) == 1 then
+        log_change('+', ARGV[3])
+        added = 1
+    end
+end
+""" + _expire(9, 6) + _VERSION + """
+return {added, released, version}
+""")
+
+# ARGV[3] - marker id, ARGV[4] - lease expiry, ARGV[5] - unix timestamp when the keys expire,
+# 0 to leave it as is, ARGV[6...] - distinct user ids.
+# The users are claimed only if all of them are in the mark_me set.
+# Returns {1 if claimed else 0, released, version}.
+CLAIM = Script(_LOG_CHANGE + _RELEASE_EXPIRED + """
+local claimed = 1
+for i = 6, #ARGV do
+    if redis.call('SISMEMBER', KEYS[1], ARGV[i]) == 0 then
+        claimed = 0
+        break
+    end
+end
+if claimed == 1 then
+    for i = 6, #ARGV do
+        redis.call('SREM', KEYS[1], ARGV[i])
+        log_change('-', ARGV[i])
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[3])
+        redis.call('ZADD', KEYS[3], ARGV[4], ARGV[i])
+    end
+end
+""" + _expire(6, 5) + _VERSION + """
+return {claimed, released, version}
+""")
+
+# ARGV[3] - marker id, ARGV[4] - lease expiry,
+# ARGV[5] - unix timestamp when the keys expire, 0 to leave it as is.
+# Claims the user waiting longest. Users of the mark_me set missing from the queue,
+# e.g. added before the queue existed, are claimed after the queue is empty.
+# Returns {claimed user id or false, released, version}.
+CLAIM_NEXT = Script(_LOG_CHANGE + _RELEASE_EXPIRED + """
+local user_id = redis.call('ZRANGE', KEYS[6], 0, 0)[1]
+if not user_id then
+    user_id = redis.call('SRANDMEMBER', KEYS[1])
+end
+if user_id then
+    redis.call('SREM', KEYS[1], user_id)
+    log_change('-', user_id)
+    redis.call('HSET', KEYS[2], user_id, ARGV[3])
+    redis.call('ZADD', KEYS[3], ARGV[4], user_id)
+end
+""" + _expire(6, 5) + _VERSION + """
+return {user_id, released, version}
+""")
+
+# KEYS[7] - mark_me channels hash, KEYS[8] - markings stream.
+# ARGV[3] - marker id, ARGV[4] - event id, ARGV[5...] - user ids.
+# Every marking is appended to the stream to be saved to the database.
+# Returns {user ids whose claims the marker held, released, version,
+# channel names of the marked users' consumers or false in the same order}.
+# The owner check goes first, so a claim that is past its lease
+# but has not been reclaimed yet can still be confirmed.
+CONFIRM = Script(_LOG_CHANGE + """
+local confirmed = {}
+local channels = {}
+for i = 5, #ARGV do
+    if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[3] then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        redis.call('ZREM', KEYS[3], ARGV[i])
+        redis.call('XADD', KEYS[8], '*', 'event', ARGV[4], 'user', ARGV[i], 'marker', ARGV[3], 'time', ARGV[1])
+        confirmed[#confirmed + 1] = ARGV[i]
+        channels[#channels + 1] = redis.call('HGET', KEYS[7], ARGV[i])
+        redis.call('HDEL', KEYS[7], ARGV[i])
+    end
+end
+""" + _RELEASE_EXPIRED + _VERSION + """
+return {confirmed, released, version, channels}
+""")
+
+# ARGV[3] - marker id, ARGV[4...] - user ids.
+# Returns {user ids whose claims the marker held, released, version}.
+REFUSE = Script(_LOG_CHANGE + """
+local refused = {}
+for i = 4, #ARGV do
+    if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[3] then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        redis.call('ZREM', KEYS[3], ARGV[i])
+        if redis.call('SADD', KEYS[1], ARGV[i]) == 1 then
+            log_change('+', ARGV[i])
+        end
+        refused[#refused + 1] = ARGV[i]
+    end
+end
+""" + _RELEASE_EXPIRED + _VERSION + """
+return {refused, released, version}
+""")
+
+# KEYS[7] - presence sorted set of users waiting to be marked,
+# KEYS[8] - mark_me channels hash, KEYS[9] - presence sorted set of markers.
+# Presence sets hold user ids scored by the time of the last heartbeat.
+# ARGV[3] - heartbeats older than this time are stale.
+# Claims of stale markers are released, then stale users are removed from the marking list.
+# Returns {joined, left, version}.
+REAP = Script(_LOG_CHANGE + _RELEASE_EXPIRED + """
+local joined = {}
+for _, user_id in ipairs(released) do
+    joined[user_id] = true
+end
+
+local stale_markers = {}
+for _, marker_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[9], '-inf', ARGV[3])) do
+    redis.call('ZREM', KEYS[9], marker_id)
+    stale_markers[marker_id] = true
+end
+if next(stale_markers) then
+    local claims = redis.call('HGETALL', KEYS[2])
+    for i = 1, #claims, 2 do
+        if stale_markers[claims[i + 1]] then
+            redis.call('HDEL', KEYS[2], claims[i])
+            redis.call('ZREM', KEYS[3], claims[i])
+            if redis.call('SADD', KEYS[1], claims[i]) == 1 then
+                log_change('+', claims[i])
+                joined[claims[i]] = true
+            end
+        end
+    end
+end
+
+local left = {}
+for _, user_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[7], '-inf', ARGV[3])) do
+    redis.call('ZREM', KEYS[7], user_id)
+    redis.call('HDEL', KEYS[8], user_id)
+    if redis.call('SREM', KEYS[1], user_id) == 1 then
+        log_change('-', user_id)
+        if joined[user_id] then
+            joined[user_id] = nil
+        else
+            left[#left + 1] = user_id
+        end
+    end
+end
+
+local joined_list = {}
+for user_id in pairs(joined) do
+    joined_list[#joined_list + 1] = user_id
+end
+""" + _VERSION + """
+return {joined_list, left, version}
+""")
+
+# KEYS[1] - sorted set of connected users scored by the time of the last heartbeat.
+# ARGV[1] - current time in milliseconds, ARGV[2] - heartbeats older than this time are stale,
+# ARGV[3] - user id, ARGV[4] - maximal number of connected users.
+# Stale users are forgotten, then the user is recorded unless the set is full.
+# Returns 1 if the user is recorded, 0 if not.
+ADMIT = Script("""
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if not redis.call('ZSCORE', KEYS[1], ARGV[3]) and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[3])
+return 1
+""")
+
+# KEYS[1] - mark_me channels hash.
+# ARGV[1] - user id, ARGV[2] - channel name.
+# Removes the channel name of the user if it has not been replaced by another consumer.
+FORGET_CHANNEL = Script("""
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+""", idempotent=True)
+
+# KEYS[1] - pending karma hash (user id -> karma change), KEYS[2] - hash of the batch being written
+# to the database, KEYS[3] - id of the batch being written.
+# ARGV[1] - id of a new batch.
+# Pending changes become a new batch unless the batch taken before has not been acknowledged.
+# Returns {id of the batch or false if nothing is pending, changes of the batch as HGETALL returns them}.
+TAKE_KARMA = Script("""
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return {false, {}}
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('SET', KEYS[3], ARGV[1])
+end
+local batch = redis.call('GET', KEYS[3])
+if not batch then
+    -- Taken before batches had ids
+    batch = ARGV[1]
+    redis.call('SET', KEYS[3], batch)
+end
+return {batch, redis.call('HGETALL', KEYS[2])}
+""", idempotent=True)
+
+# KEYS[1] - hash of the batch being written, KEYS[2] - id of the batch being written.
+# ARGV[1] - id of the written batch.
+# Returns 1 if the batch has been forgotten, 0 if another batch is being written.
+ACK_KARMA = Script("""
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return 1
+end
+return 0
+""", idempotent=True)
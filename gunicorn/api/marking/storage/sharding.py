@@ -0,0 +1,40 @@
+"""
+Consistent hashing of events onto redis nodes.
+"""
+
+import bisect
+import hashlib
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """
+    Consistent hash ring of redis nodes.
+    Every node is placed on the ring at `replicas` points derived from its address,
+    so the placement does not depend on the order of the nodes, and adding or removing a node
+    moves only the events of the arcs the node takes or gives back.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        """
+        :param nodes: addresses of the nodes, tuples (host, port)
+        :param replicas: number of points of every node on the ring
+        """
+
+        points = sorted((_hash("{}:{}-{}".format(host, port, replica)), (host, port))
+                        for host, port in nodes for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key):
+        """
+        Returns the node owning a key.
+        :param key: a string, e.g. uuid of an event
+        :return: address of the node, tuple (host, port)
+        """
+
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.nodes[index]
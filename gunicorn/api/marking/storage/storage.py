@@ -1,53 +1,150 @@
-import redis
-from backend.settings import CHANNEL_LAYERS
+"""
+Storage of the marking subsystem.
+Functions of the module delegate to the backend selected by the STORAGE_BACKEND setting,
+see StorageBackend for their descriptions.
+"""
 
+from django.utils.module_loading import import_string
 
-class ConnectionPool(object):
+from ..conf import get_setting
+from .base import EVENT_KEY_PREFIXES, MARK_ME_PRESENCE_PREFIX, MARKERS_PRESENCE_PREFIX, \
+    connections_key, event_keys, key_event_id, mark_me_presence_key, markers_presence_key
+# Redis connections are also used for purposes other than marking state (e.g. invalidation of caches)
+from .redis_backend import ConnectionPool, SyncConnectionPool, get_sync_connection, redis_nodes
+
+
+class Backend(object):
     """
-    Singleton class for redis connection pool.
+    Singleton class for the storage backend selected by the STORAGE_BACKEND setting.
+    One instance per backend class is kept, so backends keep their state when settings are overridden in tests.
     """
 
-    __connection_pool = None
+    __backends = {}
 
     @classmethod
-    def __new__(cls, *args, **kwargs):
-        if ConnectionPool.__connection_pool is None:
-            host, port = CHANNEL_LAYERS['default']["CONFIG"]['hosts'][0]
-            ConnectionPool.__connection_pool = redis.ConnectionPool(host=host, port=port)
-        return ConnectionPool.__connection_pool
+    def get(cls):
+        path = get_setting('STORAGE_BACKEND')
+        backend = Backend.__backends.get(path)
+        if backend is None:
+            backend = Backend.__backends[path] = import_string(path)()
+        return backend
 
 
-def add_to_list(listname, value):
-    """
-    Insert a value at the list.
-    If a list with name listname does not exist, the new empty list is created before.
-    :param listname: name of the list
-    :param value: a value to insert
-    :return:
-    """
+async def add_to_set(setname, value):
+    return await Backend.get().add_to_set(setname, value)
 
-    r = redis.Redis(connection_pool=ConnectionPool())
-    r.rpush(listname, value)
 
+async def get_set(setname):
+    return await Backend.get().get_set(setname)
 
-def get_list(listname):
-    """
-    Returns all the elements of the list.
-    :param listname: name of the list
-    :return: list with all the elements of requested list
-    """
 
-    r = redis.Redis(connection_pool=ConnectionPool())
-    return r.lrange(listname, 0, r.llen(listname))
+async def set_contains(setname, value):
+    return await Backend.get().set_contains(setname, value)
 
 
-def remove_from_list(listname, value):
-    """
-    Removes an element from the list.
-    :param listname: name of the list
-    :param value: a value to remove
-    :return: number of removed elements
-    """
+async def remove_from_set(setname, value):
+    return await Backend.get().remove_from_set(setname, value)
+
+
+async def get_marking_state(event_id, since_version=None):
+    return await Backend.get().get_marking_state(event_id, since_version)
+
+
+async def get_marking_list(event_id):
+    return await Backend.get().get_marking_list(event_id)
+
+
+async def add_user_to_mark(event_id, user_id, channel_name, once=False, expire_at=None):
+    return await Backend.get().add_user_to_mark(event_id, user_id, channel_name, once, expire_at)
+
+
+async def claim_users(event_id, user_ids, marker_id, lease_seconds=None, expire_at=None):
+    return await Backend.get().claim_users(event_id, user_ids, marker_id, lease_seconds, expire_at)
+
+
+async def claim_user(event_id, user_id, marker_id, lease_seconds=None, expire_at=None):
+    return await Backend.get().claim_user(event_id, user_id, marker_id, lease_seconds, expire_at)
+
+
+async def claim_next_user(event_id, marker_id, lease_seconds=None, expire_at=None):
+    return await Backend.get().claim_next_user(event_id, marker_id, lease_seconds, expire_at)
+
+
+async def confirm_claims(event_id, user_ids, marker_id):
+    return await Backend.get().confirm_claims(event_id, user_ids, marker_id)
+
+
+async def confirm_claim(event_id, user_id, marker_id):
+    return await Backend.get().confirm_claim(event_id, user_id, marker_id)
+
+
+async def release_claims(event_id, user_ids, marker_id):
+    return await Backend.get().release_claims(event_id, user_ids, marker_id)
+
+
+async def release_claim(event_id, user_id, marker_id):
+    return await Backend.get().release_claim(event_id, user_id, marker_id)
+
+
+async def forget_mark_me_channel(event_id, user_id, channel_name):
+    return await Backend.get().forget_mark_me_channel(event_id, user_id, channel_name)
+
+
+async def touch_presence(presence, refresh=False):
+    return await Backend.get().touch_presence(presence, refresh)
+
+
+async def remove_presence(key, user_id):
+    return await Backend.get().remove_presence(key, user_id)
+
+
+async def admit_connection(event_id, user_id, max_connections, timeout):
+    return await Backend.get().admit_connection(event_id, user_id, max_connections, timeout)
+
+
+async def get_present_events():
+    return await Backend.get().get_present_events()
+
+
+async def reap_stale_presence(event_id, timeout):
+    return await Backend.get().reap_stale_presence(event_id, timeout)
+
+
+def get_latency(event_id):
+    return Backend.get().get_latency(event_id)
+
+
+def expire_event_keys(event_id, expire_at):
+    return Backend.get().expire_event_keys(event_id, expire_at)
+
+
+def purge_event_keys(event_ids):
+    return Backend.get().purge_event_keys(event_ids)
+
+
+def scan_event_ids(count=1000):
+    return Backend.get().scan_event_ids(count)
+
+
+def read_markings(consumer, count, block=None):
+    return Backend.get().read_markings(consumer, count, block)
+
+
+def ack_markings(entry_ids):
+    return Backend.get().ack_markings(entry_ids)
+
+
+async def add_karma(user_id, delta):
+    return await Backend.get().add_karma(user_id, delta)
+
+
+def get_pending_karma(user_id, applied_batch=None):
+    return Backend.get().get_pending_karma(user_id, applied_batch)
+
+
+def take_pending_karma():
+    return Backend.get().take_pending_karma()
+
 
-    r = redis.Redis(connection_pool=ConnectionPool())
-    return r.lrem(listname, value, 0)
+def ack_pending_karma(batch):
+    return Backend.get().ack_pending_karma(batch)
@@ -1,13 +1,28 @@
 import asyncio
 import datetime
+import time
+import uuid
 
+import msgpack
 import pytest
+from asgiref.sync import sync_to_async
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth.models import User
 
 from .consumers import MarkingConsumer, MarkMeConsumer
-from .misc.client_communication import ClientResponse, ClientMessages, ErrorMessages, EncouragingMessages
-from ..models import Event, UserProfile
+from .hub import EventHub, UserIdSet
+from .lifecycle import close_event, reclaim_keys
+from .loadtest import LoadTestStats, percentile
+from .persistence import persist_markings
+from .misc.client_communication import ClientResponse, ClientMessages, ErrorMessages, EncouragingMessages, MessageCodes
+from .misc.codecs import JsonCodec, MsgpackCodec, encode_frames, constant_frame
+from .misc.tracing import tracing_enabled
+from .storage import redis_backend, scripts, storage
+from .storage.memory import InMemoryStorage
+from .storage.redis_backend import RedisStorage, pool_stats
+from .storage.sharding import HashRing
+from ..models import Event, Marking, UserProfile
+from ..profile.karma import flush_pending_karma
 
 
 @pytest.mark.django_db(transaction=True)
@@ -111,6 +126,8 @@ class TestConsumer(object):
         await asyncio.sleep(1)
 
         await self.assert_connection_fails(error_msg=ErrorMessages.NOT_PERMITTED)
+        # Other spellings of the uuid are the same event
+        await self.assert_connection_fails(event_id=str(self.event.uuid).upper(), error_msg=ErrorMessages.NOT_PERMITTED)
 
         await communicator.disconnect()
 
@@ -244,10 +261,15 @@ class TestInteraction(object):
         await self.assert_successful_confirm_marking(ready_to_mark_comm)
 
         await asyncio.sleep(1)
+        flush_pending_karma()
 
         profile = UserProfile.objects.filter(user=ready_to_mark_user).first()
         assert karma + EncouragingMessages.general_delta == profile.karma
 
+        while persist_markings("test"):
+            pass
+        assert Marking.objects.filter(event=self.event, user=mark_me_user, marker=ready_to_mark_user).exists()
+
         await self.assert_successful_was_marked(mark_me_comm, ready_to_mark_user.id)
 
     @staticmethod
@@ -305,6 +327,153 @@ class TestInteraction(object):
         assert response == ClientResponse.response_ok(message=ClientMessages.USER_LEFT,
                                                       params={'user_id': left_user_id})
 
+    async def test_reconnect_with_version(self):
+        ready_to_mark_comm = WebsocketCommunicator(
+            MarkingConsumer, "ws/marking?event_id={eid}&since_version=0".format(eid=self.event.uuid))
+        ready_to_mark_comm.scope['user'] = self.ready_to_mark_user
+        connected, _ = await ready_to_mark_comm.connect()
+        assert connected
+
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.MARKING_LIST_DELTA,
+                                                      params={'joined': [], 'left': [], 'version': 0})
+
+        mark_me_comm = await self.connect("mark_me")
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.USER_JOINED,
+                                                      params={'user_id': self.mark_me_user.id, 'version': 1})
+        await ready_to_mark_comm.disconnect()
+
+        ready_to_mark_comm = WebsocketCommunicator(
+            MarkingConsumer, "ws/marking?event_id={eid}&since_version=0".format(eid=self.event.uuid))
+        ready_to_mark_comm.scope['user'] = self.ready_to_mark_user
+        connected, _ = await ready_to_mark_comm.connect()
+        assert connected
+
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.MARKING_LIST_DELTA,
+                                                      params={'joined': [self.mark_me_user.id], 'left': [],
+                                                              'version': 1})
+
+        await mark_me_comm.disconnect()
+        await ready_to_mark_comm.disconnect()
+
+    async def test_msgpack_protocol(self):
+        mark_me_comm = await self.connect("mark_me")
+        await asyncio.sleep(1)
+
+        ready_to_mark_comm = WebsocketCommunicator(MarkingConsumer,
+                                                   "ws/marking?event_id={eid}".format(eid=self.event.uuid),
+                                                   subprotocols=["mv.msgpack"])
+        ready_to_mark_comm.scope['user'] = self.ready_to_mark_user
+        connected, subprotocol = await ready_to_mark_comm.connect()
+        assert connected
+        assert subprotocol == "mv.msgpack"
+
+        response = msgpack.unpackb(await ready_to_mark_comm.receive_from(), raw=False)
+        assert response == [MessageCodes.RESULTS["ok"], MessageCodes.SERVER[ClientMessages.MARKING_LIST],
+                            {"marking_list": [self.mark_me_user.id]}]
+
+        await ready_to_mark_comm.send_to(bytes_data=msgpack.packb(
+            [MessageCodes.CLIENT["prepare_to_mark"], {"user_id": self.mark_me_user.id}], use_bin_type=True))
+        response = msgpack.unpackb(await ready_to_mark_comm.receive_from(), raw=False)
+        assert response == [MessageCodes.RESULTS["ok"], MessageCodes.SERVER[ClientMessages.PREPARED]]
+
+        await ready_to_mark_comm.send_to(bytes_data=b"\xc1")
+        response = msgpack.unpackb(await ready_to_mark_comm.receive_from(), raw=False)
+        assert response == [MessageCodes.RESULTS["error"], ErrorMessages.NO_MESSAGE]
+
+        await mark_me_comm.disconnect()
+        await ready_to_mark_comm.disconnect()
+
+    async def test_pairing(self):
+        mark_me_user1 = create_user("mmu1")
+        self.event.users.add(mark_me_user1)
+        mark_me_comm = await self.connect("mark_me")
+        mark_me_comm1 = await self.connect("mark_me", user=mark_me_user1)
+
+        ready_to_mark_comm = WebsocketCommunicator(
+            MarkingConsumer, "ws/marking?event_id={eid}&pairing=1".format(eid=self.event.uuid))
+        ready_to_mark_comm.scope['user'] = self.ready_to_mark_user
+        connected, _ = await ready_to_mark_comm.connect()
+        assert connected
+        assert await ready_to_mark_comm.receive_nothing(timeout=1)
+
+        await ready_to_mark_comm.send_json_to({"message": "next_student"})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.PREPARED, params={'user_id': self.mark_me_user.id})
+
+        await self.assert_successful_refuse_to_mark(ready_to_mark_comm)
+
+        # The refused student waits behind the others
+        await ready_to_mark_comm.send_json_to({"message": "next_student"})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.PREPARED, params={'user_id': mark_me_user1.id})
+        await self.assert_successful_confirm_marking(ready_to_mark_comm)
+        await self.assert_successful_was_marked(mark_me_comm1, self.ready_to_mark_user.id)
+
+        await mark_me_comm.disconnect()
+        await mark_me_comm1.disconnect()
+        await ready_to_mark_comm.disconnect()
+
+    async def test_close_event_with_pairing_marker(self):
+        mark_me_comm = await self.connect("mark_me")
+        ready_to_mark_comm = WebsocketCommunicator(
+            MarkingConsumer, "ws/marking?event_id={eid}&pairing=1".format(eid=self.event.uuid))
+        ready_to_mark_comm.scope['user'] = self.ready_to_mark_user
+        connected, _ = await ready_to_mark_comm.connect()
+        assert connected
+
+        await sync_to_async(close_event)(self.event.uuid)
+        for communicator in (mark_me_comm, ready_to_mark_comm):
+            response = await communicator.receive_json_from()
+            assert response == ClientResponse.response_error(ErrorMessages.PAST_EVENT)
+            response = await communicator.receive_output()
+            assert response['type'] == 'websocket.close'
+            await communicator.disconnect()
+
+    async def test_batch_marking(self):
+        mark_me_user1 = create_user("mmu1")
+        self.event.users.add(mark_me_user1)
+        mark_me_comm = await self.connect("mark_me")
+        mark_me_comm1 = await self.connect("mark_me", user=mark_me_user1)
+
+        ready_to_mark_comm = WebsocketCommunicator(
+            MarkingConsumer, "ws/marking?event_id={eid}&pairing=1".format(eid=self.event.uuid))
+        ready_to_mark_comm.scope['user'] = self.ready_to_mark_user
+        connected, _ = await ready_to_mark_comm.connect()
+        assert connected
+
+        user_ids = [self.mark_me_user.id, mark_me_user1.id]
+        await ready_to_mark_comm.send_json_to({"message": "prepare_to_mark_batch",
+                                               "params": {"user_ids": user_ids + [0]}})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_error(ErrorMessages.USER_ALREADY_CHOSEN)
+
+        for invalid_ids in ([str(self.mark_me_user.id)], user_ids + [[0]], user_ids + [True]):
+            await ready_to_mark_comm.send_json_to({"message": "prepare_to_mark_batch",
+                                                   "params": {"user_ids": invalid_ids}})
+            response = await ready_to_mark_comm.receive_json_from()
+            assert response == ClientResponse.response_error(ErrorMessages.INVALID_BATCH)
+        await ready_to_mark_comm.send_json_to({"message": "prepare_to_mark", "params": {"user_id": "0"}})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_error(ErrorMessages.USER_ALREADY_CHOSEN)
+
+        await ready_to_mark_comm.send_json_to({"message": "prepare_to_mark_batch", "params": {"user_ids": user_ids}})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.PREPARED, params={'user_ids': user_ids})
+
+        await ready_to_mark_comm.send_json_to({"message": "confirm_marking_batch"})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response.get('message') == ClientMessages.MARKED
+        assert set(response.get('params').get('user_ids')) == set(user_ids)
+        await self.assert_successful_was_marked(mark_me_comm, self.ready_to_mark_user.id)
+        await self.assert_successful_was_marked(mark_me_comm1, self.ready_to_mark_user.id)
+
+        await mark_me_comm.disconnect()
+        await mark_me_comm1.disconnect()
+        await ready_to_mark_comm.disconnect()
+
     async def test_mark_me_first(self):
         mark_me_comm = await self.connect("mark_me")
 
@@ -434,3 +603,520 @@ class TestInteraction(object):
         await ready_to_mark_comm1.disconnect()
         await ready_to_mark_comm2.disconnect()
         await mark_me_comm.disconnect()
+
+    async def test_shared_hub(self):
+        ready_to_mark_user1 = create_user("rtmu1")
+        self.event.users.add(ready_to_mark_user1)
+        ready_to_mark_comm1 = await self.connect("ready_to_mark", user=ready_to_mark_user1)
+        ready_to_mark_comm2 = await self.connect("ready_to_mark")
+        await self.assert_valid_marking_list(ready_to_mark_comm1, [])
+        await self.assert_valid_marking_list(ready_to_mark_comm2, [])
+
+        stats = [hub for hub in EventHub.stats() if hub['event_id'] == str(self.event.uuid)]
+        assert len(stats) == 1
+        assert stats[0]['consumers'] == 2
+
+        await ready_to_mark_comm1.disconnect()
+        await ready_to_mark_comm2.disconnect()
+        assert not [hub for hub in EventHub.stats() if hub['event_id'] == str(self.event.uuid)]
+
+    async def test_message_rate_limit(self, settings):
+        settings.MARKING = {'MESSAGE_RATE': 1, 'MESSAGE_BURST': 1, 'USER_MESSAGE_RATE': 0}
+        ready_to_mark_comm = await self.connect("ready_to_mark")
+        await self.assert_valid_marking_list(ready_to_mark_comm, [])
+
+        await ready_to_mark_comm.send_json_to({"message": "refuse_to_mark"})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_error(ErrorMessages.NOT_PERMITTED)
+
+        await ready_to_mark_comm.send_json_to({"message": "refuse_to_mark"})
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response['message'] == ErrorMessages.TOO_MANY_MESSAGES
+        assert 0 < response['params']['retry_after'] <= 1
+
+        await ready_to_mark_comm.disconnect()
+
+    async def test_event_max_connections(self, settings):
+        settings.MARKING = {'EVENT_MAX_CONNECTIONS': 1}
+        # The user asking to be marked takes the only place
+        mark_me_comm = await self.connect("mark_me")
+
+        ready_to_mark_comm = await self.connect("ready_to_mark")
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response['message'] == ErrorMessages.EVENT_FULL
+        assert response['params']['retry_after'] == 5
+        response = await ready_to_mark_comm.receive_output()
+        assert response['type'] == 'websocket.close'
+        await ready_to_mark_comm.disconnect()
+
+        # The place is freed as soon as the user disconnects, though his/her presence is still recorded
+        await mark_me_comm.disconnect()
+        ready_to_mark_comm = await self.connect("ready_to_mark")
+        await self.assert_valid_marking_list(ready_to_mark_comm, [self.mark_me_user.id])
+        await ready_to_mark_comm.disconnect()
+
+
+@pytest.mark.asyncio
+class TestRedisStorage(object):
+    async def test_list_migration(self):
+        listname = "mark_me_test_list_migration"
+        r = await storage.ConnectionPool.get(redis_backend.key_node(listname))
+        await r.delete(listname)
+        await r.rpush(listname, 1, 2, 2)
+
+        assert await redis_backend.migrate_list_to_set(listname) == 3
+        assert await redis_backend.migrate_list_to_set(listname) == -1
+        assert set(await storage.get_set(listname)) == {1, 2}
+
+        await r.delete(listname)
+
+    async def test_lazy_migration(self):
+        listname = "mark_me_test_lazy_migration"
+        r = await storage.ConnectionPool.get(redis_backend.key_node(listname))
+        await r.delete(listname)
+        await r.rpush(listname, 1)
+
+        assert await storage.set_contains(listname, 1)
+        assert await r.type(listname) == b'set'
+
+        await r.delete(listname)
+
+
+class TestRedisPools(object):
+    def test_idempotent_commands(self):
+        assert redis_backend._is_idempotent(('GET', 'version_1'))
+        assert not redis_backend._is_idempotent(('HINCRBY', 'karma_pending', 1, 5))
+        assert redis_backend._is_idempotent(('EVALSHA', scripts.ACK_KARMA.sha, 2))
+        assert redis_backend._is_idempotent(('EVAL', scripts.ACK_KARMA.source, 2))
+        # Claims and markings must not be made twice
+        for script in (scripts.CLAIM, scripts.CLAIM_NEXT, scripts.CONFIRM):
+            assert not redis_backend._is_idempotent(('EVALSHA', script.sha, 6))
+            assert not redis_backend._is_idempotent(('EVAL', script.source, 6))
+
+    def test_pool_stats(self):
+        r = storage.get_sync_connection()
+        assert r is storage.get_sync_connection()
+        assert r.ping()
+
+        node = "{}:{}".format(*redis_backend.redis_nodes()[0])
+        stats, = [stats for stats in pool_stats()['sync'] if stats['node'] == node]
+        assert stats['in_use'] == 0
+        assert stats['checkouts'] >= 1
+        assert stats['max_connections'] == 50
+
+
+class TestSharding(object):
+    nodes = [("redis-1", 6379), ("redis-2", 6379), ("redis-3", 6379)]
+
+    def test_hash_ring(self):
+        event_ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, str(i))) for i in range(3000)]
+        ring = HashRing(self.nodes)
+        placement = {event_id: ring.node(event_id) for event_id in event_ids}
+        assert placement == {event_id: HashRing(reversed(self.nodes)).node(event_id) for event_id in event_ids}
+        for node in self.nodes:
+            assert 700 < list(placement.values()).count(node) < 1300
+
+        # Only events taken by the new node move
+        ring = HashRing(self.nodes + [("redis-4", 6379)])
+        moved = [event_id for event_id in event_ids if ring.node(event_id) != placement[event_id]]
+        assert 500 < len(moved) < 1000
+        assert all(ring.node(event_id) == ("redis-4", 6379) for event_id in moved)
+
+    def test_event_keys_colocated(self, settings):
+        settings.MARKING = {'REDIS_NODES': self.nodes}
+        event_id = uuid.uuid5(uuid.NAMESPACE_URL, "test_event_keys_colocated")
+        assert {redis_backend.key_node(key) for key in storage.event_keys(event_id)} == \
+            {redis_backend.event_node(event_id)}
+        assert redis_backend.key_node(redis_backend.KARMA_PENDING_KEY) == self.nodes[0]
+        assert storage.key_event_id("mark_me_channels_{}".format(event_id)) == str(event_id)
+
+
+@pytest.mark.asyncio
+class TestStorageConformance(object):
+    """
+    Behaviour every storage backend must have.
+    """
+
+    @pytest.fixture(params=[RedisStorage, InMemoryStorage], ids=["redis", "memory"])
+    def backend(self, request):
+        return request.param()
+
+    @staticmethod
+    def event_id(name):
+        # Events of the tests are purged by uuid
+        return str(uuid.uuid5(uuid.NAMESPACE_OID, name))
+
+    async def test_set_operations(self, backend):
+        event_id = self.event_id("test_set_operations")
+        setname = "asked_to_mark_{}".format(event_id)
+        backend.purge_event_keys([event_id])
+
+        assert await backend.add_to_set(setname, 1)
+        assert not await backend.add_to_set(setname, 1)
+        assert await backend.add_to_set(setname, 2)
+        assert await backend.set_contains(setname, 2)
+        assert set(await backend.get_set(setname)) == {1, 2}
+
+        assert await backend.remove_from_set(setname, 2)
+        assert not await backend.remove_from_set(setname, 2)
+        assert not await backend.set_contains(setname, 2)
+
+        assert list(backend.scan_event_ids()).count(event_id) >= 1
+        assert backend.purge_event_keys([event_id]) == 1
+        assert event_id not in set(backend.scan_event_ids())
+
+    async def test_claim_lease(self, backend):
+        event_id = self.event_id("test_claim_lease")
+        backend.purge_event_keys([event_id])
+        await backend.add_user_to_mark(event_id, 1, "channel_1")
+
+        claimed, _, _ = await backend.claim_user(event_id, 1, 2)
+        assert claimed
+        claimed, _, _ = await backend.claim_user(event_id, 1, 3)
+        assert not claimed
+        confirmed, _, _, _ = await backend.confirm_claim(event_id, 1, 3)
+        assert not confirmed
+        refused, _, _ = await backend.release_claim(event_id, 1, 2)
+        assert refused
+        assert (await backend.get_marking_list(event_id)) == ([1], [])
+
+        claimed, _, _ = await backend.claim_user(event_id, 1, 2, lease_seconds=0)
+        assert claimed
+        await asyncio.sleep(0.01)
+        assert (await backend.get_marking_list(event_id)) == ([1], [1])
+        confirmed, _, _, _ = await backend.confirm_claim(event_id, 1, 2)
+        assert not confirmed
+
+        backend.purge_event_keys([event_id])
+
+    async def test_add_user_to_mark_once(self, backend):
+        event_id = self.event_id("test_add_user_to_mark_once")
+        backend.purge_event_keys([event_id])
+
+        assert await backend.add_user_to_mark(event_id, 1, "channel_1", once=True) == (True, [], 1)
+        assert event_id in await backend.get_present_events()
+        assert await backend.add_user_to_mark(event_id, 1, "channel_2", once=True) == (None, [], 1)
+        assert await backend.add_user_to_mark(event_id, 1, "channel_2") == (False, [], 1)
+
+        backend.purge_event_keys([event_id])
+
+    async def test_claim_all_or_nothing(self, backend):
+        event_id = self.event_id("test_claim_all_or_nothing")
+        backend.purge_event_keys([event_id])
+        for user_id in (1, 2, 3):
+            await backend.add_user_to_mark(event_id, user_id, "channel_{}".format(user_id))
+
+        assert await backend.claim_users(event_id, [1, 4], 5) == (False, [], 3)
+        assert await backend.claim_users(event_id, [1, 2], 5) == (True, [], 5)
+        assert await backend.claim_next_user(event_id, 6) == (3, [], 6)
+        assert await backend.claim_next_user(event_id, 6) == (None, [], 6)
+        assert await backend.release_claims(event_id, [1, 2, 3], 5) == ([1, 2], [], 8)
+        confirmed, _, version = await backend.confirm_claims(event_id, [3], 6)
+        assert (confirmed, version) == ({3: "channel_3"}, 8)
+
+        backend.purge_event_keys([event_id])
+
+    async def test_marking_state_versions(self, backend, settings):
+        settings.MARKING = {'CHANGELOG_SIZE': 2}
+        event_id = self.event_id("test_marking_state_versions")
+        backend.purge_event_keys([event_id])
+
+        assert await backend.add_user_to_mark(event_id, 1, "channel_1") == (True, [], 1)
+        assert await backend.add_user_to_mark(event_id, 2, "channel_2") == (True, [], 2)
+        assert await backend.claim_user(event_id, 1, 3) == (True, [], 3)
+        assert await backend.add_user_to_mark(event_id, 1, "channel_1") == (False, [], 3)
+
+        version, members, _, changes = await backend.get_marking_state(event_id)
+        assert (version, members, changes) == (3, [2], None)
+
+        _, _, _, changes = await backend.get_marking_state(event_id, since_version=1)
+        assert changes == ([2], [1])
+
+        _, _, _, changes = await backend.get_marking_state(event_id, since_version=3)
+        assert changes == ([], [])
+
+        # The first change is not in the changelog anymore
+        _, _, _, changes = await backend.get_marking_state(event_id, since_version=0)
+        assert changes is None
+
+        assert await backend.confirm_claim(event_id, 1, 3) == (True, [], 3, "channel_1")
+
+        backend.purge_event_keys([event_id])
+
+    async def test_reap_stale_presence(self, backend):
+        event_id = self.event_id("test_reap_stale_presence")
+        backend.purge_event_keys([event_id])
+
+        await backend.touch_presence({storage.mark_me_presence_key(event_id): [1, 2],
+                                      storage.markers_presence_key(event_id): [3]})
+        assert event_id in await backend.get_present_events()
+        await backend.add_user_to_mark(event_id, 1, "channel_1")
+        await backend.add_user_to_mark(event_id, 2, "channel_2")
+        await backend.claim_user(event_id, 2, 3)
+        assert await backend.reap_stale_presence(event_id, timeout=60) == ([], [], 3)
+
+        await asyncio.sleep(0.01)
+        await backend.touch_presence({storage.mark_me_presence_key(event_id): [2]})
+        # User 1 is gone, the claim of gone marker 3 is released
+        assert await backend.reap_stale_presence(event_id, timeout=0.005) == ([2], [1], 5)
+        assert (await backend.get_marking_list(event_id)) == ([2], [])
+
+        await backend.remove_presence(storage.mark_me_presence_key(event_id), 2)
+        assert event_id not in await backend.get_present_events()
+
+        backend.purge_event_keys([event_id])
+
+    async def test_admit_connection(self, backend):
+        event_id = self.event_id("test_admit_connection")
+        backend.purge_event_keys([event_id])
+
+        # A burst of connections does not overshoot the limit
+        admitted = await asyncio.gather(*[backend.admit_connection(event_id, user_id, 2, timeout=60)
+                                          for user_id in range(1, 6)])
+        assert admitted.count(True) == 2
+        assert await backend.admit_connection(event_id, admitted.index(True) + 1, 2, timeout=60)
+
+        await backend.remove_presence(storage.connections_key(event_id), admitted.index(True) + 1)
+        assert await backend.admit_connection(event_id, 6, 2, timeout=60)
+        assert not await backend.admit_connection(event_id, 7, 2, timeout=60)
+        # Users of stale connections are forgotten
+        await asyncio.sleep(0.01)
+        assert await backend.admit_connection(event_id, 7, 2, timeout=0.005)
+
+        backend.purge_event_keys([event_id])
+
+    async def test_refresh_presence_after_purge(self, backend):
+        event_id = self.event_id("test_refresh_presence_after_purge")
+        backend.purge_event_keys([event_id])
+
+        await backend.touch_presence({storage.mark_me_presence_key(event_id): [1],
+                                      storage.markers_presence_key(event_id): [3]})
+        assert await backend.admit_connection(event_id, 1, 2, timeout=60)
+        await backend.touch_presence({storage.connections_key(event_id): [1, 2]}, refresh=True)
+        # User 2 has not been recorded, so there is a place left
+        assert await backend.admit_connection(event_id, 3, 2, timeout=60)
+
+        backend.purge_event_keys([event_id])
+        # Heartbeats of connections to the closed event do not recreate its state
+        await backend.touch_presence({storage.mark_me_presence_key(event_id): [1],
+                                      storage.markers_presence_key(event_id): [3]}, refresh=True)
+        await backend.release_claims(event_id, [1], 3)
+        await backend.forget_mark_me_channel(event_id, 1, "channel_1")
+        await backend.remove_presence(storage.markers_presence_key(event_id), 3)
+        assert event_id not in await backend.get_present_events()
+        assert event_id not in set(backend.scan_event_ids())
+
+    async def test_markings(self, backend):
+        event_id = self.event_id("test_markings")
+        backend.purge_event_keys([event_id])
+        await backend.add_user_to_mark(event_id, 1, "channel_1")
+        await backend.claim_user(event_id, 1, 2)
+        await backend.confirm_claim(event_id, 1, 2)
+
+        entries = backend.read_markings("test_markings", count=1000)
+        markings = [fields for _, fields in entries if fields.get('event') == event_id]
+        assert [(fields['user'], fields['marker']) for fields in markings] == [('1', '2')]
+        # Unacknowledged markings are delivered again
+        assert backend.read_markings("test_markings", count=1000) == entries
+
+        backend.ack_markings([entry_id for entry_id, _ in entries])
+        assert not [fields for _, fields in backend.read_markings("test_markings", count=1000)
+                    if fields.get('event') == event_id]
+
+        backend.purge_event_keys([event_id])
+
+    async def test_expire_event_keys(self, backend):
+        event_id = self.event_id("test_expire_event_keys")
+        backend.purge_event_keys([event_id])
+        await backend.add_user_to_mark(event_id, 1, "channel_1")
+
+        backend.expire_event_keys(event_id, time.time() - 1)
+        assert (await backend.get_marking_list(event_id)) == ([], [])
+
+        backend.purge_event_keys([event_id])
+
+    async def test_expire_on_write(self, backend):
+        event_id = self.event_id("test_expire_on_write")
+        backend.purge_event_keys([event_id])
+        await backend.add_user_to_mark(event_id, 1, "channel_1")
+        await backend.add_user_to_mark(event_id, 2, "channel_2", expire_at=time.time() - 1)
+        assert (await backend.get_marking_list(event_id)) == ([], [])
+
+        await backend.add_user_to_mark(event_id, 1, "channel_1")
+        await backend.add_user_to_mark(event_id, 2, "channel_2")
+        await backend.claim_user(event_id, 1, 3, expire_at=time.time() - 1)
+        assert (await backend.get_marking_list(event_id)) == ([], [])
+
+        await backend.add_user_to_mark(event_id, 1, "channel_1")
+        await backend.claim_next_user(event_id, 3, expire_at=time.time() - 1)
+        assert (await backend.get_marking_list(event_id)) == ([], [])
+
+        backend.purge_event_keys([event_id])
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+class TestBatchedInteraction(TestInteraction):
+    @pytest.fixture(autouse=True)
+    def batch_broadcasts(self, settings):
+        settings.MARKING = {'BATCH_BROADCASTS': True, 'BATCH_WINDOW': 0.5, 'BATCH_MAX_SIZE': 200}
+
+    @staticmethod
+    async def assert_valid_delta(ready_to_mark_comm, joined, left):
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response.get('result') == 'ok'
+        assert response.get('message') == ClientMessages.MARKING_LIST_DELTA
+        assert set(response.get('params').get('joined')) == set(joined)
+        assert set(response.get('params').get('left')) == set(left)
+
+    async def test_ready_to_mark_first(self):
+        ready_to_mark_comm = await self.connect("ready_to_mark")
+        await self.assert_valid_marking_list(ready_to_mark_comm, [])
+
+        mark_me_user1 = create_user("mmu1")
+        self.event.users.add(mark_me_user1)
+        mark_me_comm1 = await self.connect("mark_me", user=mark_me_user1)
+        mark_me_comm2 = await self.connect("mark_me")
+
+        await self.assert_valid_delta(ready_to_mark_comm, joined=[self.mark_me_user.id, mark_me_user1.id], left=[])
+        assert await ready_to_mark_comm.receive_nothing(timeout=1)
+
+        await mark_me_comm1.disconnect()
+        await mark_me_comm2.disconnect()
+        await ready_to_mark_comm.disconnect()
+
+    async def test_several_ready_to_mark(self):
+        ready_to_mark_user1 = create_user("rtmu1")
+        self.event.users.add(ready_to_mark_user1)
+        ready_to_mark_comm1 = await self.connect("ready_to_mark", user=ready_to_mark_user1)
+        ready_to_mark_comm2 = await self.connect("ready_to_mark")
+
+        await self.assert_valid_marking_list(ready_to_mark_comm1, [])
+        await self.assert_valid_marking_list(ready_to_mark_comm2, [])
+
+        mark_me_comm = await self.connect("mark_me")
+        await self.assert_valid_delta(ready_to_mark_comm1, joined=[self.mark_me_user.id], left=[])
+        await self.assert_valid_delta(ready_to_mark_comm2, joined=[self.mark_me_user.id], left=[])
+
+        await self.assert_successful_prepare_to_mark(ready_to_mark_comm1, self.mark_me_user.id)
+        await self.assert_valid_delta(ready_to_mark_comm2, joined=[], left=[self.mark_me_user.id])
+        # Batches do not keep senders, so the marker is told about its own claim too
+        await self.assert_valid_delta(ready_to_mark_comm1, joined=[], left=[self.mark_me_user.id])
+
+        await ready_to_mark_comm1.disconnect()
+        await ready_to_mark_comm2.disconnect()
+        await mark_me_comm.disconnect()
+
+    async def test_reconnect_with_version(self):
+        ready_to_mark_comm = WebsocketCommunicator(
+            MarkingConsumer, "ws/marking?event_id={eid}&since_version=0".format(eid=self.event.uuid))
+        ready_to_mark_comm.scope['user'] = self.ready_to_mark_user
+        connected, _ = await ready_to_mark_comm.connect()
+        assert connected
+
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.MARKING_LIST_DELTA,
+                                                      params={'joined': [], 'left': [], 'version': 0})
+
+        mark_me_comm = await self.connect("mark_me")
+        response = await ready_to_mark_comm.receive_json_from()
+        assert response == ClientResponse.response_ok(ClientMessages.MARKING_LIST_DELTA,
+                                                      params={'joined': [self.mark_me_user.id], 'left': [],
+                                                              'version': 1})
+
+        await mark_me_comm.disconnect()
+        await ready_to_mark_comm.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+class TestLifecycle(object):
+    def test_reclaim_keys(self):
+        creator = create_user("lifecycle_test_user")
+        now = datetime.datetime.utcnow()
+        running_event = create_event(creator, name="running event")
+        finished_event = create_event(creator, time_from=now - datetime.timedelta(days=2),
+                                      time_to=now - datetime.timedelta(days=1), name="finished event")
+        deleted_event_id = "01234567-89ab-cdef-0123-456789abcdef"
+
+        def r(event_id):
+            return storage.get_sync_connection(redis_backend.event_node(event_id))
+
+        for event_id in (running_event.uuid, finished_event.uuid, deleted_event_id):
+            r(event_id).sadd("mark_me_{}".format(event_id), 1)
+            r(event_id).incr("version_{}".format(event_id))
+
+        assert reclaim_keys(chunk_size=1, pause=0) >= 4
+        assert not r(finished_event.uuid).exists("mark_me_{}".format(finished_event.uuid))
+        assert not r(deleted_event_id).exists("version_{}".format(deleted_event_id))
+        assert r(running_event.uuid).exists("mark_me_{}".format(running_event.uuid),
+                                            "version_{}".format(running_event.uuid)) == 2
+        storage.purge_event_keys([running_event.uuid])
+
+    def test_expire_event_keys(self):
+        event_id = "test_expire_event_keys"
+        r = storage.get_sync_connection(redis_backend.event_node(event_id))
+        r.sadd("mark_me_{}".format(event_id), 1)
+        storage.expire_event_keys(event_id, time.time() + 60)
+        assert 0 < r.ttl("mark_me_{}".format(event_id)) <= 60
+        storage.purge_event_keys([event_id])
+
+
+class TestTracing(object):
+    def test_tracing_enabled(self, settings):
+        settings.MARKING = {'TRACE_EVENTS': ['traced'], 'TRACE_SAMPLE_RATE': 0}
+        assert tracing_enabled('traced')
+        assert not tracing_enabled('not traced')
+
+        settings.MARKING = {'TRACE_EVENTS': [], 'TRACE_SAMPLE_RATE': 1}
+        assert tracing_enabled('not traced')
+
+
+class TestUserIdSet(object):
+    def test_operations(self):
+        user_ids = UserIdSet([5, 1, 3, 1])
+        assert list(user_ids) == [1, 3, 5]
+        assert user_ids.add(2)
+        assert not user_ids.add(2)
+        assert user_ids.discard(1)
+        assert not user_ids.discard(1)
+        assert 2 in user_ids and 1 not in user_ids
+        assert list(user_ids) == [2, 3, 5]
+        assert user_ids.nbytes() >= 3 * 8
+
+
+class TestCodecs(object):
+    def test_encode_frames(self):
+        response = ClientResponse.response_ok(ClientMessages.USER_JOINED, params={'user_id': 1})
+        frames = encode_frames(response)
+        assert JsonCodec.decode(**frames[JsonCodec.name]) == response
+        assert msgpack.unpackb(frames[MsgpackCodec.name]['bytes_data'], raw=False) == \
+            [MessageCodes.RESULTS['ok'], MessageCodes.SERVER[ClientMessages.USER_JOINED], {'user_id': 1}]
+
+    def test_decode_invalid_msgpack_frames(self):
+        for frame in ([], [[1]], [{'message': 1}], [True], {'message': 1}):
+            assert MsgpackCodec.decode(bytes_data=msgpack.packb(frame, use_bin_type=True)) is None
+        assert MsgpackCodec.decode(bytes_data=b'\xc1') is None
+
+    def test_constant_frame(self):
+        frame = constant_frame(JsonCodec, 'ok', ClientMessages.PREPARED)
+        assert frame is constant_frame(JsonCodec, 'ok', ClientMessages.PREPARED)
+        assert JsonCodec.decode(**frame) == ClientResponse.response_ok(ClientMessages.PREPARED)
+
+
+class TestLoadTestStats(object):
+    def test_report(self):
+        assert percentile([], 0.5) is None
+        assert percentile([3, 1, 2], 0.5) == 2
+        assert percentile([3, 1, 2], 0.99) == 3
+
+        stats = LoadTestStats()
+        stats.connect_latencies = [0.001, 0.002]
+        stats.add_latency("prepare_to_mark", 0.004)
+        stats.frames = 10
+        stats.markings = 2
+        report = stats.report(elapsed=2, redis_ops=30)
+        assert report["connect"]["count"] == 2
+        assert report["messages"]["prepare_to_mark"]["p50_ms"] == 4
+        assert report["frames_per_second"] == 5
+        assert report["redis_ops_per_marking"] == 15
+
@@ -0,0 +1,7 @@
+from django.urls import path
+
+from . import views
+
+urlpatterns = [
+    path('GetStats', views.marking_stats, name='get_marking_stats'),
+]
@@ -0,0 +1,25 @@
+from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_GET
+
+from .hub import EventHub
+from .storage.redis_backend import pool_stats
+from ..events.cache import event_cache
+from ..misc.http_decorators import require_content_type
+from ..misc.response import APINotPermittedResponse, APIResponse
+
+
+@require_content_type('json')
+@require_GET
+@login_required
+def marking_stats(request):
+    """
+    Memory and fan-out counters of the event hubs, the event cache and utilization of the redis connection pools
+    of the process serving the request.
+    Available to staff only.
+    """
+
+    if not request.user.is_staff:
+        return APINotPermittedResponse(error_msg="Staff only")
+    return APIResponse(response={"hubs": EventHub.stats(),
+                                 "event_cache": event_cache.stats(),
+                                 "redis_pools": pool_stats()})
@@ -0,0 +1,26 @@
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('api', '0003_auto_20180523_0905'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Marking',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.DateTimeField(default=datetime.datetime.utcnow)),
+                ('stream_id', models.CharField(max_length=32, unique=True)),
+                ('event', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='markings', to='api.Event')),
+                ('marker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='marked', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='marked_at', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_marking'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='karma_batch',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
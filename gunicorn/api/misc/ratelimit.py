@@ -0,0 +1,78 @@
+"""
+Rate limiting of client messages by token buckets.
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` actions per second on average and bursts of up to `burst` actions.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self):
+        """
+        Takes a token for an action.
+        :return: 0 if the action is allowed, otherwise seconds until a token is available
+        """
+
+        self.refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+class UserRateLimiter(object):
+    """
+    Token buckets of users shared by all the connections to the process.
+    Buckets which have refilled are dropped, so only users sending messages right now are kept.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user id -> TokenBucket
+        self.buckets = {}
+        self.prune_size = 1024
+
+    def take(self, user_id, rate, burst):
+        """
+        Takes a token for a message of a user.
+        :param user_id: id of the user
+        :param rate: messages per second
+        :param burst: maximal number of messages at once
+        :return: 0 if the message is allowed, otherwise seconds until a token is available
+        """
+
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                if len(self.buckets) >= self.prune_size:
+                    self.prune()
+                bucket = self.buckets[user_id] = TokenBucket(rate, burst)
+            return bucket.take()
+
+    def prune(self):
+        now = time.monotonic()
+        for user_id, bucket in list(self.buckets.items()):
+            if bucket.is_full(now):
+                del self.buckets[user_id]
+        self.prune_size = max(1024, 2 * len(self.buckets))
+
+
+user_rate_limiter = UserRateLimiter()
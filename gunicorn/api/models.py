@@ -19,6 +19,8 @@ class UserProfile(models.Model):
     confirmed = models.BooleanField(default=False)
     bio = models.CharField(max_length=128)
     karma = models.PositiveIntegerField(default=0)
+    # Id of the last batch of pending karma changes added to the karma, so a batch is never added twice
+    karma_batch = models.CharField(max_length=32, blank=True, default='')
 
 
 class Event(models.Model):
@@ -32,6 +34,18 @@ class Event(models.Model):
     time_to = models.DateTimeField(default=datetime.utcnow)
 
 
+class Marking(models.Model):
+    event = models.ForeignKey(Event, related_name='markings',
+                              on_delete=models.CASCADE)
+    user = models.ForeignKey(User, related_name='marked_at',
+                             on_delete=models.CASCADE)
+    marker = models.ForeignKey(User, related_name='marked',
+                               on_delete=models.CASCADE)
+    time = models.DateTimeField(default=datetime.utcnow)
+    # id of the entry of the markings stream the record was made from
+    stream_id = models.CharField(max_length=32, unique=True)
+
+
 # create user profile automatically on creating new user
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -0,0 +1,46 @@
+"""
+Write-behind karma accounting.
+Karma changes are accumulated in redis and periodically written to the database in bulk.
+Every profile records the last batch of changes added to its karma, so a batch written again
+after a failed acknowledgement is skipped.
+"""
+
+from django.db import connection, transaction
+
+from ..marking.storage import storage
+from ..models import UserProfile
+
+FLUSH_BATCH_SIZE = 1000
+
+
+def get_karma(profile):
+    """
+    Returns the current karma of a user including changes not written to the database yet.
+    :param profile: UserProfile of the user
+    :return: karma
+    """
+
+    return profile.karma + storage.get_pending_karma(profile.user_id, applied_batch=profile.karma_batch)
+
+
+def flush_pending_karma():
+    """
+    Writes accumulated karma changes to the database.
+    :return: number of users whose karma has been changed
+    """
+
+    batch_id, deltas = storage.take_pending_karma()
+    deltas = [(user_id, delta) for user_id, delta in deltas.items() if delta]
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(deltas), FLUSH_BATCH_SIZE):
+            chunk = deltas[start:start + FLUSH_BATCH_SIZE]
+            cursor.execute(
+                "UPDATE {table} AS profile SET karma = profile.karma + pending.delta, karma_batch = %s "
+                "FROM (VALUES {values}) AS pending(user_id, delta) "
+                "WHERE profile.user_id = pending.user_id AND profile.karma_batch <> %s"
+                .format(table=UserProfile._meta.db_table, values=", ".join(["(%s, %s)"] * len(chunk))),
+                [batch_id] + [value for user_delta in chunk for value in user_delta] + [batch_id]
+            )
+    if batch_id is not None:
+        storage.ack_pending_karma(batch_id)
+    return len(deltas)
@@ -1,10 +1,17 @@
 import base64
 import os
+from unittest import mock
 
+import redis
+from asgiref.sync import async_to_sync
 from django.contrib.auth.models import User
-from django.test import Client
+from django.test import Client, TestCase
 from django.urls import reverse
 
+from .karma import flush_pending_karma, get_karma
+from ..marking.storage import storage
+from ..marking.storage.memory import InMemoryStorage
+from ..marking.storage.redis_backend import RedisStorage
 from ..misc.response import ResponseCode
 from ..misc.test import APITestCase, JSONClient
 from ..models import UserProfile
@@ -43,6 +50,37 @@ class UserProfileTestCase(APITestCase):
         self.assertEqual(self.user_profile.bio, profile['bio'])
         self.assertEqual(self.user_profile.karma, profile['karma'])
 
+    def test_get_profile_with_pending_karma(self):
+        client = Client()
+        client.force_login(self.user_profile.user)
+        user_id = self.user_profile.user.id
+        async_to_sync(storage.add_karma)(user_id, 50)
+
+        response = client.get(reverse('get_profile'), {'user_id': user_id},
+                              content_type='application/json')
+        parsed = self.parseAndCheckResponseCode(response, ResponseCode.RESPONSE_OK)
+        self.assertEqual(self.user_profile.karma + 50, parsed["response"]['karma'])
+
+        flush_pending_karma()
+        self.assertEqual(0, storage.get_pending_karma(user_id))
+        self.assertEqual(self.user_profile.karma + 50, UserProfile.objects.get(user=user_id).karma)
+
+    def test_flush_pending_karma_after_failed_ack(self):
+        user_id = self.user_profile.user.id
+        async_to_sync(storage.add_karma)(user_id, 50)
+
+        with mock.patch.object(storage, 'ack_pending_karma', side_effect=redis.ConnectionError):
+            with self.assertRaises(redis.ConnectionError):
+                flush_pending_karma()
+        profile = UserProfile.objects.get(user=user_id)
+        self.assertEqual(self.user_profile.karma + 50, profile.karma)
+        self.assertEqual(self.user_profile.karma + 50, get_karma(profile))
+
+        # The batch is taken again and skipped
+        flush_pending_karma()
+        self.assertEqual(0, storage.get_pending_karma(user_id))
+        self.assertEqual(self.user_profile.karma + 50, UserProfile.objects.get(user=user_id).karma)
+
     def test_get_nonexisting_profile(self):
         client = Client()
         client.force_login(self.user_profile.user)
@@ -162,3 +200,31 @@ class UserProfileTestCase(APITestCase):
                                         {'name': 'test confirmation.jpg',
                                          'image': base64.encodebytes(file.read()).decode('utf-8')})
             self.parseAndCheckResponseCode(response, ResponseCode.RESPONSE_OK)
+
+
+class PendingKarmaTestCase(TestCase):
+    def test_take_and_ack(self):
+        user_id = 987654321
+        for backend in (RedisStorage(), InMemoryStorage()):
+            with self.subTest(backend=type(backend).__name__):
+                backend.ack_pending_karma(backend.take_pending_karma()[0])
+                self.assertEqual((None, {}), backend.take_pending_karma())
+
+                async_to_sync(backend.add_karma)(user_id, 2)
+                async_to_sync(backend.add_karma)(user_id, -1)
+                self.assertEqual(1, backend.get_pending_karma(user_id))
+                batch, deltas = backend.take_pending_karma()
+                self.assertEqual(1, deltas[user_id])
+                async_to_sync(backend.add_karma)(user_id, 5)
+                # Changes taken but not acknowledged are taken again
+                self.assertEqual((batch, deltas), backend.take_pending_karma())
+                self.assertEqual(6, backend.get_pending_karma(user_id))
+                # Changes of a batch already written to the profile are not counted twice
+                self.assertEqual(5, backend.get_pending_karma(user_id, applied_batch=batch))
+
+                backend.ack_pending_karma("another batch")
+                self.assertEqual(6, backend.get_pending_karma(user_id))
+                backend.ack_pending_karma(batch)
+                self.assertEqual(5, backend.get_pending_karma(user_id))
+                self.assertNotEqual(batch, backend.take_pending_karma()[0])
+                backend.ack_pending_karma(backend.take_pending_karma()[0])
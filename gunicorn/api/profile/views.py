@@ -5,6 +5,7 @@ from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ValidationError
 from django.views.decorators.http import require_GET, require_POST
 
+from .karma import get_karma
 from ..misc.http_decorators import require_arguments, require_files, require_content_type
 from ..misc.response import (
     APIInvalidArgumentResponse,
@@ -43,7 +44,7 @@ def profile_get(request):
                                  "pic": profile.picture,
                                  "confirmed": profile.confirmed,
                                  "bio": profile.bio,
-                                 "karma": profile.karma})
+                                 "karma": get_karma(profile)})
 
 
 @require_content_type('json')
@@ -60,7 +61,8 @@ def profile_update_picture(request):
 
     profile = UserProfile.objects.filter(user=user).first()
     profile.picture = filename
-    profile.save()
+    # Karma is written by flush_pending_karma concurrently
+    profile.save(update_fields=['picture'])
     return APIResponse()
 
 
@@ -76,7 +78,8 @@ def profile_update_info(request):
         profile.display_name = request.POST['display_name']
     if 'bio' in request.POST:
         profile.bio = request.POST['bio']
-    profile.save()
+    # Karma is written by flush_pending_karma concurrently
+    profile.save(update_fields=['display_name', 'bio'])
     return APIResponse()
 
 
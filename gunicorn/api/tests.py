@@ -1,3 +1,26 @@
-from django.test import TestCase
+import time
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from .misc.ratelimit import TokenBucket, UserRateLimiter
+
+
+class RateLimitTestCase(SimpleTestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual(0, bucket.take())
+        self.assertEqual(0, bucket.take())
+        self.assertTrue(0 < bucket.take() <= 0.1)
+        time.sleep(0.1)
+        self.assertEqual(0, bucket.take())
+
+    def test_user_rate_limiter(self):
+        limiter = UserRateLimiter()
+        limiter.prune_size = 2
+        self.assertEqual(0, limiter.take(1, rate=1000, burst=1))
+        self.assertGreater(limiter.take(1, rate=1000, burst=1), 0)
+        limiter.take(2, rate=1000, burst=1)
+        time.sleep(0.01)
+        # Refilled buckets are dropped
+        limiter.take(3, rate=1000, burst=1)
+        self.assertEqual({3}, set(limiter.buckets))
@@ -4,4 +4,5 @@ urlpatterns = [
     path('profile/', include('api.profile.urls')),
     path('events/', include('api.events.urls')),
     path('auth/', include('api.auth.urls')),
+    path('marking/', include('api.marking.urls')),
 ]
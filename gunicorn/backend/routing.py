@@ -1,9 +1,9 @@
 import api.routing
-from channels.auth import AuthMiddlewareStack
+from api.auth.tickets import TicketAuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 application = ProtocolTypeRouter({
-    'websocket': AuthMiddlewareStack(
+    'websocket': TicketAuthMiddlewareStack(
         URLRouter(
             api.routing.websocket_urlpatterns
         )
@@ -100,6 +100,34 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Marking subsystem
+# See api/marking/conf.py for all the available options and their defaults
+
+MARKING = {
+    # "host:port" of the redis nodes separated by commas, e.g. set by docker-compose.sharded.yml
+    "REDIS_NODES": [tuple(node.split(':')) for node in os.environ.get("MARKING_REDIS_NODES", "").split(',') if node],
+}
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+        },
+    },
+    "loggers": {
+        "api": {
+            "handlers": ["console"],
+            "level": "INFO",
+        },
+        "backend.workers": {
+            "handlers": ["console"],
+            "level": "INFO",
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
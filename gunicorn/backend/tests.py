@@ -0,0 +1,15 @@
+from .workers import worker_sockets
+
+
+class TestWorkerSockets(object):
+    def test_worker_sockets(self):
+        sockets = worker_sockets('127.0.0.1', 0, 3)
+        assert len(sockets) == 3 and len({sock.fileno() for sock in sockets}) == 1
+        assert sockets[0].getsockname()[1] != 0
+        sockets[0].close()
+
+        sockets = worker_sockets('127.0.0.1', 0, 2, event_affinity=True)
+        ports = [sock.getsockname()[1] for sock in sockets]
+        assert len(set(ports)) == 2 and 0 not in ports
+        for sock in sockets:
+            sock.close()
@@ -0,0 +1,175 @@
+"""
+Runner of several daphne processes serving one preloaded application.
+The application is loaded once and the workers are forked from the runner,
+so they start fast and share the memory of the loaded code.
+The runner keeps the workers running and replaces them on SIGHUP without closing the listening sockets.
+"""
+
+import logging
+import os
+import signal
+import socket
+import time
+
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+
+def listen(host, port, backlog=2048):
+    """
+    Opens a listening socket to be inherited by the workers.
+    :param host: address to bind
+    :param port: port to bind
+    :param backlog: maximal number of connections waiting to be accepted
+    :return: socket.socket instance
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def worker_sockets(host, port, workers, event_affinity=False):
+    """
+    Opens the listening sockets of the workers.
+    :param host: address to bind
+    :param port: port to bind, the first of the ports in the event affinity mode, 0 to bind any free ports
+    :param workers: number of workers
+    :param event_affinity: give every worker its own port (port, port + 1, ...), so a proxy can send
+      all the sockets of an event to the same worker, otherwise the workers accept connections of one socket
+    :return: list of sockets, one per worker
+    """
+
+    if event_affinity:
+        return [listen(host, port + index if port else 0) for index in range(workers)]
+    return [listen(host, port)] * workers
+
+
+class WorkerRunner(object):
+    """
+    Forks a daphne worker per socket and keeps it running.
+    SIGHUP starts new workers and stops the old ones gracefully, SIGTERM and SIGINT stop the runner.
+    A preloaded application is not reloaded by SIGHUP, the runner must be restarted to pick up new code.
+    """
+
+    def __init__(self, application, sockets, server_options, graceful_timeout=30):
+        """
+        :param application: ASGI application
+        :param sockets: listening sockets, one per worker
+        :param server_options: keyword arguments of daphne.server.Server
+        :param graceful_timeout: seconds stopped workers are given to close their connections
+        """
+
+        self.application = application
+        self.sockets = sockets
+        self.server_options = server_options
+        self.graceful_timeout = graceful_timeout
+        # pid -> index of the socket of the worker
+        self.workers = {}
+        # pid -> time the stopped worker is killed at
+        self.retiring = {}
+        self.signals = []
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda received, frame: self.signals.append(received))
+        # Connections opened while the application was loaded must not be shared by the workers
+        connections.close_all()
+
+        for index in range(len(self.sockets)):
+            self.spawn(index)
+        while True:
+            self.reap()
+            while self.signals:
+                if self.signals.pop(0) == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            self.kill_overdue()
+            time.sleep(0.5)
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                # Workers share the command line of the runner, so they may receive signals meant for it
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                self.serve(self.sockets[index])
+            except BaseException:
+                logger.exception("Worker %s failed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+        logger.info("Started worker %s on %s:%s", pid, *self.sockets[index].getsockname()[:2])
+        self.workers[pid] = index
+
+    def serve(self, sock):
+        # Twisted installs its reactor when daphne.server is imported, so the runner must not import it
+        from daphne.endpoints import build_endpoint_description_strings
+        from daphne.server import Server
+
+        for other in self.sockets:
+            if other.fileno() != sock.fileno():
+                other.close()
+        Server(application=self.application,
+               endpoints=build_endpoint_description_strings(file_descriptor=sock.fileno()),
+               **self.server_options).run()
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            self.retiring.pop(pid, None)
+            index = self.workers.pop(pid, None)
+            if index is not None:
+                logger.warning("Worker %s exited with status %s, restarting", pid, status)
+                self.spawn(index)
+
+    def reload(self):
+        logger.info("Reloading workers")
+        old_workers = self.workers
+        self.workers = {}
+        for index in range(len(self.sockets)):
+            self.spawn(index)
+        # The new workers accept connections on the same sockets while the old ones close theirs
+        self.terminate(old_workers)
+
+    def terminate(self, pids):
+        for pid in pids:
+            self.retiring[pid] = time.monotonic() + self.graceful_timeout
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, kill_at in list(self.retiring.items()):
+            if now >= kill_at:
+                logger.warning("Worker %s did not stop in time, killing", pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                del self.retiring[pid]
+
+    def stop(self):
+        logger.info("Stopping workers")
+        workers = self.workers
+        self.workers = {}
+        self.terminate(workers)
+        while self.retiring:
+            self.reap()
+            self.kill_overdue()
+            time.sleep(0.1)
@@ -4,5 +4,10 @@ python wait_for_db.py &&
 python manage.py collectstatic --noinput && 
 python manage.py makemigrations && 
 python manage.py migrate && 
-daphne -b 0.0.0.0 -p 8000 backend.asgi:application ||
+(python manage.py flush_karma --interval 5 &) &&
+(python manage.py reap_presence --interval 15 &) &&
+(python manage.py sweep_events --interval 60 &) &&
+(python manage.py persist_markings --interval 5 &) &&
+python manage.py run_workers --workers "${WORKERS:-4}" --event-affinity --port "${WORKERS_PORT:-8000}" --ping-interval 10 --ping-timeout 30 \
+    --pid /tmp/workers.pid ||
 echo ERROR
@@ -0,0 +1,14 @@
+#!/bin/sh
+# Lists the workers started by run.sh for the upstreams of nginx.conf:
+# WORKERS processes listening on consecutive ports from WORKERS_PORT
+set -e
+
+WORKERS=${WORKERS:-4}
+WORKERS_PORT=${WORKERS_PORT:-8000}
+
+: > /etc/nginx/workers.conf
+i=0
+while [ "$i" -lt "$WORKERS" ]; do
+  echo "server gunicorn:$((WORKERS_PORT + i));" >> /etc/nginx/workers.conf
+  i=$((i + 1))
+done